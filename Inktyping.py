@@ -7,16 +7,14 @@ import random
 import shutil
 import json  
 import datetime  
+import multiprocessing
 
 from send2trash import send2trash
 from pathlib import Path
 
 # Text stuff
 import re
-import inflect
-from ebooklib import epub, ITEM_DOCUMENT
-from bs4 import BeautifulSoup
-import PyPDF2
+from collections import OrderedDict
 import time
 from html import escape
 
@@ -34,6 +32,7 @@ import sip
 # App 
 from main_window import Ui_MainWindow
 from session_display import Ui_session_display
+from text_engine import ExtractionEngine, ExtractionCancelled, PresetIndex, SessionPlaylist, parse_preset_record, sample_preset_blocks, DEFAULT_TEXT_CACHE_SETTINGS, DEFAULT_STREAMING_SETTINGS, DEFAULT_PDF_SETTINGS
 import resources_config_rc  
 
 
@@ -45,10 +44,10 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
         self.setupUi(self)
         self.setWindowTitle('Sentence practice - Inktyping')
         self.session_schedule = {}
+        self.extraction_thread = None  # Preset extraction running in the background
+        self.extraction_progress_dialog = None
         # Install event filter
         self.installEventFilter(self)
-        
-        self.plural = inflect.engine()
 
 
 
@@ -199,6 +198,9 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
 
         self.display = None  # Initialize with None
 
+        # A running extraction is cancelled when the application quits
+        QtWidgets.QApplication.instance().aboutToQuit.connect(self.stop_preset_extraction)
+
         # Automatically start the session if auto_start is True
         if self.auto_start_settings:
             self.start_session_from_files()
@@ -510,6 +512,10 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
         to a specific dialog or session window.
         """
 
+        # The session fonts and stylesheets are applied again after a theme change
+        if session and hasattr(session, 'render_cache'):
+            session.render_cache.text_style_key = None
+
         # Load the selected theme file
         selected_theme_path = os.path.join(self.theme_presets_dir, self.current_theme)
         print('NOW LOADING THEME : ',selected_theme_path)
@@ -872,7 +878,8 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
 ########################################## TEXT PARSING ##########################################
 
     def create_preset(self, selected_files=None, keyword_profiles=None, preset_name=None, highlight_keywords=True, 
-                      output_option="Single output", max_length=200, metadata_settings=True, output_folder=None, is_gui=True, metadata_prefix=";;"):
+                      output_option="Single output", max_length=200, metadata_settings=True, output_folder=None, is_gui=True, metadata_prefix=";;",
+                      use_text_cache=None, jobs=None, use_sentence_index=None):
         """
         Opens a dialog for folder selection, collects keyword profiles, and processes all EPUB, PDF, and TXT files 
         within the selected folders using the chosen profiles. Combines results from all folders.
@@ -882,6 +889,9 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
 
 
         if is_gui:
+            if self.extraction_thread is not None:
+                self.show_info_message('Extraction Running', 'Wait for the current extraction to finish or cancel it.')
+                return
 
             dialog = MultiFolderSelector(self, preset_name, text_presets_dir=self.text_presets_dir)
 
@@ -896,6 +906,9 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
                 highlight_keywords = dialog.highlight_keywords_checkbox.isChecked()
                 output_option = dialog.output_option_dropdown.currentText()
                 metadata_settings = dialog.extract_metadata_checkbox.isChecked()
+                use_text_cache = dialog.text_cache_checkbox.isChecked()
+                jobs = dialog.jobs_spinbox.value()
+                use_sentence_index = dialog.sentence_index_checkbox.isChecked()
                 if preset_name == None:
                     preset_name = dialog.preset_name_edit.text()
 
@@ -916,84 +929,103 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
                 self.show_info_message('No Selection', 'No folders were selected.')
             return
 
-        # Dictionary to store all results
-        all_results = {}
-        total_sentences = 0  # Counter for total unique sentences
-
-
-
-        # Start timer    
-        start_time = time.time()
-
-
-
-
-        folder_results = self.process_text_files(
-                file_paths=selected_files,
-                keyword_profiles=keyword_profiles,
-                highlight_keywords=highlight_keywords,
-                output_option=output_option,
-                preset_name=preset_name,
-                max_length=max_length,
-                metadata_settings=metadata_settings
-            )
+        preset_settings = dict(
+            selected_files=selected_files,
+            keyword_profiles=keyword_profiles,
+            preset_name=preset_name,
+            highlight_keywords=highlight_keywords,
+            output_option=output_option,
+            max_length=max_length,
+            metadata_settings=metadata_settings,
+            output_folder=output_folder,
+            metadata_prefix=metadata_prefix,
+            use_text_cache=use_text_cache,
+            jobs=jobs,
+            use_sentence_index=use_sentence_index
+        )
 
+        if not is_gui:
+            self.get_extraction_engine().create_preset(**preset_settings)
+            return
 
+        # Extract in the background, the summary message and the presets reload come when it finishes
+        self.start_preset_extraction(preset_settings)
+
+    def start_preset_extraction(self, preset_settings):
+        """Run the extraction in a worker thread and show its progress in a non-modal dialog."""
+        self.extraction_thread = PresetExtractionThread(self.get_extraction_engine(), preset_settings, self)
+        self.extraction_thread.progress.connect(self.update_extraction_progress)
+        self.extraction_thread.completed.connect(self.extraction_completed)
+        self.extraction_thread.cancelled.connect(self.extraction_cancelled)
+        self.extraction_thread.failed.connect(self.extraction_failed)
+
+        self.extraction_progress_dialog = QtWidgets.QProgressDialog("Starting extraction...", "Cancel", 0, 0, self)
+        self.extraction_progress_dialog.setWindowTitle('Creating Preset')
+        self.extraction_progress_dialog.setWindowModality(Qt.NonModal)  # The preset tables stay usable
+        self.extraction_progress_dialog.setMinimumDuration(0)
+        self.extraction_progress_dialog.setMinimumWidth(400)
+        self.extraction_progress_dialog.setAutoClose(False)
+        self.extraction_progress_dialog.setAutoReset(False)
+        self.extraction_progress_dialog.canceled.connect(self.cancel_preset_extraction)
+        self.init_styles(dialog=self.extraction_progress_dialog)
+        self.extraction_progress_dialog.show()
+
+        self.extraction_thread.start()
+
+    def update_extraction_progress(self, files_done, files_total, sentences, remaining_time, file_path, pages=None):
+        if self.extraction_progress_dialog is None:
+            return
+        file_text = os.path.basename(file_path)
+        if pages is not None:
+            file_text += f" (page {pages[0]}/{pages[1]})"
+        label_text = (f"Processed {files_done}/{files_total} files: {file_text}\n"
+                      f"{sentences} sentences extracted")
+        if files_done >= files_total:
+            label_text += "\nWriting the preset..."
+        elif remaining_time is not None:
+            minutes, seconds = divmod(int(remaining_time), 60)
+            label_text += f"\nTime remaining: {minutes}:{seconds:02d}"
+        self.extraction_progress_dialog.setMaximum(files_total)
+        self.extraction_progress_dialog.setValue(files_done)
+        self.extraction_progress_dialog.setLabelText(label_text)
+
+    def cancel_preset_extraction(self):
+        """Ask the extraction to stop after the current file, nothing gets written."""
+        if self.extraction_thread is not None:
+            print("Cancelling the extraction...")
+            self.extraction_thread.requestInterruption()
+
+    def finish_preset_extraction(self):
+        if self.extraction_progress_dialog is not None:
+            self.extraction_progress_dialog.canceled.disconnect(self.cancel_preset_extraction)
+            self.extraction_progress_dialog.close()
+            self.extraction_progress_dialog.deleteLater()
+            self.extraction_progress_dialog = None
+        if self.extraction_thread is not None:
+            self.extraction_thread.wait()
+            self.extraction_thread.deleteLater()
+            self.extraction_thread = None
+
+    def extraction_completed(self, summary_message):
+        self.finish_preset_extraction()
+        self.show_info_message('Extraction Complete', summary_message)
+        self.load_presets()
 
+    def extraction_cancelled(self):
+        self.finish_preset_extraction()
+        print("Extraction cancelled.")
+        self.show_info_message('Extraction Cancelled', 'The extraction was cancelled, no preset was written.')
 
-        # Merge results
-        for keyword, sentences in folder_results.items():
-            if keyword not in all_results:
-                all_results[keyword] = []
-            all_results[keyword].extend(sentences)
-
-        # Determine the output folder
-        target_folder = output_folder if output_folder else self.text_presets_dir
-        os.makedirs(target_folder, exist_ok=True)
-
-        # Create the combined output file and count unique sentences
-        combined_output_path = os.path.join(target_folder, f"{preset_name}.txt")
-        seen_sentences = set()
-
-        with open(combined_output_path, 'w', encoding='utf-8') as output_file:
-            for sentences in all_results.values():
-                for sentence_data in sentences:
-                    sentence_key = (sentence_data[0], sentence_data[1])  # sentence and filepath
-                    if sentence_key not in seen_sentences:
-                        seen_sentences.add(sentence_key)
-                        total_sentences += 1
-                        if metadata_settings:
-                            sentence, filepath, metadata = sentence_data  # Now includes metadata
-                            output_file.write(f'["""{sentence}""","""{metadata}"""]\n\n')
-                        else:
-                            sentence = sentence_data[0]
-                            output_file.write(f'{sentence}\n\n')
-
-        # If "All output" is selected, create individual keyword files
-        if output_option == "All output":
-            for keyword, sentences in all_results.items():
-                if sentences:
-                    keyword_output_path = os.path.join(
-                        target_folder, f"{preset_name}_{keyword}.txt"
-                    )
-                    with open(keyword_output_path, 'w', encoding='utf-8') as output_file:
-                        for sentence_data in sentences:
-                            if metadata_settings:
-                                sentence, filepath, metadata = sentence_data
-                                output_file.write(f'["""{sentence}""","""{metadata}"""]\n\n')
-                            else:
-                                sentence = sentence_data[0]
-                                output_file.write(f'{sentence}\n\n')
+    def extraction_failed(self, error_message):
+        self.finish_preset_extraction()
+        self.show_info_message('Extraction Failed', f'The extraction failed: {error_message}')
 
-        # End timer and calculate elapsed time
-        elapsed_time = time.time() - start_time
+    def stop_preset_extraction(self):
+        """Cancel a running extraction and wait for it, the worker thread can't outlive the application."""
+        if self.extraction_thread is not None and self.extraction_thread.isRunning():
+            self.extraction_thread.requestInterruption()
+            self.extraction_thread.wait()
 
-        # Show summary message and reload presets if using GUI
-        summary_message = (f"Successfully extracted {total_sentences} unique sentences to: {preset_name}.txt in {elapsed_time:.2f} seconds!")
-        if is_gui:
-            self.show_info_message('Extraction Complete', summary_message)
-            self.load_presets()
-        print(summary_message)
 
 
 
@@ -1002,6 +1034,17 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
 
 
 
+    def get_extraction_engine(self):
+        """Return the headless extraction engine configured with the current session settings."""
+        return ExtractionEngine(
+            self.presets_dir,
+            text_cache_settings=self.text_cache_settings,
+            extraction_jobs=self.extraction_jobs,
+            use_sentence_index=self.use_sentence_index,
+            streaming_settings=self.streaming_settings,
+            pdf_settings=self.pdf_settings,
+            save_timings=self.save_extraction_timings
+        )
 
     def create_keyword_profiles(self, keyword_input):
         """
@@ -1029,460 +1072,6 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
 
 
 
-    def process_text_files(self, file_paths, keyword_profiles, highlight_keywords=True, output_option="Single output", preset_name="preset_output", max_length=200, metadata_settings=True, metadata_prefix=";;"):
-        """
-        Process a folder of EPUB, PDF, or text files and return the extracted sentences.
-        Returns a tuple of (filtered_sentences, folder_path) where filtered_sentences is a dictionary
-        of keyword-sentence pairs with their complete file paths.
-        """
-        
-        # Process ignored keywords
-        ignored_keywords = keyword_profiles.get("Ignored keywords", [])
-        # Remove "Ignored keywords" from profiles for processing
-        if "Ignored keywords" in keyword_profiles:
-            del keyword_profiles["Ignored keywords"]
-
-        # Remove duplicates across all profiles
-        seen_keywords = set()
-        for profile, keywords in keyword_profiles.items():
-            unique_keywords = []
-            for keyword in keywords:
-                if keyword not in seen_keywords:
-                    unique_keywords.append(keyword)
-                    seen_keywords.add(keyword)
-            keyword_profiles[profile] = unique_keywords
-
-        # Remove duplicates from ignored keywords
-        ignored_keywords = list(set(ignored_keywords))
-
-        #print("Keywords by profile (unique)[0:5]:", keyword_profiles)
-        #print("Ignored keywords (unique)[0:5]:", ignored_keywords)
-
-        # Gather all files in the specified folder
-
-
-        # Initialize storage for combined sentences and processed keywords
-        combined_sentences = {
-            keyword: [] for keywords in keyword_profiles.values() 
-            for keyword in keywords
-        }
-        processed_keywords = []
-
-        # Process all profiles and extract sentences
-        for profile_number, keywords in keyword_profiles.items():
-            if keywords:
-                self.extract_sentences_with_keywords(
-                    file_paths, keywords, combined_sentences, 
-                    processed_keywords, max_length, metadata_settings, metadata_prefix
-                )
-
-        # Filter out sentences with ignored keywords and store full file paths
-        filtered_sentences = {
-            keyword: [
-                sentence_data for sentence_data in sentences
-                if not self.contains_ignored_keyword(sentence_data[0], ignored_keywords)
-            ]
-            for keyword, sentences in combined_sentences.items()
-        }
-
-        # Reset processed keywords for highlighting
-        processed_keywords = []
-
-        # Highlight keywords if requested
-        if highlight_keywords:
-            filtered_sentences = self.process_highlight_keywords(
-                filtered_sentences, keyword_profiles, processed_keywords
-            )
-
-        return filtered_sentences
-
-    def get_book_metadata(self, file_path, metadata_prefix=";;"):
-        """
-        Extract metadata from book files.
-        Returns metadata string with optional prefix from filename.
-        """
-        filename = os.path.basename(file_path)
-        filename_without_ext = os.path.splitext(filename)[0]
-        
-        # Extract prefix if present
-        prefix = ""
-        if metadata_prefix in filename_without_ext:
-            prefix, rest = filename_without_ext.split(metadata_prefix, 1)
-            filename_without_ext = rest.replace('_', ' ').strip()
-        
-        # Default values
-        title = filename_without_ext
-        author = "Unknown Author"
-        date = "Unknown Date"
-        
-        try:
-            if file_path.endswith('.epub'):
-                book = epub.read_epub(file_path)
-                
-                # Get title
-                if book.get_metadata('DC', 'title'):
-                    title = book.get_metadata('DC', 'title')[0][0]
-                
-                # Get author
-                if book.get_metadata('DC', 'creator'):
-                    author = book.get_metadata('DC', 'creator')[0][0]
-                
-                # Get date
-                if book.get_metadata('DC', 'date'):
-                    date = book.get_metadata('DC', 'date')[0][0]
-                    year_match = re.search(r'\d{4}', date)
-                    if year_match:
-                        date = year_match.group(0)
-                
-            elif file_path.endswith('.pdf'):
-                with open(file_path, 'rb') as file:
-                    reader = PyPDF2.PdfReader(file)
-                    if reader.metadata:
-                        if reader.metadata.get('/Title'):
-                            title = reader.metadata['/Title']
-                        if reader.metadata.get('/Author'):
-                            author = reader.metadata['/Author']
-                        if reader.metadata.get('/CreationDate'):
-                            date_str = reader.metadata['/CreationDate']
-                            year_match = re.search(r'D:(\d{4})', date_str)
-                            if year_match:
-                                date = year_match.group(1)
-            
-            # Clean up metadata
-            title = title.strip()
-            author = author.strip()
-            date = date.strip()
-            
-            if not title:
-                title = filename_without_ext
-                
-        except Exception as e:
-            print(f"Error extracting metadata from {filename}: {str(e)}")
-            title = filename_without_ext
-        
-        # Format the metadata string with prefix
-        metadata = prefix.strip()
-        if metadata:
-            metadata += " - "
-        metadata += title
-        if author != "Unknown Author":
-            metadata += f" by {author}"
-        if date != "Unknown Date":
-            metadata += f" - {date}"
-        
-        return metadata
-
-
-
-    def get_keyword_forms(self, keyword):
-        """
-        Get the forms of a keyword, handling the '&' prefix and combined keywords.
-        Returns a list of forms and a boolean indicating if it's an exact match.
-        """
-        if '+' in keyword:
-            # Split combined keywords and process each part
-            parts = [k.strip() for k in keyword.split('+')]
-            all_forms = []
-            exact_matches = []
-            
-            for part in parts:
-                if part.startswith('&'):
-                    all_forms.append([part[1:]])  # Exact form only
-                    exact_matches.append(True)
-                else:
-                    all_forms.append([self.get_singular_form(part), self.get_plural_form(part)])
-                    exact_matches.append(False)
-            
-            return all_forms, exact_matches
-        else:
-            if keyword.startswith('&'):
-                return [[keyword[1:]]], [True]  # Single keyword, exact match
-            else:
-                return [[self.get_singular_form(keyword), self.get_plural_form(keyword)]], [False]  # Single keyword, both forms
-
-
-
-    def contains_ignored_keyword(self, sentence, ignored_keywords):
-        """
-        Check if a sentence contains any of the ignored keywords.
-        Handles both regular ignored keywords and exact matches (with & prefix).
-        """
-        for ignored_keyword in ignored_keywords:
-            # Remove the ! prefix first
-            keyword = ignored_keyword.lstrip('!')
-            
-            # Get the forms to check (handles both exact and regular matches)
-            forms_to_check, exact_matches = self.get_keyword_forms(keyword)
-            
-            # Check each form
-            for form_group, is_exact in zip(forms_to_check, exact_matches):
-                for form in form_group:
-                    # For exact matches (with &), we need to match the exact form
-                    if is_exact:
-                        pattern = r'(?<!\w){}(?!\w)'.format(re.escape(form))
-                    else:
-                        pattern = r'\b{}\b'.format(re.escape(form))
-                    
-                    if re.search(pattern, sentence, re.IGNORECASE):
-                        return True
-        return False   
-
-
-
-
-    def process_highlight_keywords(self, filtered_sentences, profiles, processed_keywords):
-        """
-        Highlight keywords and their forms in sentences with the appropriate number of brackets based on the profile name.
-        Updated to handle metadata in sentence data.
-        """
-        for profile_name, keywords in profiles.items():
-            # Extract the numeric part from the profile name (e.g., 'Keywords_1' -> 1)
-            match = re.search(r'(\d+)', profile_name)
-            bracket_count = int(match.group(1)) if match else 1  # Default to 1 if no number is found
-
-            # Construct the bracket style for this profile
-            left_bracket = "{" * bracket_count
-            right_bracket = "}" * bracket_count
-
-            # Process each keyword in the profile
-            for keyword in keywords:
-                # Get all forms of the keyword(s)
-                forms_list, exact_matches = self.get_keyword_forms(keyword)
-                
-                # Flatten the forms list for highlighting
-                all_forms = [form for sublist in forms_list for form in sublist]
-                forms_lower = [form.lower() for form in all_forms]
-                
-                if any(form in processed_keywords for form in forms_lower):
-                    continue
-                
-                # Create pattern to match any of the keyword forms
-                pattern = re.compile(
-                    r'(?<!\w)({})\b'.format("|".join(map(re.escape, all_forms))), 
-                    re.IGNORECASE
-                )
-
-                # Highlight keywords in all sentences
-                for key, sentence_data_list in filtered_sentences.items():
-                    for i, sentence_data in enumerate(sentence_data_list):
-                        def replace_func(match):
-                            # Wrap the matched word in the appropriate brackets
-                            original_word = match.group(0)
-                            return f"{left_bracket}{original_word}{right_bracket}"
-
-                        # Update the sentence with highlighted keywords, preserving the metadata
-                        if len(sentence_data) == 3:  # If we have metadata
-                            sentence, filepath, metadata = sentence_data
-                            highlighted_sentence = pattern.sub(replace_func, sentence)
-                            filtered_sentences[key][i] = (highlighted_sentence, filepath, metadata)
-                        else:  # If we don't have metadata
-                            sentence, filepath = sentence_data
-                            highlighted_sentence = pattern.sub(replace_func, sentence)
-                            filtered_sentences[key][i] = (highlighted_sentence, filepath)
-
-                # Add all forms to processed_keywords
-                for form in all_forms:
-                    processed_keywords.append(form.lower())
-
-        return filtered_sentences
-
-
-
-    def replace_broken_characters(self, text):
-        replacements = {
-            "“": '"',
-            "’": "'",
-            "”": '"',
-            "—": "-",  # Correct long dash
-            "â€“": "-",  # Misinterpreted en dash
-            "â€”": "-",  # Misinterpreted em dash
-            " ": "",  # Non-breaking space
-            "…": "...",
-            "‘": "'",
-            "â€œ": '"',  # Misinterpreted opening double quote
-            "â€": '"',   # Misinterpreted closing double quote or other symbols
-            "â€™": "'",  # Misinterpreted apostrophe
-            "–": "-",  # Replace en dash if present
-        }
-
-        # Create a pattern that matches any of the keys in replacements (sorted by length to handle multi-character sequences first)
-        pattern = re.compile('|'.join(re.escape(key) for key in sorted(replacements.keys(), key=len, reverse=True)))
-
-        # Function to replace all occurrences
-        def replace(match):
-            return replacements[match.group(0)]
-
-        # Replace all occurrences of broken characters with their correct counterparts
-        return pattern.sub(replace, text)
-
-
-
-
-
-    def get_plural_form(self, keyword):
-        return self.plural.plural(keyword)
-
-    def get_singular_form(self, keyword):
-        # For words already in singular form
-        if self.plural.singular_noun(keyword) == False:
-            return keyword
-        # For plurals
-        return self.plural.singular_noun(keyword)
-
-                
-    def extract_sentences_with_keywords(self, file_paths, keywords, combined_sentences, processed_keywords, max_length, metadata_settings=True, metadata_prefix=";;"):
-        """
-        Extract sentences containing the provided keywords from the list of files.
-        Optimized to process each file only once and pre-filter keywords.
-        """
-        def match_keywords(forms_list, exact_matches, sentence, max_length=200):
-            def find_keyword_in_sentence(forms, exact_match, sentence):
-                for form in forms:
-                    if re.search(r'\b{}\b'.format(re.escape(form)), sentence, re.IGNORECASE):
-                        return form
-                return None
-
-            found_keywords = []
-            for forms, exact_match in zip(forms_list, exact_matches):
-                found_keyword = find_keyword_in_sentence(forms, exact_match, sentence)
-                if not found_keyword:
-                    return False
-                found_keywords.append(found_keyword)
-
-            return truncate_sentence_around_keywords(sentence, found_keywords, max_length)
-
-        def truncate_sentence_around_keywords(sentence, keywords, max_length=200):
-            positions = []
-            for keyword in keywords:
-                match = re.search(r'\b{}\b'.format(re.escape(keyword)), sentence, re.IGNORECASE)
-                if match:
-                    positions.append((match.start(), match.end()))
-            
-            if not positions:
-                return self.truncate_sentence(sentence, max_length)
-            
-            positions.sort()
-            start_pos = positions[0][0]
-            end_pos = positions[-1][1]
-            context_length = (max_length - (end_pos - start_pos)) // 2
-            
-            start = max(0, start_pos - context_length)
-            end = min(len(sentence), end_pos + context_length)
-            
-            if start > 0:
-                start = sentence.rfind(' ', 0, start) + 1
-            if end < len(sentence):
-                end = sentence.rfind(' ', end) + 1
-            
-            truncated = sentence[start:end].strip()
-            if start > 0:
-                truncated = '...' + truncated
-            if end < len(sentence):
-                truncated = truncated + '...'
-            
-            return truncated
-
-        def extract_text_from_epub(file_path):
-            book = epub.read_epub(file_path)
-            full_text = ""
-            for item in book.get_items_of_type(ITEM_DOCUMENT):
-                content = item.get_body_content().decode('utf-8')
-                soup = BeautifulSoup(content, 'html.parser')
-                full_text += soup.get_text(separator=' ')
-            return full_text
-
-        def clean_linebreaks(text):
-            return re.sub(r'(\n\s*)+', ' ', text).strip()
-
-        # Pre-process keywords and their forms
-        keyword_forms_map = {}
-        for keyword in keywords:
-            forms_list, exact_matches = self.get_keyword_forms(keyword)
-            # Skip if all forms have been processed
-            all_forms = [form.lower() for sublist in forms_list for form in sublist]
-            if all(form in processed_keywords for form in all_forms):
-                continue
-            keyword_forms_map[keyword] = (forms_list, exact_matches, all_forms)
-
-        unique_sentences = set()
-
-        # Process each file once
-        for file_path in file_paths:
-            filename = os.path.basename(file_path)
-            
-            # Extract metadata once per file if needed
-            metadata = None
-            if metadata_settings:
-                try:
-                    metadata = self.get_book_metadata(file_path, metadata_prefix)
-                except Exception as e:
-                    print(f"Error extracting metadata from {filename}: {str(e)}")
-                    metadata = filename
-            
-            # Read file content
-            try:
-                if file_path.endswith('.pdf'):
-                    with open(file_path, 'rb') as file:
-                        reader = PyPDF2.PdfReader(file)
-                        full_text = "".join([page.extract_text() or "" for page in reader.pages])
-                elif file_path.endswith('.txt'):
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as file:
-                            full_text = file.read()
-                    except UnicodeDecodeError:
-                        with open(file_path, 'r', encoding='iso-8859-1') as file:
-                            full_text = file.read()
-                elif file_path.endswith('.epub'):
-                    full_text = extract_text_from_epub(file_path)
-                else:
-                    print(f"Unsupported file type: {file_path}")
-                    continue
-
-                # Clean and split text into sentences
-                full_text = clean_linebreaks(full_text)
-                
-                # Pre-filter keywords based on simple text matching
-                active_keywords = {}
-                for keyword, (forms_list, exact_matches, all_forms) in keyword_forms_map.items():
-                    # Check if any form of the keyword appears in the text
-                    if any(form.lower() in full_text.lower() for forms in forms_list for form in forms):
-                        active_keywords[keyword] = (forms_list, exact_matches)
-
-                if not active_keywords:
-                    continue  # Skip processing if no keywords found in file
-
-                # Process sentences only if we have matching keywords
-                sentences = re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s', full_text)
-                
-                for sentence in sentences:
-                    sentence_cleaned = self.replace_broken_characters(sentence.strip())
-                    
-                    # Check each active keyword
-                    for keyword, (forms_list, exact_matches) in active_keywords.items():
-                        matched_sentence_trimmed = match_keywords(forms_list, exact_matches, sentence_cleaned, max_length)
-                        if matched_sentence_trimmed:
-                            if metadata_settings:
-                                sentence_data = (matched_sentence_trimmed, file_path, metadata)
-                            else:
-                                sentence_data = (matched_sentence_trimmed, file_path)
-                                
-                            if sentence_data not in unique_sentences:
-                                unique_sentences.add(sentence_data)
-                                if keyword not in combined_sentences:
-                                    combined_sentences[keyword] = []
-                                combined_sentences[keyword].append(sentence_data)
-
-            except Exception as e:
-                print(f"Error processing file {file_path}: {str(e)}")
-                continue
-
-        # Update processed keywords
-        for _, (_, _, all_forms) in keyword_forms_map.items():
-            processed_keywords.extend(all_forms)
-
-        print(f"Processed keywords: {processed_keywords[0:5]} ...")
-        print(f"Extracted {len(unique_sentences)} unique sentences.")
-
 ########################################## TEXT PARSING END ##########################################
 ########################################## TEXT PARSING END ##########################################
 ########################################## TEXT PARSING END ##########################################
@@ -1593,6 +1182,7 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
         if os.path.exists(file_path):
             try:
                 send2trash(file_path)
+                PresetIndex.remove_sidecar(file_path)
                 
                 # Remove from preset_labels_dictionary if it exists
                 if file_name in self.preset_labels_dictionary:
@@ -1888,6 +1478,8 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
 
             # Rename the file
             os.rename(old_filepath, new_filepath)
+            if item.tableWidget() == self.table_sentences_selection:
+                PresetIndex.rename_sidecar(old_filepath, new_filepath)
 
             # Update label assignment if this is a sentence preset
             if item.tableWidget() == self.table_sentences_selection and old_filename in self.preset_labels_dictionary:
@@ -2051,29 +1643,16 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
                     self.table_sentences_selection.setItem(row_position, 1, name_item)
 
 
-                    # Count the number of empty lines in the text file
+                    # Count the sentences of the preset, read from the header of its index
                     file_path = os.path.join(self.text_presets_dir, filename)
-                    empty_line_count = 0
-                    
                     try:
-                        # Try UTF-8 first, fall back to other encodings if needed
-                        try:
-                            with open(file_path, 'r', encoding='utf-8') as file:
-                                for line in file:
-                                    if line.strip() == "":  # Check for empty line
-                                        empty_line_count += 1
-                        except UnicodeDecodeError:
-                            # Try ISO-8859-1 if UTF-8 fails
-                            with open(file_path, 'r', encoding='iso-8859-1') as file:
-                                for line in file:
-                                    if line.strip() == "":  # Check for empty line
-                                        empty_line_count += 1
+                        sentence_count = len(PresetIndex(file_path))
                     except Exception as e:
                         print(f"Error reading file {filename}: {str(e)}")
-                        empty_line_count = 0  # Set to 0 if we can't read the file
+                        sentence_count = 0  # Set to 0 if we can't read the file
 
-                    # Add the empty line count to the third column
-                    count_item = QtWidgets.QTableWidgetItem(str(empty_line_count))
+                    # Add the sentence count to the third column
+                    count_item = QtWidgets.QTableWidgetItem(str(sentence_count))
                     count_item.setTextAlignment(QtCore.Qt.AlignCenter)  # Center the text
                     count_item.setFlags(count_item.flags() & ~Qt.ItemIsEditable)  # Make non-editable
 
@@ -2246,19 +1825,6 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
                 seconds = int(time_str.split('s')[0])
             return minutes * 60 + seconds
 
-        def parse_sentence_block(block):
-
-            block = block.strip()
-            try:
-                # First try to parse as a list containing sentence and metadata
-                entry = eval(block)
-                if isinstance(entry, list) and len(entry) == 2:
-                    return [entry[0].strip(), entry[1].strip()]
-            except:
-                # If parsing fails, treat as a regular sentence and add empty metadata
-                return [block, ""]
-
-
 
         if self.selected_sentence_filename == None or self.selected_session_filename == None:
             self.show()
@@ -2273,7 +1839,6 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
 
 
         session_details = {}
-        selected_sentences = []
 
 
         try:
@@ -2285,38 +1850,44 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
             self.show()
             return
 
+        # Only the block numbers of the displayed sentences are drawn, from the index of the preset, or in a
+        # single pass over the preset by reservoir sampling when it has no index yet. They are read when displayed
+        session_time = convert_time_to_seconds(session_details.get('time', '0m 0s'))
+        total_sentences_to_display = session_details.get('total_sentences')
         try:
-            with open(sentence_preset_path, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-                sentence_blocks = content.split("\n\n")
-                for block in sentence_blocks:
-                    try:
-                        parsed_entry = parse_sentence_block(block)
-                        selected_sentences.append(parsed_entry)
-                    except Exception as e:
-                        print(f"Failed to parse block: {block}, Error: {e}")
-                print(f"Loaded {len(selected_sentences)} sentence blocks from {sentence_preset_path}.")
+            available_sentences = PresetIndex.read_count(sentence_preset_path)
+            if available_sentences is not None:
+                preset_index = PresetIndex(sentence_preset_path)
+                sample_size = available_sentences
+                if total_sentences_to_display is not None:
+                    sample_size = min(available_sentences, total_sentences_to_display)
+                if randomize_settings:
+                    block_numbers = random.sample(range(available_sentences), sample_size)
+                else:
+                    block_numbers = range(sample_size)
+                playlist = SessionPlaylist(sentence_preset_path, block_numbers, preset_index=preset_index)
+            else:
+                sampled_blocks = sample_preset_blocks(sentence_preset_path, total_sentences_to_display, randomize_settings)
+                playlist = SessionPlaylist(sentence_preset_path, [number for number, _ in sampled_blocks],
+                                           blocks=[block for _, block in sampled_blocks])
         except FileNotFoundError:
             print(f"Text file not found: {sentence_preset_path}")
             self.show()
             return
 
-        # Use provided or default randomize_settings
-
-
         if randomize_settings:
-            random.shuffle(selected_sentences)
             print("-- Sentences have been shuffled randomly.")
 
+        if total_sentences_to_display is None:
+            total_sentences_to_display = len(playlist)
+        if total_sentences_to_display > len(playlist):
+            print(f"Warning: Not enough sentences to display. Requested {total_sentences_to_display}, but only {len(playlist)} available.")
+            total_sentences_to_display = len(playlist)
 
-        session_time = convert_time_to_seconds(session_details.get('time', '0m 0s'))
-        total_sentences_to_display = session_details.get('total_sentences', len(selected_sentences))
-
-        if total_sentences_to_display > len(selected_sentences):
-            print(f"Warning: Not enough sentences to display. Requested {total_sentences_to_display}, but only {len(selected_sentences)} available.")
-            total_sentences_to_display = len(selected_sentences)
-
-        selected_sentences = selected_sentences[:total_sentences_to_display]
+        if available_sentences is not None:
+            print(f"Loaded {len(playlist)} of {available_sentences} sentence blocks from {sentence_preset_path}.")
+        else:
+            print(f"Loaded {len(playlist)} sentence blocks from {sentence_preset_path} (sampled without index).")
 
         self.session_schedule = {
             0: [
@@ -2336,7 +1907,7 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
             file_path=sentence_preset_path,
             shortcuts=self.shortcut_settings,
             schedule=self.session_schedule,
-            items=selected_sentences,
+            items=playlist,
             total=self.total_scheduled_sentences,
             autocopy_settings=self.autocopy_settings,
             themes_dir=self.theme_presets_dir,
@@ -2366,6 +1937,12 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
             "shortcuts": self.default_shortcuts,
             "keyword_method": "Method 1: Dictionary Presets",
             "dictionary_settings": {str(i): {"enabled": False, "path": ""} for i in range(10)},
+            "text_cache_settings": dict(DEFAULT_TEXT_CACHE_SETTINGS),
+            "extraction_jobs": 1,
+            "use_sentence_index": False,
+            "streaming_settings": dict(DEFAULT_STREAMING_SETTINGS),
+            "pdf_settings": dict(DEFAULT_PDF_SETTINGS),
+            "save_extraction_timings": False,
             "labels_color_dictionary": {"Default": "#00000000"},
             "preset_labels_dictionary": {},
             "sentence_names_cache": [],
@@ -2393,6 +1970,9 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
                                             "enabled": file_settings["dictionary_settings"][str(i)].get("enabled", False),
                                             "path": file_settings["dictionary_settings"][str(i)].get("path", "")
                                         }
+                            elif key in ["text_cache_settings", "streaming_settings", "pdf_settings"]:
+                                # Keep defaults for missing cache, streaming and PDF options
+                                current_settings[key] = dict(default_settings[key], **file_settings[key])
                             elif key in ["labels_color_dictionary", "preset_labels_dictionary"]:
                                 # Direct assignment for dictionaries
                                 current_settings[key] = file_settings[key]
@@ -2410,6 +1990,12 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
         self.current_theme = current_settings["theme_settings"]
         self.keyword_method = current_settings.get("keyword_method", "Method 1: Dictionary Presets")
         self.dictionary_settings = current_settings["dictionary_settings"]
+        self.text_cache_settings = current_settings["text_cache_settings"]
+        self.extraction_jobs = current_settings["extraction_jobs"]
+        self.use_sentence_index = current_settings["use_sentence_index"]
+        self.streaming_settings = current_settings["streaming_settings"]
+        self.pdf_settings = current_settings["pdf_settings"]
+        self.save_extraction_timings = current_settings["save_extraction_timings"]
         self.labels_color_dictionary = current_settings["labels_color_dictionary"]
         self.preset_labels_dictionary = current_settings["preset_labels_dictionary"]
 
@@ -2469,6 +2055,12 @@ class MainApp(QtWidgets.QMainWindow, Ui_MainWindow):
             "auto_start_settings": self.auto_start_settings,
             "autocopy_settings": self.autocopy_settings,
             "theme_settings": self.current_theme,
+            "text_cache_settings": self.text_cache_settings,
+            "extraction_jobs": self.extraction_jobs,
+            "use_sentence_index": self.use_sentence_index,
+            "streaming_settings": self.streaming_settings,
+            "pdf_settings": self.pdf_settings,
+            "save_extraction_timings": self.save_extraction_timings,
             "shortcuts": self.shortcut_settings,
             "labels_color_dictionary": self.labels_color_dictionary,
             "preset_labels_dictionary": self.preset_labels_dictionary,
@@ -2655,6 +2247,93 @@ class LabelColorDelegate(QStyledItemDelegate):
         super(LabelColorDelegate, self).paint(painter, option, index)
 
 
+class SessionRenderCache:
+    """
+    Render cache of a SessionDisplay. It holds the highlight spans of the theme colors, the key of the fonts and
+    stylesheets applied for the current theme and zoom, and the display HTML, clipboard HTML and plain text of
+    the last rendered sentences, keyed by their block number in the preset.
+    It also measures the latency between a navigation key and the paint of the next sentence.
+    """
+    HIGHLIGHT_PATTERN = re.compile(r'\{+(\w+?)\}+')
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.rendered = OrderedDict()  # Block number -> (display HTML, plain text, clipboard HTML)
+        self.colors_key = None
+        self.highlight_spans = {}  # Number of curly braces -> span format
+        self.default_highlight_span = None
+        self.text_style_key = None  # Fonts and stylesheets applied to the widgets
+        self.hits = 0
+        self.misses = 0
+        self.navigation_start = None
+        self.paints = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def set_colors(self, color_settings):
+        """Build the highlight spans of the colors, the rendered sentences are dropped when they changed."""
+        colors_key = tuple(sorted((key, value) for key, value in color_settings.items()
+                                  if key == "text_color" or key.startswith("highlight_color_")))
+        if colors_key == self.colors_key:
+            return
+        self.colors_key = colors_key
+        self.highlight_spans = {
+            int(key[len("highlight_color_"):]): f'<span style="color:{value}">{{}}</span>'
+            for key, value in colors_key if key.startswith("highlight_color_") and key[len("highlight_color_"):].isdigit()
+        }
+        self.default_highlight_span = self.highlight_spans.get(1)
+        self.rendered.clear()
+
+    def highlight(self, sentence):
+        """Wrap the keywords between curly braces in the span of their highlight color."""
+        def replace_with_color(match):
+            span = self.highlight_spans.get(match.group(0).count('{'), self.default_highlight_span)
+            return span.format(match.group(1)) if span else match.group(1)
+        return self.HIGHLIGHT_PATTERN.sub(replace_with_color, sentence)
+
+    def render(self, block_number, sentence, color_settings):
+        """Return the (display HTML, plain text, clipboard HTML) of a sentence, rendered once per block."""
+        rendered = self.rendered.get(block_number)
+        if rendered is not None:
+            self.hits += 1
+            self.rendered.move_to_end(block_number)
+            return rendered
+
+        self.misses += 1
+        highlighted = self.highlight(sentence)
+        text_color = color_settings.get('text_color', 'rgb(0, 255, 255)')
+        rendered = (
+            f'<span style="color:{text_color};">{highlighted}</span>',
+            self.HIGHLIGHT_PATTERN.sub(r'\1', sentence),
+            f'<span style="color:{text_color}">{highlighted}</span>'
+        )
+        self.rendered[block_number] = rendered
+        if len(self.rendered) > self.max_entries:
+            self.rendered.popitem(last=False)
+        return rendered
+
+    def clear(self):
+        self.rendered.clear()
+
+    def start_navigation(self):
+        self.navigation_start = time.perf_counter()
+
+    def record_paint(self):
+        """Count the latency since the last navigation key, called when the sentence is painted."""
+        if self.navigation_start is None:
+            return
+        latency = time.perf_counter() - self.navigation_start
+        self.navigation_start = None
+        self.paints += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def summary(self):
+        average = self.total_latency / self.paints * 1000 if self.paints else 0.0
+        return (f"Render cache: {self.hits} hits, {self.misses} misses. Key to paint: {self.paints} sentences, "
+                f"average {average:.1f} ms, max {self.max_latency * 1000:.1f} ms.")
+
+
 class SessionDisplay(QWidget, Ui_session_display):
     closed = QtCore.pyqtSignal() # Needed here for close event to work.
 
@@ -2684,6 +2363,8 @@ class SessionDisplay(QWidget, Ui_session_display):
 
 
         self.text_display.setWordWrap(True)  # Enable word wrapping for the QLabel
+        self.render_cache = SessionRenderCache()  # Rendered sentences, fonts and key to paint latency
+        self.text_display.installEventFilter(self)
         self.lineEdit.setMaxLength(self.text_display_settings["max_length_lineedit"])
 
 
@@ -2700,7 +2381,7 @@ class SessionDisplay(QWidget, Ui_session_display):
         self.schedule = schedule
         self.shortcuts = shortcuts
         self.file_path = file_path
-        self.playlist = items if items else []
+        self.playlist = items if items is not None else SessionPlaylist(file_path, [])  # SessionPlaylist, read lazily
         self.playlist_position = 0
 
         self.text_toggle = True
@@ -2788,7 +2469,9 @@ class SessionDisplay(QWidget, Ui_session_display):
 
 
     def eventFilter(self, source, event):
-        if source == self.lineEdit and event.type() == QtCore.QEvent.KeyPress:
+        if source is self.text_display and event.type() == QtCore.QEvent.Paint:
+            self.render_cache.record_paint()
+        elif source == self.lineEdit and event.type() == QtCore.QEvent.KeyPress:
             if event.key() == QtCore.Qt.Key_Backspace and event.modifiers() == QtCore.Qt.ShiftModifier:
                 self.load_prev_sentence()  # Navigate to the previous sentence
                 self.lineEdit.clear()  # Optionally clear the input field
@@ -2860,45 +2543,38 @@ class SessionDisplay(QWidget, Ui_session_display):
         :param sentence: The sentence to process.
         :param display: If True, highlights keywords; if False, returns the sentence without highlights.
         """
+        self.render_cache.set_colors(self.color_settings)
         if not display:
             # Remove highlight curly braces and return plain text
-            sentence = re.sub(r'\{+(\w+?)\}+', r'\1', sentence)  # Remove {...}, {{...}}, etc.
-            return sentence
-
-        # Apply overall text color to the sentence
-        sentence = rf'<span style="color:{self.color_settings["text_color"]};">{sentence}</span>'
-
-        # Replace curly brackets with corresponding highlight color
-        def replace_with_color(match):
-            """Determine the color based on the number of curly braces and return the highlighted span."""
-            # Count the number of opening braces
-            curly_count = match.group(0).count('{')
-
-            # Find the corresponding highlight color
-            color_key = f"highlight_color_{curly_count}"
-            color_style = self.color_settings.get(color_key, self.color_settings["highlight_color_1"])
+            return self.render_cache.HIGHLIGHT_PATTERN.sub(r'\1', sentence)  # Remove {...}, {{...}}, etc.
 
-            # Return the highlighted keyword wrapped in the appropriate color style
-            return rf'<span style="color:{color_style}">{match.group(1)}</span>'
+        # Apply overall text color to the sentence, and the highlight color of their curly braces to the keywords
+        return rf'<span style="color:{self.color_settings["text_color"]};">{self.render_cache.highlight(sentence)}</span>'
 
-        # Use regex to find keywords with different levels of curly brackets and replace them
-        sentence = re.sub(r'\{+(\w+?)\}+', replace_with_color, sentence)
+    def render_sentence(self, position):
+        """Return the (display HTML, plain text, clipboard HTML) of the sentence at position, from the render cache."""
+        current_sentence, _ = self.parse_sentence_entry(self.playlist[position])
+        self.render_cache.set_colors(self.color_settings)
+        return self.render_cache.render(self.playlist.block_number(position), current_sentence, self.color_settings)
 
-        return sentence
+    def prefetch_sentences(self):
+        """Read and render the next and previous sentences while the session waits for input."""
+        if sip.isdeleted(self):
+            return
+        for position in (self.playlist_position + 1, self.playlist_position - 1):
+            if 0 <= position < len(self.playlist):
+                try:
+                    self.render_sentence(position)
+                except Exception as e:
+                    print(f"Error prefetching sentence {position}: {e}")
 
 
 
     def copy_sentence(self, rich_text=True, metadata=False):
         """Copy the current sentence to the clipboard, with or without rich text."""
-        # Parse the current sentence entry
+        # Parse the current sentence entry, its HTML and plain text come from the render cache
         current_sentence, sentence_metadata = self.parse_sentence_entry(self.playlist[self.playlist_position])
-        
-        # Function to replace curly braces with appropriate highlighted spans
-        def replace_with_color(match):
-            curly_count = match.group(0).count('{')
-            color_key = f"highlight_color_{curly_count}"
-            color_style = self.color_settings.get(color_key, self.color_settings["highlight_color_1"])
-            return rf'<span style="color:{color_style}">{match.group(1)}</span>'
+        _, plain_text, highlighted_sentence = self.render_sentence(self.playlist_position)
         
         if metadata:
             metadata_text = f" - {sentence_metadata}" if sentence_metadata else ""
@@ -2906,10 +2582,6 @@ class SessionDisplay(QWidget, Ui_session_display):
             metadata_text = ""
         
         if rich_text:
-            text_color = self.color_settings.get('text_color', 'rgb(0, 255, 255)')
-            highlighted_sentence = re.sub(r'\{+(\w+?)\}+', replace_with_color, current_sentence)
-            highlighted_sentence = rf'<span style="color:{text_color}">{highlighted_sentence}</span>'
-            
             # Add metadata if enabled
             highlighted_sentence_with_metadata = f"{highlighted_sentence}{metadata_text}" if metadata else highlighted_sentence
             
@@ -2920,7 +2592,6 @@ class SessionDisplay(QWidget, Ui_session_display):
             mime_data = QtCore.QMimeData()
             mime_data.setData('text/html', highlighted_sentence_with_lines.encode('utf-8'))
             
-            plain_text = re.sub(r'\{+(\w+?)\}+', r'\1', current_sentence)
             plain_text_with_metadata = f"{plain_text}{metadata_text}" if metadata else plain_text
             
             # Add two empty lines to the plain text version
@@ -2930,8 +2601,7 @@ class SessionDisplay(QWidget, Ui_session_display):
             clipboard.setMimeData(mime_data)
             print(f"Copied Rich Text (HTML): {highlighted_sentence_with_lines}")
         else:
-            clipboard_text = re.sub(r'\{+(\w+?)\}+', r'\1', current_sentence)
-            clipboard_text_with_metadata = f"{clipboard_text}{metadata_text}" if metadata else clipboard_text
+            clipboard_text_with_metadata = f"{plain_text}{metadata_text}" if metadata else plain_text
             
             # Add two empty lines to the plain text
             clipboard_text_with_lines = f"{clipboard_text_with_metadata}\n\n\n"
@@ -2992,49 +2662,33 @@ class SessionDisplay(QWidget, Ui_session_display):
             self.playlist[self.playlist_position]
         )
 
-        # Format the search string with properly escaped quotes
-        search_string = f"\"\"\"{current_sentence}\"\"\""
+        def is_current_block(block):
+            return parse_preset_record(block)[0] == current_sentence
 
+        # Reach the block of the sentence through the preset index, it is searched for when the preset changed since
         try:
-            # Read the file content with proper encoding (utf-8 or other)
-            with open(self.file_path, 'r', encoding='utf-8') as file:
-                file_lines = file.readlines()
-        except UnicodeDecodeError:
-            # Handle the error if the file isn't encoded in utf-8
-            print("Error: Unable to read the file with UTF-8 encoding. Trying a different encoding...")
-            with open(self.file_path, 'r', encoding='cp1252') as file:
-                file_lines = file.readlines()
-
-        # Find and remove the exact line and the line beneath it (if empty)
-        line_found = None
-        updated_lines = []
-        skip_next_line = False
-        for line in file_lines:
-            if skip_next_line:
-                # Skip the next line if the previous one was removed and it is empty
-                if line.strip() == "":
-                    skip_next_line = False
-                    continue
-
-            if search_string in line:
-                line_found = line.strip()  # Capture the exact line
-                skip_next_line = True  # Flag to remove the next line if it is empty
-                continue  # Skip the current line containing the search string
-
-            updated_lines.append(line)
-
-        if not line_found:
-            print(search_string)
+            preset_index = PresetIndex(self.file_path)
+            block_number = self.playlist.block_number(self.playlist_position)
+            if block_number >= len(preset_index) or not is_current_block(preset_index.block(block_number)):
+                block_number = None
+            if block_number is None:
+                block_number = preset_index.find(is_current_block)
+        except OSError as e:
+            print(f"Error reading the preset: {str(e)}")
+            return
+
+        if block_number is None:
+            print(current_sentence)
             print("Matching sentence not found in file.")
             return
 
-        # Write updated lines back to the file
-        with open(self.file_path, 'w', encoding='utf-8') as file:
-            file.writelines(updated_lines)
+        line_found = preset_index.remove(block_number)
 
-        # Remove the current sentence from the playlist
-        self.playlist.pop(self.playlist_position)
+        # Remove the current sentence from the playlist, the following blocks of the preset moved down by one
+        self.playlist.preset_index = preset_index
+        self.playlist.remove(self.playlist_position, block_number)
         self.playlist_position -= 1
+        self.render_cache.clear()  # Rendered sentences are keyed by block numbers, which moved
 
         # Create a backup file with the removed line and metadata
         timestamp = time.strftime("%Y%m%d-%H%M%S")
@@ -3270,6 +2924,7 @@ class SessionDisplay(QWidget, Ui_session_display):
         Handles cleanup when the window is closed.
         """
         view.display = None
+        print(self.render_cache.summary())
         # Stop any active timers
         if hasattr(self, 'timer') and self.timer.isActive():
             self.timer.stop()
@@ -3298,6 +2953,20 @@ class SessionDisplay(QWidget, Ui_session_display):
 
 
     def apply_text_settings(self):
+        # Skip the fonts and stylesheets when the theme and zoom did not change since they were applied
+        text_style_key = (
+            self.text_display_settings["font_size"],
+            self.text_display_settings.get("font_family", "Arial"),
+            self.text_display_settings.get("font_weight", QtGui.QFont.Normal),
+            self.color_settings['metadata_font_size'],
+            self.color_settings['text_color'],
+            self.color_settings['metadata_background'],
+            self.color_settings['metadata_padding'],
+        )
+        if text_style_key == self.render_cache.text_style_key:
+            return
+        self.render_cache.text_style_key = text_style_key
+
         # Apply main text settings
         font = QtGui.QFont()
         font.setPointSize(self.text_display_settings["font_size"])
@@ -3326,11 +2995,8 @@ class SessionDisplay(QWidget, Ui_session_display):
             if isinstance(entry, list) and len(entry) == 2:
                 return entry[0], entry[1]
             elif isinstance(entry, str):
-                # Handle triple quotes by replacing them with single quotes
-                entry = entry.replace('"""', '"')
-                entry = eval(entry.strip())
-                if isinstance(entry, list) and len(entry) == 2:
-                    return entry[0], entry[1]
+                # JSON line, legacy block or plain sentence
+                return tuple(parse_preset_record(entry))
         except Exception as e:
             print(f"Error parsing entry: {entry}, Error: {e}")
         return str(entry).strip(), ""
@@ -3343,16 +3009,14 @@ class SessionDisplay(QWidget, Ui_session_display):
             self.display_end_screen()
             return
 
-        current_sentence, metadata = self.parse_sentence_entry(self.playlist[self.playlist_position])
+        _, metadata = self.parse_sentence_entry(self.playlist[self.playlist_position])
 
         self.session_info.setText(f'{self.playlist_position + 1}/{len(self.playlist)}')
         self.apply_text_settings()
 
-        if self.highlight_toggle:
-            displayed_sentence = self.highlight_keywords(current_sentence)
-        else:
-            displayed_sentence = self.highlight_keywords(current_sentence, display=False)
-        self.text_display.setText(displayed_sentence)
+        # The highlighted and plain sentence come from the render cache, filled ahead by prefetch_sentences
+        display_html, plain_text, _ = self.render_sentence(self.playlist_position)
+        self.text_display.setText(display_html if self.highlight_toggle else plain_text)
 
         if self.display_metadata:
             self.metadata_label.setText(metadata)
@@ -3364,6 +3028,9 @@ class SessionDisplay(QWidget, Ui_session_display):
             self.reset_timer()
         self.update_session_info()
 
+        # Render the neighbouring sentences once the current one is painted
+        QtCore.QTimer.singleShot(0, self.prefetch_sentences)
+
 
         
 
@@ -3456,11 +3123,13 @@ class SessionDisplay(QWidget, Ui_session_display):
         if dialog_color.exec_():
             # After saving colors, update the color settings in the parent class (now all handled by color_settings)
             self.color_settings = dialog_color.parent().color_settings  # Directly update color_settings
+            self.render_cache.text_style_key = None
             # Reapply the updated styles to the displayed sentence
             self.display_sentence()
 
         #view.init_styles(session_display=session_display)
         view.init_styles(session=view.display)
+        self.render_cache.text_style_key = None
         self.apply_text_settings()
 
 
@@ -3611,7 +3280,7 @@ class SessionDisplay(QWidget, Ui_session_display):
         Loads the next sentence in the playlist or displays an end screen if at the end.
         Resets the timer for a new sentence.
         """
- 
+        self.render_cache.start_navigation()
         
         # Check if we are at the last sentence
         if self.playlist_position < len(self.playlist) - 1:
@@ -3637,6 +3306,7 @@ class SessionDisplay(QWidget, Ui_session_display):
         """
         Loads the previous sentence in the playlist or does nothing if at the start.
         """
+        self.render_cache.start_navigation()
 
         # Check if we are at the first sentence
         if self.playlist_position > 0:
@@ -4153,6 +3823,34 @@ class MaxLengthDelegate(QStyledItemDelegate):
 
             # Subclass to enable multifolder selection.
 
+class PresetExtractionThread(QtCore.QThread):
+    """Runs ExtractionEngine.create_preset outside of the main thread and reports its progress."""
+    progress = QtCore.pyqtSignal(int, int, int, object, str, object)  # files done, files total, sentences, remaining seconds, file, pages
+    completed = QtCore.pyqtSignal(str)  # summary message
+    cancelled = QtCore.pyqtSignal()
+    failed = QtCore.pyqtSignal(str)
+
+    def __init__(self, engine, preset_settings, parent=None):
+        super().__init__(parent)
+        self.engine = engine
+        self.preset_settings = preset_settings
+
+    def run(self):
+        try:
+            summary_message = self.engine.create_preset(
+                **self.preset_settings,
+                progress_callback=self.progress.emit,
+                cancel_check=self.isInterruptionRequested
+            )
+        except ExtractionCancelled:
+            self.cancelled.emit()
+        except Exception as e:
+            print(f"Error creating preset: {str(e)}")
+            self.failed.emit(str(e))
+        else:
+            self.completed.emit(summary_message)
+
+
 class MultiFolderSelector(QtWidgets.QDialog):
     def __init__(self, parent=None, preset_name="", text_presets_dir=None):
         super(MultiFolderSelector, self).__init__(parent)
@@ -4160,7 +3858,7 @@ class MultiFolderSelector(QtWidgets.QDialog):
         
         self.setWindowTitle("Select Files")
 
-        self.setFixedSize(600, 780)  # This makes the window non-resizable
+        self.setFixedSize(600, 810)  # This makes the window non-resizable
 
         self.setWindowFlags(self.windowFlags() & ~QtCore.Qt.WindowContextHelpButtonHint)
 
@@ -4341,6 +4039,15 @@ class MultiFolderSelector(QtWidgets.QDialog):
         self.max_length_edit.setText("200")
         self.max_length_edit.setValidator(QtGui.QIntValidator(1, 10000, self))
         max_length_layout.addWidget(self.max_length_edit)
+
+        # Number of worker processes used for the extraction
+        self.jobs_label = QtWidgets.QLabel("Parallel Jobs:")
+        max_length_layout.addWidget(self.jobs_label)
+        self.jobs_spinbox = QtWidgets.QSpinBox()
+        self.jobs_spinbox.setRange(1, os.cpu_count() or 1)
+        self.jobs_spinbox.setValue(self.parent().extraction_jobs)
+        self.jobs_spinbox.setToolTip("Number of files processed at the same time, 1 processes the files one by one")
+        max_length_layout.addWidget(self.jobs_spinbox)
         self.layout.addLayout(max_length_layout)
 
         # Checkboxes
@@ -4352,6 +4059,22 @@ class MultiFolderSelector(QtWidgets.QDialog):
         self.extract_metadata_checkbox.setChecked(True)
         self.layout.addWidget(self.extract_metadata_checkbox)
 
+        # Text cache
+        text_cache_layout = QtWidgets.QHBoxLayout()
+        self.text_cache_checkbox = QtWidgets.QCheckBox("Use Text Cache")
+        self.text_cache_checkbox.setChecked(self.parent().text_cache_settings.get("enabled", True))
+        text_cache_layout.addWidget(self.text_cache_checkbox)
+        self.sentence_index_checkbox = QtWidgets.QCheckBox("Use Sentence Index")
+        self.sentence_index_checkbox.setChecked(self.parent().use_sentence_index)
+        self.sentence_index_checkbox.setToolTip("Index the selected files once and look up the keywords in the index")
+        text_cache_layout.addWidget(self.sentence_index_checkbox)
+        text_cache_layout.addStretch()
+        self.clear_cache_button = QtWidgets.QPushButton("Clear Cache")
+        self.clear_cache_button.clicked.connect(self.clear_text_cache)
+        text_cache_layout.addWidget(self.clear_cache_button)
+        self.layout.addLayout(text_cache_layout)
+        self.update_text_cache_info()
+
         # Output options
         self.output_option_dropdown = QtWidgets.QComboBox()
         self.output_option_dropdown.addItems(["Single output", "All output"])
@@ -4436,9 +4159,19 @@ class MultiFolderSelector(QtWidgets.QDialog):
                     'path': path if path.strip() else ""  # Ensure empty string for cleared paths
                 }
 
+        # Update the text cache toggle, shared with the main window
+        text_cache_settings = dict(self.parent().text_cache_settings)
+        text_cache_settings["enabled"] = self.text_cache_checkbox.isChecked()
+        self.parent().text_cache_settings = text_cache_settings
+        self.parent().extraction_jobs = self.jobs_spinbox.value()
+        self.parent().use_sentence_index = self.sentence_index_checkbox.isChecked()
+
         current_settings.update({
             "keyword_method": self.current_method,
-            "dictionary_settings": dictionary_settings
+            "dictionary_settings": dictionary_settings,
+            "text_cache_settings": text_cache_settings,
+            "extraction_jobs": self.jobs_spinbox.value(),
+            "use_sentence_index": self.sentence_index_checkbox.isChecked()
         })
         
         # Save back to file
@@ -4478,6 +4211,18 @@ class MultiFolderSelector(QtWidgets.QDialog):
 
             #print("LOADING :",settings)
 
+    def update_text_cache_info(self):
+        """Show the current content of the text cache as tooltip"""
+        info = self.parent().get_extraction_engine().get_text_cache().info()
+        self.text_cache_checkbox.setToolTip(f"Reuse the text extracted from unchanged files.\n{info}")
+        self.clear_cache_button.setToolTip(info)
+
+    def clear_text_cache(self):
+        """Delete the cached text of every source file"""
+        info = self.parent().get_extraction_engine().manage_text_cache(clear=True)
+        self.update_text_cache_info()
+        self.parent().show_info_message('Text Cache', info)
+
     def change_keyword_method(self, index):
         """Switch between keyword methods"""
         self.current_method = self.keyword_methods[index]
@@ -4982,8 +4727,18 @@ class ThemeSelectorDialog(QtWidgets.QDialog):
 
 
 
+def get_presets_dir():
+    """Return the writing_presets directory next to the executable, or next to the script."""
+    if getattr(sys, 'frozen', False):
+        base_dir = os.path.dirname(sys.executable)
+    else:
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(base_dir, 'writing_presets')
+
+
 if __name__ == "__main__":
-    
+    # Needed by the extraction worker processes in the frozen executable
+    multiprocessing.freeze_support()
 
     parser = argparse.ArgumentParser(description="Sentence Queuer Tool")
     subparsers = parser.add_subparsers(dest="command")
@@ -4998,6 +4753,42 @@ if __name__ == "__main__":
     create_preset_parser.add_argument("-get_metadata", type=lambda x: x.lower() == "true", default=True, help="Extract metadata (True/False)")
     create_preset_parser.add_argument("-max_length", type=int, default=200, help="Maximum sentence length")
     create_preset_parser.add_argument("-output_folder", help="Folder to save the preset file. Defaults to text_presets_dir if not provided.")
+    create_preset_parser.add_argument("-jobs", type=int, default=None, help="Number of files processed in parallel. Defaults to the session settings.")
+    create_preset_parser.add_argument("-use_cache", type=lambda x: x.lower() == "true", default=None, help="Use the extracted text cache (True/False). Defaults to the session settings.")
+
+    create_preset_parser.add_argument("-use_index", type=lambda x: x.lower() == "true", default=None, help="Use the sentence index (True/False). Defaults to the session settings.")
+    create_preset_parser.add_argument("-streaming", type=lambda x: x.lower() == "true", default=None, help="Keep the extracted sentences on disk instead of memory (True/False). Defaults to the session settings.")
+    create_preset_parser.add_argument("-timings", type=lambda x: x.lower() == "true", default=None, help="Write the time spent in each stage next to the preset (True/False). Defaults to the session settings.")
+
+    # Subparser for "sentence_index"
+    sentence_index_parser = subparsers.add_parser("sentence_index", help="Build, query or clear the sentence index")
+    sentence_index_parser.add_argument("-add_files", nargs="+", help="List of file paths to index, unchanged files are skipped")
+    sentence_index_parser.add_argument("-query", nargs="+", help="Keywords to look up in the index")
+    sentence_index_parser.add_argument("-clear", action="store_true", help="Delete every indexed file")
+
+    # Subparser for "text_cache"
+    text_cache_parser = subparsers.add_parser("text_cache", help="Inspect or clear the extracted text cache")
+    text_cache_parser.add_argument("-clear", action="store_true", help="Delete every cached file")
+
+    # Subparser for "pdf_backend"
+    pdf_backend_parser = subparsers.add_parser("pdf_backend", help="List, benchmark or set the PDF extraction backend")
+    pdf_backend_parser.add_argument("-benchmark", nargs="+", help="List of PDF files to benchmark the backends on, the fastest one becomes the default")
+    pdf_backend_parser.add_argument("-set", dest="set_backend", help="Name of the backend to use by default")
+
+    # Subparser for "migrate_presets"
+    migrate_presets_parser = subparsers.add_parser("migrate_presets", help="Convert the legacy presets of a folder to JSON Lines")
+    migrate_presets_parser.add_argument("-folder", help="Folder of the presets to convert. Defaults to text_presets_dir if not provided.")
+    migrate_presets_parser.add_argument("-jobs", type=int, default=None, help="Number of presets converted in parallel. Defaults to the session settings.")
+
+    # Subparser for "benchmark"
+    benchmark_parser = subparsers.add_parser("benchmark", help="Benchmark the extraction on a generated corpus")
+    benchmark_parser.add_argument("-sizes", nargs="+", default=["small", "medium"], choices=["small", "medium", "large"], help="Sizes of the generated corpora")
+    benchmark_parser.add_argument("-dictionary_sizes", nargs="+", type=int, default=[10, 100, 1000, 10000, 100000], help="Numbers of keywords of the generated dictionaries")
+    benchmark_parser.add_argument("-cases", nargs="+", choices=["pipeline", "load", "segment", "normalize", "compile", "match", "filter", "highlight"], help="Only run these cases")
+    benchmark_parser.add_argument("-repeat", type=int, default=3, help="Runs of each case, the fastest is kept")
+    benchmark_parser.add_argument("-output_folder", help="Folder to keep the corpus and the results in. A temporary folder is used if not provided.")
+    benchmark_parser.add_argument("-baseline", help="Baseline results file. Defaults to benchmark_baseline.json in the presets folder.")
+    benchmark_parser.add_argument("-save_baseline", action="store_true", help="Save the results as the new baseline")
 
     # Subparser for "start_session_from_files"
     session_parser = subparsers.add_parser("start_session_from_files", help="Start session from files")
@@ -5011,10 +4802,10 @@ if __name__ == "__main__":
     # Parse arguments
     args = parser.parse_args()
 
+    # The extraction commands run headless, without creating the application or any window
     if args.command == "create_preset":
-        app = QtWidgets.QApplication(sys.argv)
-        view = MainApp(show_main_window=False)
-        view.create_preset(
+        engine = ExtractionEngine.from_session_settings(get_presets_dir())
+        engine.create_preset(
             selected_files=args.selected_files,
             keyword_profiles=args.keyword_profiles,
             preset_name=args.preset_name,
@@ -5023,9 +4814,40 @@ if __name__ == "__main__":
             max_length=args.max_length,
             metadata_settings=args.get_metadata,
             output_folder=args.output_folder,
-            is_gui=False
+            use_text_cache=args.use_cache,
+            jobs=args.jobs,
+            use_sentence_index=args.use_index,
+            streaming=args.streaming,
+            save_timings=args.timings
+        )
+
+    elif args.command == "sentence_index":
+        engine = ExtractionEngine.from_session_settings(get_presets_dir())
+        engine.manage_sentence_index(add_files=args.add_files, query=args.query, clear=args.clear)
+
+    elif args.command == "text_cache":
+        engine = ExtractionEngine.from_session_settings(get_presets_dir())
+        engine.manage_text_cache(clear=args.clear)
+
+    elif args.command == "pdf_backend":
+        engine = ExtractionEngine.from_session_settings(get_presets_dir())
+        engine.manage_pdf_backends(benchmark=args.benchmark, set_backend=args.set_backend)
+
+    elif args.command == "migrate_presets":
+        engine = ExtractionEngine.from_session_settings(get_presets_dir())
+        engine.migrate_presets(folder=args.folder, jobs=args.jobs)
+
+    elif args.command == "benchmark":
+        from benchmark import run_benchmarks  # Only loaded by this command, not on every start
+        run_benchmarks(
+            output_folder=args.output_folder,
+            sizes=args.sizes,
+            dictionary_sizes=args.dictionary_sizes,
+            repeat=args.repeat,
+            baseline_path=args.baseline or os.path.join(get_presets_dir(), 'benchmark_baseline.json'),
+            save_baseline=args.save_baseline,
+            kinds=args.cases
         )
-        app.quit()
 
     elif args.command == "start_session_from_files":
         app = QtWidgets.QApplication(sys.argv)
@@ -0,0 +1,427 @@
+"""
+Extraction benchmarks of Inktyping.
+
+Generates deterministic synthetic corpora (.txt, .epub and .pdf files at several sizes) with keyword
+dictionaries of 10 to 100k entries, then times the whole process_text_files pipeline and each of its
+stages in isolation: loading, sentence splitting, normalization, keyword compilation, matching,
+ignored keywords filtering and highlighting. Every case runs in its own process, its peak memory being
+the memory allocated by its timed part. Nothing needs a network connection or a display.
+"""
+import os
+import json
+import time
+import random
+import shutil
+import zipfile
+import tempfile
+import tracemalloc
+import multiprocessing
+from xml.sax.saxutils import escape
+
+from text_engine import (
+    ExtractionEngine, ExtractionStats, KeywordMatcher, SentenceSplitter, TextNormalizer, read_file_text
+)
+
+
+CORPUS_SIZES = {"small": 2000, "medium": 20000, "large": 200000}  # Sentences of each corpus
+DICTIONARY_SIZES = [10, 100, 1000, 10000, 100000]
+LEXICON_SIZE = 120000  # Generated words, the dictionaries are taken from them
+PIPELINE_DICTIONARY_SIZE = 1000
+REGRESSION_TOLERANCE = 0.1  # Share of the baseline speed lost before a case is reported as slower
+
+COMMON_WORDS = (
+    "the of and to in a is that for it as was with be by on not he I this are or his from at which but have an "
+    "they you were her she there one been all we their has would when if so no what up out about who them into "
+    "time could house said people over little only man then years very down day new way just like through back "
+    "where much before good must even after still city world child children water under place again long night"
+).split()
+SYLLABLE_START = "b c d f g h k l m n p r s t v w z br ch cl dr fl gr pl sh st th tr".split()
+SYLLABLE_VOWEL = "a e i o u ai ea ee oo ou".split()
+SYLLABLE_END = ["", "", "", "n", "r", "s", "l", "t", "m", "ck", "nd", "st"]
+# Broken characters of the source files, replaced by the normalization
+BROKEN_CHARACTERS = ["’", "“", "”", "—", "â€™", "â€œ", "…"]
+
+
+class SyntheticCorpus:
+    """
+    Deterministic generator of sentences and keyword dictionaries, the same seed always gives the same files.
+    The words of the sentences follow a Zipf distribution over the common words and a generated lexicon.
+    """
+
+    def __init__(self, seed=1):
+        self.seed = seed
+        random_generator = random.Random(seed)
+        lexicon = set()
+        while len(lexicon) < LEXICON_SIZE:
+            syllables = random_generator.randint(2, 4)
+            lexicon.add("".join(
+                random_generator.choice(SYLLABLE_START) + random_generator.choice(SYLLABLE_VOWEL)
+                for _ in range(syllables)
+            ) + random_generator.choice(SYLLABLE_END))
+        self.lexicon = sorted(lexicon)
+        random_generator.shuffle(self.lexicon)
+        self.words = COMMON_WORDS + self.lexicon
+        weights = [1 / (rank + 1) for rank in range(len(self.words))]
+        self.cumulative_weights = []
+        total = 0
+        for weight in weights:
+            total += weight
+            self.cumulative_weights.append(total)
+
+    def sentences(self, count, broken_characters=True):
+        """Return count sentences, with some broken characters to normalize unless broken_characters is False."""
+        random_generator = random.Random(self.seed * 1000003 + count)
+        sentences = []
+        for _ in range(count):
+            length = random_generator.randint(4, 24)
+            words = random_generator.choices(self.words, cum_weights=self.cumulative_weights, k=length)
+            if broken_characters and random_generator.random() < 0.1:
+                words.insert(random_generator.randrange(length), random_generator.choice(BROKEN_CHARACTERS))
+            sentence = " ".join(words)
+            sentences.append(sentence[0].upper() + sentence[1:] + random_generator.choice(".....?!"))
+        return sentences
+
+    def paragraphs(self, sentences, sentences_per_paragraph=8):
+        return [" ".join(sentences[i:i + sentences_per_paragraph])
+                for i in range(0, len(sentences), sentences_per_paragraph)]
+
+    def dictionary(self, size):
+        """
+        Return size keywords spread over the ranks of the lexicon, every 50th one combined with
+        the next word ("a + b") and every 20th one an exact form ("&a").
+        """
+        step = max(len(self.lexicon) // size, 1)
+        keywords = []
+        for i in range(size):
+            word = self.lexicon[(i * step) % len(self.lexicon)]
+            if i % 50 == 49:
+                keywords.append(f"{word} + {self.lexicon[(i * step + 1) % len(self.lexicon)]}")
+            elif i % 20 == 19:
+                keywords.append(f"&{word}")
+            else:
+                keywords.append(word)
+        return keywords
+
+    def ignored_dictionary(self, size=10):
+        """Return size frequent words of the lexicon, the sentences containing them are ignored."""
+        return self.lexicon[:size * 7:7]
+
+    def write_txt(self, path, sentences):
+        with open(path, 'w', encoding='utf-8') as f:
+            for paragraph in self.paragraphs(sentences):
+                f.write(paragraph + "\n\n")
+
+    @staticmethod
+    def zip_entry(name, compress_type=zipfile.ZIP_DEFLATED):
+        # A fixed date, the same archive is written every time
+        entry = zipfile.ZipInfo(name, date_time=(2020, 1, 1, 0, 0, 0))
+        entry.compress_type = compress_type
+        return entry
+
+    def write_epub(self, path, sentences, chapter_size=400):
+        """Write an EPUB 3 of the sentences, chapter_size sentences per chapter."""
+        chapters = [sentences[i:i + chapter_size] for i in range(0, len(sentences), chapter_size)]
+        manifest = []
+        spine = []
+        with zipfile.ZipFile(path, 'w') as archive:
+            archive.writestr(self.zip_entry("mimetype", zipfile.ZIP_STORED), "application/epub+zip")
+            archive.writestr(self.zip_entry("META-INF/container.xml"), (
+                '<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                '</rootfiles></container>'
+            ))
+            for index, chapter in enumerate(chapters):
+                name = f"chapter_{index}.xhtml"
+                body = "".join(f"<p>{escape(paragraph)}</p>\n" for paragraph in self.paragraphs(chapter))
+                archive.writestr(self.zip_entry(f"OEBPS/{name}"), (
+                    '<?xml version="1.0" encoding="utf-8"?>\n'
+                    '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Chapter</title></head>'
+                    f'<body><h1>Chapter {index + 1}</h1>\n{body}</body></html>'
+                ))
+                manifest.append(f'<item id="c{index}" href="{name}" media-type="application/xhtml+xml"/>')
+                spine.append(f'<itemref idref="c{index}"/>')
+            archive.writestr(self.zip_entry("OEBPS/content.opf"), (
+                '<?xml version="1.0" encoding="utf-8"?>\n'
+                '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">'
+                '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                f'<dc:identifier id="id">synthetic-{self.seed}-{len(sentences)}</dc:identifier>'
+                '<dc:title>Synthetic Book</dc:title><dc:creator>Inktyping Benchmark</dc:creator>'
+                '<dc:date>2020-01-01</dc:date><dc:language>en</dc:language></metadata>'
+                f'<manifest>{"".join(manifest)}</manifest><spine>{"".join(spine)}</spine></package>'
+            ))
+
+    def write_pdf(self, path, sentences, lines_per_page=60, line_length=95):
+        """Write a PDF of the sentences with the standard Helvetica font, so their text must be Latin-1."""
+        text = " ".join(sentences)
+        lines = []
+        while text:
+            cut = text.rfind(" ", 0, line_length) if len(text) > line_length else len(text)
+            cut = cut if cut > 0 else line_length
+            lines.append(text[:cut])
+            text = text[cut:].lstrip()
+        pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+
+        objects = [None, None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]  # Catalog, pages, font
+        page_ids = []
+        for page_lines in pages:
+            stream = b"BT /F1 9 Tf 12 TL 40 800 Td " + b" ".join(
+                b"(" + line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)").encode('latin-1') + b") '"
+                for line in page_lines
+            ) + b" ET"
+            objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+            objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+                           b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (len(objects)))
+            page_ids.append(len(objects))
+        objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+        objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+            b" ".join(b"%d 0 R" % page_id for page_id in page_ids), len(page_ids))
+        objects.append(b"<< /Title (Synthetic Book) /Author (Inktyping Benchmark) /CreationDate (D:20200101000000) >>")
+
+        with open(path, 'wb') as f:
+            f.write(b"%PDF-1.4\n")
+            offsets = []
+            for number, content in enumerate(objects, 1):
+                offsets.append(f.tell())
+                f.write(b"%d 0 obj\n%s\nendobj\n" % (number, content))
+            xref_offset = f.tell()
+            f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+            f.write(b"".join(b"%010d 00000 n \n" % offset for offset in offsets))
+            f.write(b"trailer\n<< /Size %d /Root 1 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+                len(objects) + 1, len(objects), xref_offset))
+
+    def write_files(self, folder, sizes=("small", "medium"), dictionary_sizes=DICTIONARY_SIZES):
+        """
+        Write the .txt, .epub and .pdf files of every corpus size and the dictionary files to folder,
+        files already written with the same seed are kept. Returns {"corpora": {size: {extension: path}},
+        "dictionaries": {size: path}, "ignored": path}.
+        """
+        folder = os.path.join(folder, f"corpus_{self.seed}")
+        os.makedirs(folder, exist_ok=True)
+        files = {"corpora": {}, "dictionaries": {}}
+        for size in sizes:
+            sentence_count = CORPUS_SIZES[size]
+            paths = {extension: os.path.join(folder, f"{size}.{extension}") for extension in ("txt", "epub", "pdf")}
+            if not all(os.path.exists(path) for path in paths.values()):
+                self.write_txt(paths["txt"], self.sentences(sentence_count))
+                self.write_epub(paths["epub"], self.sentences(sentence_count))
+                self.write_pdf(paths["pdf"], self.sentences(sentence_count, broken_characters=False))
+            files["corpora"][size] = paths
+
+        for size in sorted(set(dictionary_sizes) | {PIPELINE_DICTIONARY_SIZE}):
+            path = os.path.join(folder, f"dictionary_{size}.txt")
+            if not os.path.exists(path):
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write("\n".join(self.dictionary(size)) + "\n")
+            files["dictionaries"][size] = path
+
+        files["ignored"] = os.path.join(folder, "dictionary_ignored.txt")
+        with open(files["ignored"], 'w', encoding='utf-8') as f:
+            f.write("\n".join(self.ignored_dictionary()) + "\n")
+        return files
+
+
+def read_dictionary(path):
+    """Return the keywords of a dictionary file, one per line, the lines starting with ; being comments."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith(';')]
+
+
+def keyword_forms(engine, keywords):
+    return [(keyword,) + tuple(engine.get_keyword_forms(keyword)) for keyword in keywords]
+
+
+def split_text(text, piece_size=1024 * 1024):
+    splitter = SentenceSplitter()
+    sentences = []
+    for start in range(0, len(text), piece_size):
+        sentences.extend(splitter.feed(text[start:start + piece_size]))
+    sentences.extend(splitter.close())
+    return sentences
+
+
+def run_case(case, files, presets_dir, repeat):
+    """
+    Run a benchmark case in the current process, the fastest of repeat runs is kept.
+    Returns {"count": int, "seconds": float, "peak_mb": float}, count being the number of sentences
+    processed, or of keywords compiled, and peak_mb the peak of the memory allocated by the timed part,
+    the prepared corpus and dictionaries left out.
+    """
+    kind, size, option = case
+    engine = ExtractionEngine(presets_dir)
+    normalizer = TextNormalizer()
+    corpus = files["corpora"][size]
+
+    # Everything the timed part needs is prepared first
+    if kind == "pipeline":
+        keywords = read_dictionary(files["dictionaries"][option])
+        ignored = read_dictionary(files["ignored"])
+        engine.plural  # The inflect import isn't part of the pipeline
+    elif kind != "load":
+        sentences = normalizer.normalize_batch(split_text(read_file_text(corpus["txt"])))
+        if kind in ("compile", "match", "highlight"):
+            keywords = read_dictionary(files["dictionaries"][option])
+            engine.plural
+        if kind == "compile":
+            engine.keyword_registry.prepare(keywords)  # The forms are saved in the keyword forms cache
+        if kind == "segment":
+            text = read_file_text(corpus["txt"])
+        elif kind == "match":
+            matcher = KeywordMatcher(keyword_forms(engine, keywords))
+        elif kind == "filter":
+            matcher = KeywordMatcher(keyword_forms(engine, read_dictionary(files["ignored"])), exact_boundaries=True)
+        elif kind == "highlight":
+            highlighter = engine.build_highlighter({"Highlight color 1": keywords})
+
+    def run_once():
+        """Run the timed part of the case once, returns the count."""
+        if kind == "pipeline":
+            stats = ExtractionStats()
+            profiles = {"Ignored keywords": list(ignored), "Highlight color 1": list(keywords)}
+            sentence_store = engine.process_text_files(list(corpus.values()), profiles, highlight_keywords=True,
+                                                       max_length=200, metadata_settings=True, stats=stats)
+            sentence_store.close()
+            return stats.sentences_scanned
+        elif kind == "load":
+            return len(split_text(read_file_text(corpus[option])))
+        elif kind == "segment":
+            return len(split_text(text))
+        elif kind == "normalize":
+            return len(normalizer.normalize_batch(sentences))
+        elif kind == "compile":
+            # A new engine, as for each preset, loads the forms from the keyword forms cache
+            compile_engine = ExtractionEngine(presets_dir)
+            compile_engine.keyword_registry.prepare(keywords)
+            KeywordMatcher(keyword_forms(compile_engine, keywords))
+            return len(keywords)
+        elif kind == "match":
+            for sentence in sentences:
+                matcher.match(sentence)
+            return len(sentences)
+        elif kind == "filter":
+            for sentence in sentences:
+                matcher.search(sentence)
+            return len(sentences)
+        elif kind == "highlight":
+            for sentence in sentences:
+                highlighter.highlight(sentence)
+            return len(sentences)
+
+    best = None
+    count = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = run_once()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    # The memory is traced on one more run, tracemalloc slowing down the timed ones
+    tracemalloc.start()
+    try:
+        run_once()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {"count": count, "seconds": best, "peak_mb": peak / (1024 * 1024)}
+
+
+def case_name(case):
+    kind, size, option = case
+    return f"{kind}:{size}" + (f":{option}" if option is not None else "")
+
+
+def benchmark_cases(sizes, dictionary_sizes):
+    """
+    Return the (kind, corpus size, option) of every case: the pipeline with the default dictionary,
+    the loading of each file type, and each stage with every dictionary size where it depends on it.
+    The keyword compilation is measured on the largest corpus only, it doesn't depend on the text.
+    """
+    cases = []
+    for size in sizes:
+        cases.append(("pipeline", size, PIPELINE_DICTIONARY_SIZE))
+        cases.extend(("load", size, extension) for extension in ("txt", "epub", "pdf"))
+        cases.append(("segment", size, None))
+        cases.append(("normalize", size, None))
+        cases.extend(("match", size, dictionary_size) for dictionary_size in dictionary_sizes)
+        cases.append(("filter", size, None))
+        cases.append(("highlight", size, PIPELINE_DICTIONARY_SIZE))
+    cases.extend(("compile", sizes[-1], dictionary_size) for dictionary_size in dictionary_sizes)
+    return cases
+
+
+def compare_to_baseline(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """Add the speed relative to the baseline to each result, and whether it is slower than the tolerance."""
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if not reference or not reference.get("per_second"):
+            continue
+        ratio = result["per_second"] / reference["per_second"]
+        result["baseline_ratio"] = round(ratio, 3)
+        result["regression"] = ratio < 1 - tolerance
+
+
+def format_results(results):
+    lines = [f"{'Case':<28}{'Count':>11}{'Seconds':>10}{'Per second':>14}{'Peak MB':>9}{'Baseline':>10}"]
+    for name, result in results.items():
+        peak = f"{result['peak_mb']:.1f}" if result.get("peak_mb") is not None else "-"
+        ratio = f"{result['baseline_ratio']:.2f}x" if "baseline_ratio" in result else "-"
+        if result.get("regression"):
+            ratio += " !"
+        lines.append(f"{name:<28}{result['count']:>11}{result['seconds']:>10.3f}"
+                     f"{result['per_second']:>14.0f}{peak:>9}{ratio:>10}")
+    return "\n".join(lines)
+
+
+def run_benchmarks(output_folder=None, sizes=("small", "medium"), dictionary_sizes=DICTIONARY_SIZES, repeat=3,
+                   baseline_path=None, save_baseline=False, seed=1, kinds=None):
+    """
+    Generate the corpus in output_folder (a temporary folder deleted afterwards if None), run every case
+    in its own process and print the results, compared to the baseline file when it exists.
+    With save_baseline the results become the new baseline. Returns {case name: result}.
+    kinds restricts the cases to some kinds ("pipeline", "load", "segment", "normalize", "compile",
+    "match", "filter", "highlight").
+    """
+    sizes = sorted(sizes, key=list(CORPUS_SIZES).index)
+    temporary = output_folder is None
+    output_folder = output_folder or tempfile.mkdtemp(prefix='inktyping_benchmark_')
+    try:
+        print(f"Generating the corpus in {output_folder}...")
+        files = SyntheticCorpus(seed).write_files(output_folder, sizes, dictionary_sizes)
+        presets_dir = os.path.join(output_folder, 'writing_presets')
+
+        # A fresh process per case, so a case doesn't reuse what the previous ones loaded
+        context = multiprocessing.get_context('spawn')
+        results = {}
+        for case in benchmark_cases(sizes, dictionary_sizes):
+            if kinds and case[0] not in kinds:
+                continue
+            with context.Pool(1) as pool:
+                result = pool.apply(run_case, (case, files, presets_dir, repeat))
+            result["per_second"] = result["count"] / max(result["seconds"], 1e-9)
+            results[case_name(case)] = result
+            print(f"{case_name(case)}: {result['per_second']:.0f} per second")
+
+        baseline = {}
+        if baseline_path and os.path.exists(baseline_path):
+            with open(baseline_path, 'r', encoding='utf-8') as f:
+                baseline = json.load(f).get("results", {})
+            compare_to_baseline(results, baseline)
+        print(format_results(results))
+        regressions = [name for name, result in results.items() if result.get("regression")]
+        if regressions:
+            print(f"Slower than the baseline: {', '.join(regressions)}")
+
+        report = {"created": time.strftime("%Y-%m-%d %H:%M:%S"), "seed": seed, "repeat": repeat, "results": results}
+        if not temporary:
+            with open(os.path.join(output_folder, 'benchmark_results.json'), 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=4)
+        if save_baseline and baseline_path:
+            os.makedirs(os.path.dirname(os.path.abspath(baseline_path)), exist_ok=True)
+            with open(baseline_path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=4)
+            print(f"Baseline saved to {baseline_path}")
+        return results
+    finally:
+        if temporary:
+            shutil.rmtree(output_folder, ignore_errors=True)
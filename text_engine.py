@@ -0,0 +1,3428 @@
+"""
+Text extraction engine of Inktyping.
+
+Loads the source files (.txt, .epub, .pdf), splits them into sentences, matches them against
+the keyword profiles and writes the text presets. Nothing in here depends on PyQt, so the
+per-file extraction can run in worker processes and the command line runs without any window.
+The sentences can also be served from a persistent inverted index.
+"""
+import os
+import re
+import ast
+import random
+import mmap
+import json
+import gzip
+import hashlib
+import time
+import sqlite3
+import codecs
+import struct
+import shutil
+import tempfile
+import unicodedata
+import zipfile
+import posixpath
+import subprocess
+import importlib.util
+import multiprocessing
+from array import array
+from collections import Counter, OrderedDict, deque
+from html.parser import HTMLParser
+from urllib.parse import unquote
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+from lxml import etree, html as lxml_html
+from bs4.builder import HTMLTreeBuilder
+from bs4.dammit import EntitySubstitution, UnicodeDammit
+import PyPDF2
+
+
+SUPPORTED_EXTENSIONS = ('.pdf', '.txt', '.epub')
+
+DEFAULT_TEXT_CACHE_SETTINGS = {"enabled": True, "max_size_mb": 1024, "use_content_hash": False}
+DEFAULT_STREAMING_SETTINGS = {"enabled": False, "memory_budget_mb": 256}
+DEFAULT_PDF_SETTINGS = {"backend": "PyPDF2", "pages_per_batch": 20, "page_timeout": 0}
+
+# Sentences end with a whitespace after "." or "?", except after initials and abbreviations (e.g. "Mr.")
+LINEBREAK_PATTERN = re.compile(r'(\n\s*)+')
+SENTENCE_SPLIT_PATTERN = re.compile(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?)\s')
+
+
+class KeywordMatcher:
+    """
+    Matches a list of keywords against sentences in a single scan.
+    Single word forms are stored in a lookup table and checked against each word of the sentence,
+    forms spanning several words or containing punctuation fall back to a precompiled pattern.
+    """
+    WORD_PATTERN = re.compile(r'\w+')
+    SINGLE_WORD_PATTERN = re.compile(r'\w+$')
+
+    def __init__(self, keyword_forms, exact_boundaries=False):
+        """
+        keyword_forms is a list of (keyword, forms_list, exact_matches) as returned by get_keyword_forms.
+        With exact_boundaries, the exact (&) forms that are not a single word must not touch any other
+        word character instead of matching on word boundaries.
+        """
+        self.keywords = []
+        self.group_counts = []
+        self.group_tokens = []  # per keyword, per group, the lowercased words of each form
+        self.word_forms = {}  # lowercased form -> [(keyword index, group index, form index), ...]
+        self.phrase_forms = []  # (compiled pattern, keyword index, group index, form index)
+
+        for keyword_index, (keyword, forms_list, exact_matches) in enumerate(keyword_forms):
+            self.keywords.append(keyword)
+            self.group_counts.append(len(forms_list))
+            self.group_tokens.append([
+                [tuple(self.WORD_PATTERN.findall(form.lower())) for form in forms if form] for forms in forms_list
+            ])
+            for group_index, forms in enumerate(forms_list):
+                for form_index, form in enumerate(forms):
+                    if not form:
+                        continue
+                    entry = (keyword_index, group_index, form_index)
+                    if self.SINGLE_WORD_PATTERN.match(form):
+                        self.word_forms.setdefault(form.lower(), []).append(entry)
+                    else:
+                        if exact_boundaries and exact_matches[group_index]:
+                            pattern = r'(?<!\w){}(?!\w)'
+                        else:
+                            pattern = r'\b{}\b'
+                        pattern = re.compile(pattern.format(re.escape(form)), re.IGNORECASE)
+                        self.phrase_forms.append((pattern,) + entry)
+
+    def find_hits(self, sentence):
+        """
+        Return every form found in the sentence as (keyword index, group index, form index, start, end).
+        """
+        hits = []
+        word_forms = self.word_forms
+        for word in self.WORD_PATTERN.finditer(sentence):
+            entries = word_forms.get(word.group(0).lower())
+            if entries:
+                start, end = word.span()
+                for keyword_index, group_index, form_index in entries:
+                    hits.append((keyword_index, group_index, form_index, start, end))
+
+        for pattern, keyword_index, group_index, form_index in self.phrase_forms:
+            for match in pattern.finditer(sentence):
+                hits.append((keyword_index, group_index, form_index, match.start(), match.end()))
+
+        return hits
+
+    def active_keywords(self, vocabulary):
+        """
+        Return the keywords that may be found in a document whose lowercased words are the vocabulary set:
+        every part of the keyword needs a form with all its words in the vocabulary.
+        """
+        return {
+            keyword for keyword, groups in zip(self.keywords, self.group_tokens)
+            if all(any(all(token in vocabulary for token in tokens) for tokens in group) for group in groups)
+        }
+
+    def search(self, sentence):
+        """
+        Return True as soon as any form of any keyword is found in the sentence.
+        """
+        word_forms = self.word_forms
+        for word in self.WORD_PATTERN.finditer(sentence):
+            if word.group(0).lower() in word_forms:
+                return True
+        return any(pattern.search(sentence) for pattern, _, _, _ in self.phrase_forms)
+
+    def match(self, sentence):
+        """
+        Return a list of (keyword, positions) for every keyword whose parts are all found in the sentence.
+        Each part uses the first of its forms found in the sentence and the position of the first
+        occurrence of that form.
+        """
+        best = {}
+        for keyword_index, group_index, form_index, start, end in self.find_hits(sentence):
+            key = (keyword_index, group_index)
+            current = best.get(key)
+            if current is None or (form_index, start) < current[:2]:
+                best[key] = (form_index, start, end)
+
+        if not best:
+            return []
+
+        matches = []
+        for keyword_index in sorted({keyword_index for keyword_index, _ in best}):
+            positions = []
+            for group_index in range(self.group_counts[keyword_index]):
+                hit = best.get((keyword_index, group_index))
+                if hit is None:
+                    break
+                positions.append(hit[1:])
+            else:
+                matches.append((self.keywords[keyword_index], positions))
+        return matches
+
+
+class KeywordHighlighter:
+    """
+    Wraps the keywords found in a sentence in brackets, all keywords of all profiles in a single scan.
+    Keywords made of single words are looked up word by word, the others use one precompiled pattern each.
+    Where keywords overlap, the one added first wins and the text it highlights is not matched again.
+    """
+    WORD_PATTERN = re.compile(r'\w+')
+    SINGLE_WORD_PATTERN = re.compile(r'\w+$')
+
+    def __init__(self, keyword_brackets):
+        """
+        keyword_brackets is a list of (forms, bracket_count) in order of precedence,
+        forms being the flattened list of forms of a keyword.
+        """
+        self.brackets = []
+        self.word_forms = {}  # lowercased form -> keyword index
+        self.phrase_patterns = []  # (compiled pattern, keyword index)
+
+        for keyword_index, (forms, bracket_count) in enumerate(keyword_brackets):
+            self.brackets.append(("{" * bracket_count, "}" * bracket_count))
+            forms = [form for form in forms if form]
+            if all(self.SINGLE_WORD_PATTERN.match(form) for form in forms):
+                for form in forms:
+                    self.word_forms.setdefault(form.lower(), keyword_index)
+            elif forms:
+                # Same pattern as a separate substitution per keyword, the first listed form wins at a position
+                pattern = re.compile(r'(?<!\w)({})\b'.format("|".join(map(re.escape, forms))), re.IGNORECASE)
+                self.phrase_patterns.append((pattern, keyword_index))
+
+    def find_spans(self, sentence):
+        """
+        Return the non-overlapping (start, end, keyword index) to highlight, sorted by position.
+        """
+        hits = []
+        word_forms = self.word_forms
+        for word in self.WORD_PATTERN.finditer(sentence):
+            keyword_index = word_forms.get(word.group(0).lower())
+            if keyword_index is not None:
+                hits.append((keyword_index, word.start(), word.end()))
+
+        if self.phrase_patterns:
+            for pattern, keyword_index in self.phrase_patterns:
+                for match in pattern.finditer(sentence):
+                    hits.append((keyword_index, match.start(), match.end()))
+            hits.sort()
+
+            # Keep the hits of the earlier keywords where they overlap
+            spans = []
+            for keyword_index, start, end in hits:
+                if all(end <= span_start or start >= span_end for span_start, span_end, _ in spans):
+                    spans.append((start, end, keyword_index))
+            spans.sort()
+            return spans
+
+        # Words never overlap
+        return [(start, end, keyword_index) for keyword_index, start, end in hits]
+
+    def highlight(self, sentence):
+        """
+        Return the sentence with every keyword wrapped in the brackets of its profile.
+        """
+        spans = self.find_spans(sentence)
+        if not spans:
+            return sentence
+
+        parts = []
+        last_end = 0
+        brackets = self.brackets
+        for start, end, keyword_index in spans:
+            left_bracket, right_bracket = brackets[keyword_index]
+            parts.append(sentence[last_end:start])
+            parts.append(left_bracket)
+            parts.append(sentence[start:end])
+            parts.append(right_bracket)
+            last_end = end
+        parts.append(sentence[last_end:])
+        return "".join(parts)
+
+
+class TextCache:
+    """
+    On-disk cache of the cleaned sentences, vocabulary and metadata of the source files.
+    Entries are keyed by file path, size and modification time (or content hash when enabled),
+    and the least recently used entries are evicted once the cache grows past max_size_mb.
+    An entry is a gzip JSON Lines file: a header with the metadata, sentence count and vocabulary
+    (and the backend that read a PDF), then one line per batch of sentences, so it is written and
+    read back batch by batch.
+    """
+    CACHE_VERSION = 2
+    INDEX_FILENAME = 'cache_index.json'
+    ENTRY_SUFFIXES = ('.jsonl.gz', '.json.gz', '.chunks', '.tmp')  # Entries, previous versions and unfinished ones
+
+    def __init__(self, cache_dir, max_size_mb=1024, use_content_hash=False):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.use_content_hash = use_content_hash
+        self.index_path = os.path.join(cache_dir, self.INDEX_FILENAME)
+        self.index_changed = False
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self.load_index()
+
+        # The entries written by another version of the cache can't be read
+        for name, record in list(self.index.items()):
+            if record.get('version') != self.CACHE_VERSION:
+                self.remove(name)
+
+    def load_index(self):
+        """Load the index of the cache entries, an unreadable index resets the cache."""
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error loading text cache index: {str(e)}. Clearing the cache.")
+            self.clear()
+            return {}
+
+    def save_index(self):
+        """Write the index back to disk if it was modified."""
+        if not self.index_changed:
+            return
+        temp_path = self.index_path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.index, f, indent=4)
+            os.replace(temp_path, self.index_path)
+            self.index_changed = False
+        except Exception as e:
+            print(f"Error saving text cache index: {str(e)}")
+
+    def entry_name(self, file_path):
+        return hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest() + '.jsonl.gz'
+
+    def fingerprint(self, file_path):
+        """Return the size and modification time of the file, and its content hash if enabled."""
+        stat = os.stat(file_path)
+        fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        if self.use_content_hash:
+            digest = hashlib.sha1()
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+            fingerprint['hash'] = digest.hexdigest()
+        return fingerprint
+
+    def is_valid(self, record, fingerprint):
+        if record.get('version') != self.CACHE_VERSION or record.get('size') != fingerprint['size']:
+            return False
+        if self.use_content_hash:
+            return record.get('hash') == fingerprint['hash']
+        return record.get('mtime') == fingerprint['mtime']
+
+    def entry_path(self, file_path):
+        return os.path.join(self.cache_dir, self.entry_name(file_path))
+
+    def lookup(self, file_path, fingerprint=None):
+        """
+        Return the path of the cached entry of the file, or None if it is missing or out of date.
+        """
+        name = self.entry_name(file_path)
+        record = self.index.get(name)
+        if record is None:
+            return None
+
+        if fingerprint is None:
+            fingerprint = self.fingerprint(file_path)
+        if not self.is_valid(record, fingerprint):
+            return None
+
+        record['last_used'] = time.time()
+        self.index_changed = True
+        return os.path.join(self.cache_dir, name)
+
+    @staticmethod
+    def read_entry_header(entry_path):
+        """Return the header of an entry: its 'metadata', 'sentences' count, 'vocabulary' and 'pdf_backend'."""
+        with gzip.open(entry_path, 'rt', encoding='utf-8') as f:
+            return json.loads(f.readline())
+
+    @staticmethod
+    def iter_entry_sentences(entry_path):
+        """Yield the batches of cleaned sentences of an entry, as they were written."""
+        with gzip.open(entry_path, 'rt', encoding='utf-8') as f:
+            f.readline()  # Header
+            for line in f:
+                yield json.loads(line)
+
+    def add_record(self, file_path, fingerprint, entry_size):
+        """Register an entry written to entry_path(file_path) in the index."""
+        self.index[self.entry_name(file_path)] = dict(
+            fingerprint,
+            path=os.path.abspath(file_path),
+            version=self.CACHE_VERSION,
+            bytes=entry_size,
+            last_used=time.time()
+        )
+        self.index_changed = True
+        self.evict()
+
+    def remove(self, name):
+        self.index.pop(name, None)
+        self.index_changed = True
+        try:
+            os.remove(os.path.join(self.cache_dir, name))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in its maximum size."""
+        total_size = sum(record.get('bytes', 0) for record in self.index.values())
+        if total_size <= self.max_size:
+            return
+        for name, record in sorted(self.index.items(), key=lambda item: item[1].get('last_used', 0)):
+            if total_size <= self.max_size:
+                break
+            total_size -= record.get('bytes', 0)
+            self.remove(name)
+
+    def clear(self):
+        """Delete every entry of the cache."""
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(self.ENTRY_SUFFIXES) or filename == self.INDEX_FILENAME:
+                os.remove(os.path.join(self.cache_dir, filename))
+        self.index = {}
+        self.index_changed = False
+
+    def info(self):
+        """Return a short description of the cache content."""
+        total_size = sum(record.get('bytes', 0) for record in self.index.values())
+        return (f"Text cache: {len(self.index)} files, {total_size / (1024 * 1024):.1f} MB "
+                f"of {self.max_size / (1024 * 1024):.0f} MB ({self.cache_dir})")
+
+
+class TextCacheWriter:
+    """
+    Writes a TextCache entry batch by batch, can be used from the worker processes.
+    The batches go to a gzip file next to the entry, close writes the header in front of them,
+    gzip files being readable as one stream when concatenated.
+    """
+
+    def __init__(self, entry_path):
+        self.entry_path = entry_path
+        self.batches_path = entry_path + '.chunks'
+        self.batches = gzip.open(self.batches_path, 'wt', encoding='utf-8', compresslevel=1)
+        self.sentence_count = 0
+
+    def write_batch(self, sentences):
+        """Add a batch of cleaned sentences, before their normalization."""
+        self.batches.write(json.dumps(sentences) + '\n')
+        self.sentence_count += len(sentences)
+
+    def close(self, metadata, vocabulary, pdf_backend=None):
+        """Write the entry with its header and return its size on disk, pdf_backend is the name of the backend of a PDF."""
+        self.batches.close()
+        header = {'metadata': metadata, 'sentences': self.sentence_count, 'vocabulary': vocabulary,
+                  'pdf_backend': pdf_backend}
+        temp_path = self.entry_path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(gzip.compress((json.dumps(header) + '\n').encode('utf-8'), compresslevel=1))
+                with open(self.batches_path, 'rb') as batches:
+                    shutil.copyfileobj(batches, f)
+            os.replace(temp_path, self.entry_path)
+        finally:
+            self.discard()
+        return os.path.getsize(self.entry_path)
+
+    def discard(self):
+        """Remove the unfinished entry."""
+        self.batches.close()
+        for path in (self.batches_path, self.entry_path + '.tmp'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def get_book_metadata(file_path, metadata_prefix=";;", document=None):
+    """
+    Extract metadata from book files.
+    Returns metadata string with optional prefix from filename.
+    The file already opened with open_document can be given to avoid reading it again.
+    """
+    try:
+        if document is None:
+            with open_document(file_path) as opened_document:
+                book_metadata = opened_document.book_metadata()
+        else:
+            book_metadata = document.book_metadata()
+    except Exception as e:
+        print(f"Error extracting metadata from {os.path.basename(file_path)}: {str(e)}")
+        book_metadata = {}
+    return format_book_metadata(file_path, book_metadata, metadata_prefix)
+
+
+def format_book_metadata(file_path, book_metadata, metadata_prefix=";;"):
+    """
+    Return the metadata string of a book from the dict of Document.book_metadata,
+    with the prefix found before metadata_prefix in the filename.
+    """
+    filename = os.path.basename(file_path)
+    filename_without_ext = os.path.splitext(filename)[0]
+
+    # Extract prefix if present
+    prefix = ""
+    if metadata_prefix in filename_without_ext:
+        prefix, rest = filename_without_ext.split(metadata_prefix, 1)
+        filename_without_ext = rest.replace('_', ' ').strip()
+
+    # Default values
+    title = filename_without_ext
+    author = "Unknown Author"
+    date = "Unknown Date"
+
+    try:
+        title = book_metadata.get('title', title)
+        author = book_metadata.get('author', author)
+        date = book_metadata.get('date', date)
+
+        # Clean up metadata
+        title = title.strip()
+        author = author.strip()
+        date = date.strip()
+
+        if not title:
+            title = filename_without_ext
+
+    except Exception as e:
+        print(f"Error extracting metadata from {filename}: {str(e)}")
+        title = filename_without_ext
+
+    # Format the metadata string with prefix
+    metadata = prefix.strip()
+    if metadata:
+        metadata += " - "
+    metadata += title
+    if author != "Unknown Author":
+        metadata += f" by {author}"
+    if date != "Unknown Date":
+        metadata += f" - {date}"
+
+    return metadata
+
+
+# Default replacements of the broken characters, written to the normalization settings file
+DEFAULT_REPLACEMENTS = {
+    "“": '"',
+    "’": "'",
+    "”": '"',
+    "—": "-",  # Correct long dash
+    "â€“": "-",  # Misinterpreted en dash
+    "â€”": "-",  # Misinterpreted em dash
+    "\u00a0": "",  # Non-breaking space
+    "…": "...",
+    "‘": "'",
+    "â€œ": '"',  # Misinterpreted opening double quote
+    "â€": '"',   # Misinterpreted closing double quote or other symbols
+    "â€™": "'",  # Misinterpreted apostrophe
+    "–": "-",  # Replace en dash if present
+}
+
+
+class TextNormalizer:
+    """
+    Replaces the broken characters of a text, optionally followed by Unicode NFKC folding.
+    The longer sequences (mojibake) are replaced first with one precompiled pattern, longest first,
+    then the single characters with a lookup table through a precompiled character class
+    (str.translate is several times slower on non-ASCII text).
+    """
+
+    def __init__(self, replacements=None, use_nfkc=False):
+        if replacements is None:
+            replacements = DEFAULT_REPLACEMENTS
+        # Line breaks are used to separate the sentences of a document, like in the source text they become spaces
+        self.replacements = {
+            key: value.replace("\n", " ") for key, value in replacements.items() if key and "\n" not in key
+        }
+        self.use_nfkc = use_nfkc
+        settings = json.dumps([sorted(self.replacements.items()), self.use_nfkc])
+        self.settings_hash = hashlib.sha1(settings.encode('utf-8')).hexdigest()
+
+        characters = {key: value for key, value in self.replacements.items() if len(key) == 1}
+        sequences = {key: value for key, value in self.replacements.items() if len(key) > 1}
+        if any(character in value for value in sequences.values() for character in characters):
+            # The replacement of a sequence would be replaced again by the table, use a single pattern instead
+            characters, sequences = {}, self.replacements
+        self.table = characters
+        self.sequences = sequences
+        self.pattern = None
+        self.characters_pattern = None
+        if sequences:
+            self.pattern = re.compile('|'.join(re.escape(key) for key in sorted(sequences, key=len, reverse=True)))
+        if characters:
+            self.characters_pattern = re.compile('[{}]'.format(''.join(map(re.escape, characters))))
+
+    @classmethod
+    def from_settings_file(cls, settings_path):
+        """
+        Load the normalizer from a JSON settings file {"use_nfkc": bool, "replacements": {text: replacement}},
+        the file is created with the default replacements if it does not exist.
+        """
+        if not os.path.exists(settings_path):
+            os.makedirs(os.path.dirname(settings_path), exist_ok=True)
+            with open(settings_path, 'w', encoding='utf-8') as f:
+                json.dump({"use_nfkc": False, "replacements": DEFAULT_REPLACEMENTS}, f, indent=4, ensure_ascii=False)
+            return cls()
+
+        with open(settings_path, 'r', encoding='utf-8') as f:
+            settings = json.load(f)
+        return cls(settings.get("replacements", DEFAULT_REPLACEMENTS), settings.get("use_nfkc", False))
+
+    def signature(self):
+        """Return a hash of the normalization settings, the texts normalized with other settings are outdated."""
+        return self.settings_hash
+
+    def replace_sequence(self, match):
+        return self.sequences[match.group(0)]
+
+    def replace_character(self, match):
+        return self.table[match.group(0)]
+
+    def normalize(self, text):
+        if self.pattern is not None:
+            text = self.pattern.sub(self.replace_sequence, text)
+        if self.characters_pattern is not None:
+            text = self.characters_pattern.sub(self.replace_character, text)
+        if self.use_nfkc:
+            text = unicodedata.normalize('NFKC', text)
+        return text
+
+    def normalize_batch(self, sentences):
+        """
+        Return the normalized text of a list of stripped sentences, normalized at once.
+        The sentences are joined with line breaks, which clean_linebreaks removed from the text,
+        so no replacement can span two sentences.
+        """
+        return self.normalize("\n".join(sentences)).split("\n")
+
+
+_default_normalizer = TextNormalizer()
+
+
+class HTMLTextParser(HTMLParser):
+    """
+    Collects the text of an HTML document like BeautifulSoup(html, 'html.parser').get_text(separator=' ')
+    without building the tree: the same strings, whitespace-only strings collapsed, the text of
+    script, style, template and ruby annotations left out.
+    """
+    VOID_ELEMENTS = frozenset(HTMLTreeBuilder.DEFAULT_EMPTY_ELEMENT_TAGS)
+    PRESERVE_WHITESPACE_TAGS = frozenset(HTMLTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS)
+    STRING_CONTAINERS = frozenset(HTMLTreeBuilder.DEFAULT_STRING_CONTAINERS)
+    ASCII_SPACES = frozenset('\x20\x0a\x09\x0c\x0d')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.strings = []
+        self.data = []
+        self.tag_stack = []
+        self.preserve_whitespace_stack = []  # Positions in tag_stack of the open pre and textarea
+        self.string_container_stack = []  # Positions in tag_stack of the open script, style, template, rt and rp
+        self.closed_void_elements = []
+
+    @classmethod
+    def get_text(cls, markup):
+        parser = cls()
+        parser.feed(markup)
+        parser.close()
+        parser.end_data()
+        return ' '.join(parser.strings)
+
+    def end_data(self, kind="text"):
+        """
+        Add the pending data as a string. kind is "text", "cdata" for a CDATA section,
+        or None for what is not text (comment, declaration...).
+        """
+        if not self.data:
+            return
+        data = ''.join(self.data)
+        self.data = []
+        if kind is None or (kind == "text" and self.string_container_stack):
+            return
+        if not self.preserve_whitespace_stack and all(character in self.ASCII_SPACES for character in data):
+            data = '\n' if '\n' in data else ' '
+        self.strings.append(data)
+
+    def pop_tag(self):
+        position = len(self.tag_stack) - 1
+        self.tag_stack.pop()
+        if self.preserve_whitespace_stack and self.preserve_whitespace_stack[-1] == position:
+            self.preserve_whitespace_stack.pop()
+        if self.string_container_stack and self.string_container_stack[-1] == position:
+            self.string_container_stack.pop()
+
+    def handle_starttag(self, tag, attrs, void_element=True):
+        self.end_data()
+        if tag in self.PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace_stack.append(len(self.tag_stack))
+        if tag in self.STRING_CONTAINERS:
+            self.string_container_stack.append(len(self.tag_stack))
+        self.tag_stack.append(tag)
+        if void_element and tag in self.VOID_ELEMENTS:
+            # html.parser sends no end tag for them, an explicit one later on is ignored
+            self.handle_endtag(tag, check_closed=False)
+            self.closed_void_elements.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, void_element=False)
+        self.handle_endtag(tag, check_closed=False)
+
+    def handle_endtag(self, tag, check_closed=True):
+        if check_closed and tag in self.closed_void_elements:
+            self.closed_void_elements.remove(tag)
+            return
+        self.end_data()
+        # Close the most recent open tag with this name and the ones opened after it
+        if tag in self.tag_stack:
+            while True:
+                open_tag = self.tag_stack[-1]
+                self.pop_tag()
+                if open_tag == tag:
+                    break
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_charref(self, name):
+        base = 16 if name[:1] in ('x', 'X') else 10
+        digits = name[1:] if base == 16 else name
+        extra_data = ""
+        try:
+            number = int(digits, base)
+        except ValueError:
+            # Only the leading digits are the reference, the rest is text
+            match = re.search(r'^([0-9a-f]+)(.*)' if base == 16 else r'^([0-9]+)(.*)', digits)
+            if match is None:
+                self.data.append(digits)
+                return
+            number, extra_data = int(match.group(1), base), match.group(2)
+        self.data.append(UnicodeDammit.numeric_character_reference(number)[0])
+        self.data.append(extra_data)
+
+    def handle_entityref(self, name):
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self.data.append(character if character is not None else f"&{name}")
+
+    def handle_comment(self, data):
+        self.end_data()
+        self.data.append(data)
+        self.end_data(kind=None)
+
+    def handle_decl(self, decl):
+        self.handle_comment(decl)
+
+    def handle_pi(self, data):
+        self.handle_comment(data)
+
+    def unknown_decl(self, data):
+        # CDATA sections are text, other declarations are not
+        self.end_data()
+        is_cdata = data.upper().startswith("CDATA[")
+        self.data.append(data[len("CDATA["):] if is_cdata else data)
+        self.end_data(kind="cdata" if is_cdata else None)
+
+
+class EpubFile:
+    """
+    Reads the metadata and the text of an EPUB without loading the whole book: the OPF is parsed once
+    and only the XHTML documents are decompressed, one at a time. Images, fonts and styles are never read.
+    The documents are the XHTML items of the manifest, in manifest order, and their text is the one
+    BeautifulSoup gives for the body serialized by lxml, like with EbookLib.
+    """
+    OPF_NAMESPACE = "http://www.idpf.org/2007/opf"
+    CONTAINER_NAMESPACE = "urn:oasis:names:tc:opendocument:xmlns:container"
+    DC_NAMESPACE = "http://purl.org/dc/elements/1.1/"
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with zipfile.ZipFile(file_path) as archive:
+            container = self.parse_xml(archive.read("META-INF/container.xml"))
+        opf_path = None
+        for root_file in container.iterfind(f".//{{{self.CONTAINER_NAMESPACE}}}rootfile[@media-type]"):
+            if root_file.get("media-type") == "application/oebps-package+xml":
+                opf_path = root_file.get("full-path")
+        if opf_path is None:
+            raise ValueError("No OPF file found in the EPUB container")
+        opf_dir = posixpath.dirname(opf_path)
+
+        with zipfile.ZipFile(file_path) as archive:
+            package = self.parse_xml(archive.read(posixpath.normpath(opf_path)))
+
+        # Dublin Core metadata, {name: [values]}
+        self.metadata = {}
+        metadata = package.find(f"{{{self.OPF_NAMESPACE}}}metadata")
+        if metadata is not None:
+            for element in metadata:
+                if isinstance(element.tag, str) and element.tag.startswith(f"{{{self.DC_NAMESPACE}}}"):
+                    name = element.tag[len(self.DC_NAMESPACE) + 2:]
+                    self.metadata.setdefault(name, []).append(element.text)
+
+        self.documents = []
+        manifest = package.find(f"{{{self.OPF_NAMESPACE}}}manifest")
+        for item in (manifest if manifest is not None else []):
+            if item.tag != f"{{{self.OPF_NAMESPACE}}}item" or item.get("media-type") != "application/xhtml+xml":
+                continue
+            href = item.get("href")
+            # The navigation document is not unquoted by EbookLib
+            if "nav" not in item.get("properties", "").split(" "):
+                href = unquote(href)
+            self.documents.append(posixpath.normpath(posixpath.join(opf_dir, href)))
+
+    @staticmethod
+    def parse_xml(content):
+        return etree.fromstring(content, parser=etree.XMLParser(recover=True, resolve_entities=False))
+
+    def get_metadata(self, name):
+        return self.metadata.get(name, [])
+
+    def iter_texts(self):
+        """Yield the text of the documents, only one is decompressed at a time."""
+        with zipfile.ZipFile(self.file_path) as archive:
+            for document in self.documents:
+                yield self.document_text(archive.read(document))
+
+    @staticmethod
+    def document_text(content):
+        """Return the text of the body of an XHTML document."""
+        try:
+            html_tree = lxml_html.document_fromstring(content, parser=lxml_html.HTMLParser(encoding="utf-8"))
+        except Exception:
+            return ""
+        body = html_tree.find("body")
+        if body is None or len(body) == 0:
+            return ""
+
+        body_html = etree.tostring(body, pretty_print=True, encoding="utf-8", xml_declaration=False)
+        if body_html.startswith(b"<body>"):
+            body_html = body_html[6:body_html.rindex(b"</body>")]
+        return HTMLTextParser.get_text(body_html.decode('utf-8'))
+
+
+def iter_epub_texts(file_path):
+    """Yield the text of the documents of an EPUB file, one chapter after the other."""
+    yield from EpubFile(file_path).iter_texts()
+
+
+def extract_text_from_epub(file_path):
+    return "".join(iter_epub_texts(file_path))
+
+
+TEXT_BOMS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]  # The UTF-32 BOMs first, the little endian one starts with the UTF-16 one
+
+
+def detect_bom_encoding(data):
+    """Return the encoding of the byte order mark starting the bytes of a text file, or None."""
+    for bom, encoding in TEXT_BOMS:
+        if data[:len(bom)] == bom:
+            return encoding
+    return None
+
+
+def detect_text_encoding(data, block_size=1024 * 1024):
+    """
+    Return the encoding of the bytes of a text file: the one of its byte order mark if any,
+    'utf-8' if the whole buffer decodes as UTF-8, 'iso-8859-1' otherwise.
+    """
+    bom_encoding = detect_bom_encoding(data)
+    if bom_encoding:
+        return bom_encoding
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for start in range(0, len(data), block_size):
+            decoder.decode(data[start:start + block_size])
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return 'iso-8859-1'
+    return 'utf-8'
+
+
+class PdfBackend:
+    """
+    Reads the page texts and the metadata of a PDF with one library, the file is opened once.
+    Subclasses are registered in PDF_BACKENDS with register_pdf_backend.
+    """
+    name = None
+
+    @classmethod
+    def is_available(cls):
+        return False
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
+    def page_count(self):
+        raise NotImplementedError
+
+    def iter_page_texts(self, start=0, end=None):
+        """Yield the text of the pages start to end - 1."""
+        raise NotImplementedError
+
+    def metadata(self):
+        """Return a dict with the 'title', 'author' and 'year' of the document that are known."""
+        raise NotImplementedError
+
+    @staticmethod
+    def year(date):
+        """Return the year of a PDF date string (D:YYYYMMDD...), or None."""
+        year_match = re.search(r'D:(\d{4})', date or "")
+        return year_match.group(1) if year_match else None
+
+
+PDF_BACKENDS = {}  # Name: PdfBackend subclass, in order of preference
+_missing_pdf_backends = set()
+
+
+def register_pdf_backend(backend):
+    PDF_BACKENDS[backend.name] = backend
+    return backend
+
+
+@register_pdf_backend
+class PyPDF2Backend(PdfBackend):
+    name = "PyPDF2"
+    module = PyPDF2
+
+    @classmethod
+    def is_available(cls):
+        return cls.module is not None
+
+    def __init__(self, file_path):
+        super().__init__(file_path)
+        self.file = open(file_path, 'rb')
+        try:
+            self.reader = self.module.PdfReader(self.file)
+        except Exception:
+            self.file.close()
+            raise
+
+    def close(self):
+        self.file.close()
+
+    def page_count(self):
+        return len(self.reader.pages)
+
+    def iter_page_texts(self, start=0, end=None):
+        for page_number in range(start, self.page_count() if end is None else end):
+            yield self.reader.pages[page_number].extract_text() or ""
+
+    def metadata(self):
+        metadata = {}
+        info = self.reader.metadata
+        if info:
+            if info.get('/Title'):
+                metadata['title'] = info['/Title']
+            if info.get('/Author'):
+                metadata['author'] = info['/Author']
+            if info.get('/CreationDate'):
+                metadata['year'] = self.year(info['/CreationDate'])
+        return metadata
+
+
+@register_pdf_backend
+class PypdfBackend(PyPDF2Backend):
+    """pypdf is the continuation of PyPDF2, with the same reader."""
+    name = "pypdf"
+
+    @classmethod
+    def is_available(cls):
+        return importlib.util.find_spec("pypdf") is not None
+
+    def __init__(self, file_path):
+        import pypdf
+        self.module = pypdf
+        super().__init__(file_path)
+
+
+@register_pdf_backend
+class PdfminerBackend(PdfBackend):
+    name = "pdfminer.six"
+
+    @classmethod
+    def is_available(cls):
+        return importlib.util.find_spec("pdfminer") is not None
+
+    def __init__(self, file_path):
+        from pdfminer.pdfparser import PDFParser
+        from pdfminer.pdfdocument import PDFDocument
+        super().__init__(file_path)
+        self.file = open(file_path, 'rb')
+        try:
+            self.document = PDFDocument(PDFParser(self.file))
+        except Exception:
+            self.file.close()
+            raise
+        self.pages = None
+
+    def close(self):
+        self.file.close()
+
+    def get_pages(self):
+        from pdfminer.pdfpage import PDFPage
+        if self.pages is None:
+            self.pages = list(PDFPage.create_pages(self.document))
+        return self.pages
+
+    def page_count(self):
+        return len(self.get_pages())
+
+    def iter_page_texts(self, start=0, end=None):
+        from io import StringIO
+        from pdfminer.converter import TextConverter
+        from pdfminer.layout import LAParams
+        from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+
+        resource_manager = PDFResourceManager()
+        for page in self.get_pages()[start:end]:
+            output = StringIO()
+            device = TextConverter(resource_manager, output, laparams=LAParams())
+            PDFPageInterpreter(resource_manager, device).process_page(page)
+            device.close()
+            yield output.getvalue()
+
+    def metadata(self):
+        from pdfminer.pdftypes import resolve1
+        from pdfminer.utils import decode_text
+
+        def text(value):
+            value = resolve1(value)
+            return decode_text(value) if isinstance(value, bytes) else str(value or "")
+
+        metadata = {}
+        info = self.document.info[0] if self.document.info else {}
+        if text(info.get('Title')):
+            metadata['title'] = text(info['Title'])
+        if text(info.get('Author')):
+            metadata['author'] = text(info['Author'])
+        if text(info.get('CreationDate')):
+            metadata['year'] = self.year(text(info['CreationDate']))
+        return metadata
+
+
+@register_pdf_backend
+class PdftotextBackend(PdfBackend):
+    """The pdftotext and pdfinfo programs of Poppler."""
+    name = "pdftotext"
+
+    @classmethod
+    def is_available(cls):
+        return shutil.which("pdftotext") is not None and shutil.which("pdfinfo") is not None
+
+    def __init__(self, file_path):
+        super().__init__(file_path)
+        output = subprocess.run(["pdfinfo", "-isodates", "-enc", "UTF-8", file_path],
+                                capture_output=True, check=True).stdout.decode('utf-8', errors='replace')
+        self.info = {}
+        for line in output.splitlines():
+            key, separator, value = line.partition(":")
+            if separator:
+                self.info[key.strip()] = value.strip()
+
+    def page_count(self):
+        return int(self.info.get("Pages", 0))
+
+    def iter_page_texts(self, start=0, end=None):
+        end = self.page_count() if end is None else end
+        if start >= end:
+            return
+        output = subprocess.run(["pdftotext", "-enc", "UTF-8", "-f", str(start + 1), "-l", str(end), self.file_path, "-"],
+                                capture_output=True, check=True).stdout.decode('utf-8', errors='replace')
+        # Every page ends with a form feed
+        pages = output.split("\f")
+        for page_number in range(end - start):
+            yield pages[page_number] if page_number < len(pages) else ""
+
+    def metadata(self):
+        metadata = {}
+        if self.info.get("Title"):
+            metadata['title'] = self.info["Title"]
+        if self.info.get("Author"):
+            metadata['author'] = self.info["Author"]
+        year_match = re.match(r'(\d{4})', self.info.get("CreationDate", ""))
+        if year_match:
+            metadata['year'] = year_match.group(1)
+        return metadata
+
+
+def get_pdf_backend(name=None):
+    """Return the PdfBackend class called name, or the first available one if it is not installed."""
+    backend = PDF_BACKENDS.get(name)
+    if backend is not None and backend.is_available():
+        return backend
+    for backend in PDF_BACKENDS.values():
+        if backend.is_available():
+            if name and name not in _missing_pdf_backends:
+                _missing_pdf_backends.add(name)  # Reported once, not for every file
+                print(f"PDF backend {name} is not available, using {backend.name}")
+            return backend
+    raise RuntimeError("No PDF backend available")
+
+
+def open_pdf(file_path, backend=None):
+    """Open a PDF with the backend called backend (the default one if None), its text and metadata are then read from it."""
+    return get_pdf_backend(backend or DEFAULT_PDF_SETTINGS["backend"])(file_path)
+
+
+def measure_pdf_backend(file_paths, backend):
+    """
+    Extract the PDFs with the backend called backend, each file being opened once for its text and metadata.
+    Returns (pages, seconds, words), words counting the words of the extracted text.
+    """
+    pages = 0
+    words = Counter()
+    start_time = time.perf_counter()
+    for file_path in file_paths:
+        with PDF_BACKENDS[backend](file_path) as pdf:
+            pdf.metadata()
+            for page_text in pdf.iter_page_texts():
+                pages += 1
+                words.update(word.lower() for word in re.findall(r'\w+', page_text))
+    return pages, time.perf_counter() - start_time, words
+
+
+def text_fidelity(words, reference_words):
+    """Return the share of the words of the reference found in words, 1.0 for identical texts."""
+    total = max(sum(words.values()), sum(reference_words.values()))
+    if total == 0:
+        return 1.0
+    return sum((words & reference_words).values()) / total
+
+
+def _extract_pdf_pages(file_path, start, end, backend=None):
+    """Return the text of the pages start to end - 1 of a PDF, each worker opens the file on its own."""
+    with open_pdf(file_path, backend) as pdf:
+        return list(pdf.iter_page_texts(start, end))
+
+
+def iter_pdf_texts(file_path, jobs=1, pages_per_batch=20, page_timeout=0, page_progress=None, backend=None,
+                   pdf_document=None):
+    """
+    Yield the text of the pages of a PDF in page order, read with the backend called backend.
+    With jobs > 1, or a page timeout, batches of pages_per_batch pages are extracted by a pool of worker processes.
+    A batch taking more than page_timeout seconds per page is retried page by page, a page timing out
+    on its own is left empty so a malformed page can't stall the extraction.
+    page_progress(pages_done, pages_total) is called after each batch.
+    A PDF already opened with a PdfBackend can be given as pdf_document, it is not closed.
+    """
+    pages_per_batch = max(int(pages_per_batch), 1)
+    pdf = pdf_document or open_pdf(file_path, backend)
+    try:
+        page_count = pdf.page_count()
+        if (jobs <= 1 and not page_timeout) or page_count == 0:
+            for page_number, page_text in enumerate(pdf.iter_page_texts(), 1):
+                yield page_text
+                if page_progress and (page_number % pages_per_batch == 0 or page_number == page_count):
+                    page_progress(page_number, page_count)
+            return
+        backend = pdf.name
+    finally:
+        if pdf_document is None:
+            pdf.close()
+
+    batches = deque((start, min(start + pages_per_batch, page_count)) for start in range(0, page_count, pages_per_batch))
+    processes = max(min(jobs, len(batches)), 1)
+    pending = {}
+
+    # A Pool rather than a ProcessPoolExecutor, its workers can be terminated when a page hangs
+    def start_pool():
+        pool = multiprocessing.Pool(processes)
+        pool.apply(os.getpid)  # The startup of the workers doesn't count in the timeout
+        return pool
+
+    def submit(pool):
+        for batch in batches:
+            if batch not in pending:
+                pending[batch] = pool.apply_async(_extract_pdf_pages, (file_path,) + batch + (backend,))
+
+    pool = start_pool()
+    try:
+        submit(pool)
+        pages_done = 0
+        while batches:
+            start, end = batches.popleft()
+            try:
+                texts = pending.pop((start, end)).get(timeout=page_timeout * (end - start) if page_timeout else None)
+            except multiprocessing.TimeoutError:
+                # The workers are replaced, the pages still running are lost
+                pool.terminate()
+                pool = start_pool()
+                pending.clear()
+                if end - start > 1:
+                    batches.extendleft((page_number, page_number + 1) for page_number in range(end - 1, start - 1, -1))
+                    submit(pool)
+                    continue
+                print(f"Page {start + 1} of {os.path.basename(file_path)} timed out after {page_timeout} seconds, skipped")
+                submit(pool)
+                texts = [""]
+
+            yield from texts
+            pages_done += end - start
+            if page_progress:
+                page_progress(pages_done, page_count)
+    finally:
+        pool.terminate()
+
+
+class Document:
+    """
+    A source file opened once, its metadata and its text being read from the same parsed book.
+    Created by open_document, it is closed by close() or at the end of a with block.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
+    def book_metadata(self):
+        """Return a dict with the 'title', 'author' and 'date' of the book that are known."""
+        return {}
+
+    def iter_texts(self, page_progress=None):
+        """Yield the raw text of the file piece by piece, the pieces joined are the whole text."""
+        raise NotImplementedError
+
+
+class TextDocument(Document):
+    """
+    A .txt file mapped in memory: its bytes are read once, the encoding being detected on them
+    before they are decoded block by block.
+    """
+    SINGLE_PASS_SIZE = 64 * 1024 * 1024  # Files decoded as UTF-8 at once, their blocks held until the whole file is checked
+
+    def __init__(self, file_path, block_size=1024 * 1024):
+        super().__init__(file_path)
+        self.block_size = block_size
+        self.file = open(file_path, 'rb')
+        # An empty file can't be mapped
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(self.file.fileno()).st_size else b""
+        self.encoding = None  # Detected when the text is read, the metadata doesn't need it
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def iter_texts(self, page_progress=None):
+        if self.encoding is None:
+            self.encoding = detect_bom_encoding(self.data)
+        if self.encoding is None and len(self.data) <= self.SINGLE_PASS_SIZE:
+            try:
+                blocks = list(self.decode_blocks('utf-8'))
+                self.encoding = 'utf-8'
+                yield from blocks
+                return
+            except UnicodeDecodeError:
+                self.encoding = 'iso-8859-1'
+        if self.encoding is None:
+            self.encoding = detect_text_encoding(self.data, self.block_size)
+        yield from self.decode_blocks(self.encoding)
+
+    def decode_blocks(self, encoding):
+        decoder = codecs.getincrementaldecoder(encoding)()
+        for start in range(0, len(self.data), self.block_size):
+            block = decoder.decode(self.data[start:start + self.block_size])
+            if block:
+                yield block
+        block = decoder.decode(b'', final=True)
+        if block:
+            yield block
+
+
+class EpubDocument(Document):
+    """An .epub file, chapter after chapter."""
+
+    def __init__(self, file_path):
+        super().__init__(file_path)
+        self.epub_file = EpubFile(file_path)
+
+    def book_metadata(self):
+        book_metadata = {}
+        if self.epub_file.get_metadata('title'):
+            book_metadata['title'] = self.epub_file.get_metadata('title')[0]
+        if self.epub_file.get_metadata('creator'):
+            book_metadata['author'] = self.epub_file.get_metadata('creator')[0]
+        if self.epub_file.get_metadata('date'):
+            date = self.epub_file.get_metadata('date')[0]
+            year_match = re.search(r'\d{4}', date)
+            book_metadata['date'] = year_match.group(0) if year_match else date
+        return book_metadata
+
+    def iter_texts(self, page_progress=None):
+        return self.epub_file.iter_texts()
+
+
+class PdfDocument(Document):
+    """A .pdf file read with a PdfBackend, page after page."""
+
+    def __init__(self, file_path, pdf_settings=None):
+        super().__init__(file_path)
+        self.pdf_settings = dict(pdf_settings or {})
+        self.pdf = open_pdf(file_path, self.pdf_settings.get("backend"))
+
+    def close(self):
+        self.pdf.close()
+
+    def book_metadata(self):
+        pdf_metadata = self.pdf.metadata()
+        book_metadata = {key: pdf_metadata[key] for key in ('title', 'author') if pdf_metadata.get(key)}
+        if pdf_metadata.get('year'):
+            book_metadata['date'] = pdf_metadata['year']
+        return book_metadata
+
+    def iter_texts(self, page_progress=None):
+        return iter_pdf_texts(self.file_path, page_progress=page_progress, pdf_document=self.pdf, **self.pdf_settings)
+
+
+def open_document(file_path, pdf_settings=None):
+    """
+    Open a .pdf, .txt or .epub file once for its metadata and its text.
+    pdf_settings are the keyword arguments of iter_pdf_texts, their backend reads the PDFs.
+    """
+    if file_path.endswith('.pdf'):
+        return PdfDocument(file_path, pdf_settings)
+    if file_path.endswith('.txt'):
+        return TextDocument(file_path)
+    return EpubDocument(file_path)
+
+
+def iter_file_texts(file_path, pdf_settings=None, page_progress=None, document=None):
+    """
+    Yield the raw text of a .pdf, .txt or .epub file piece by piece: a page of a PDF,
+    a chapter of an EPUB or a block of a text file. The pieces joined are the whole text.
+    The file already opened with open_document can be given as document, it is then not closed.
+    pdf_settings are the keyword arguments of iter_pdf_texts, page_progress is only used for PDFs.
+    """
+    if document is not None:
+        yield from document.iter_texts(page_progress)
+        return
+    with open_document(file_path, pdf_settings) as document:
+        yield from document.iter_texts(page_progress)
+
+
+def read_file_text(file_path):
+    """Return the raw text of a .pdf, .txt or .epub file."""
+    return "".join(iter_file_texts(file_path))
+
+
+def clean_linebreaks(text):
+    return LINEBREAK_PATTERN.sub(' ', text).strip()
+
+
+def split_sentence_spans(text):
+    """Return the (start, end) offsets of the sentences, the same boundaries as re.split."""
+    spans = []
+    start = 0
+    for separator in SENTENCE_SPLIT_PATTERN.finditer(text):
+        spans.append((start, separator.start()))
+        start = separator.end()
+    spans.append((start, len(text)))
+    return spans
+
+
+class SentenceSplitter:
+    """
+    Splits a text received piece by piece into sentences, with the same result as
+    split_sentence_spans(clean_linebreaks(text)). The unfinished sentence at the end of a piece
+    is carried over to the next one, trailing whitespace is held back until the next piece
+    tells whether it belongs to a line break.
+    """
+    CONTEXT = 8  # Characters needed before a separator by the lookbehinds of SENTENCE_SPLIT_PATTERN
+
+    def __init__(self):
+        self.whitespace = ""  # Trailing whitespace of the raw text, not cleaned yet
+        self.buffer = ""  # Cleaned text of the unfinished sentence, preceded by some context
+        self.sentence_start = 0  # Position of the unfinished sentence in the buffer
+        self.started = False
+
+    def feed(self, piece):
+        """Add a piece of raw text, returns the stripped sentences it completed."""
+        raw = self.whitespace + piece
+        content = raw.rstrip()
+        self.whitespace = raw[len(content):]
+        if not content:
+            return []
+
+        cleaned = LINEBREAK_PATTERN.sub(' ', content)
+        if not self.started:
+            cleaned = cleaned.lstrip()
+            self.started = True
+
+        # The buffer ends with a non whitespace character, every separator found is final
+        text = self.buffer + cleaned
+        sentences = []
+        start = self.sentence_start
+        for separator in SENTENCE_SPLIT_PATTERN.finditer(text, start):
+            sentences.append(text[start:separator.start()].strip())
+            start = separator.end()
+
+        keep = max(start - self.CONTEXT, 0)
+        self.buffer = text[keep:]
+        self.sentence_start = start - keep
+        return sentences
+
+    def close(self):
+        """Return the last sentence, the text always has at least one even if empty."""
+        sentence = self.buffer[self.sentence_start:].strip()
+        self.buffer = ""
+        self.sentence_start = 0
+        return [sentence]
+
+
+def iter_sentence_batches(file_path, normalizer, splitter=None, batch_size=1024 * 1024, pdf_settings=None,
+                          page_progress=None, document=None, stats=None, cache_writer=None):
+    """
+    Yield the normalized sentences of a file in batches of about batch_size characters,
+    the file being loaded and split piece by piece so only a batch is held in memory.
+    The file already opened with open_document can be given as document, and each batch is
+    written before its normalization to the TextCacheWriter cache_writer if given.
+    The time spent loading, splitting and normalizing is added to the ExtractionStats stats.
+    """
+    splitter = splitter or SentenceSplitter()
+    stats = stats or ExtractionStats()
+    batch = []
+    batch_length = 0
+    start = time.perf_counter()
+    for piece in iter_file_texts(file_path, pdf_settings, page_progress, document):
+        start = stats.add_time("load", start)
+        for sentence in splitter.feed(piece):
+            batch.append(sentence)
+            batch_length += len(sentence)
+        start = stats.add_time("segment", start)
+        if batch_length >= batch_size:
+            if cache_writer is not None:
+                cache_writer.write_batch(batch)
+                start = stats.add_time("load", start)
+            batch = normalizer.normalize_batch(batch)
+            stats.add_time("normalize", start)
+            yield batch
+            batch = []
+            batch_length = 0
+            start = time.perf_counter()  # The time of the caller between two batches isn't counted
+    batch.extend(splitter.close())
+    start = stats.add_time("segment", start)
+    if cache_writer is not None:
+        cache_writer.write_batch(batch)
+        start = stats.add_time("load", start)
+    batch = normalizer.normalize_batch(batch)
+    stats.add_time("normalize", start)
+    yield batch
+
+
+def iter_cached_sentence_batches(entry_path, normalizer, stats=None, cache_writer=None):
+    """
+    Yield the normalized sentences of a TextCache entry batch by batch, like iter_sentence_batches,
+    each batch being written again to the TextCacheWriter cache_writer if given.
+    """
+    stats = stats or ExtractionStats()
+    start = time.perf_counter()
+    for batch in TextCache.iter_entry_sentences(entry_path):
+        if cache_writer is not None:
+            cache_writer.write_batch(batch)
+        start = stats.add_time("load", start)
+        batch = normalizer.normalize_batch(batch)
+        stats.add_time("normalize", start)
+        yield batch
+        start = time.perf_counter()
+
+
+def sentence_words(sentences):
+    """Return the set of the lowercased words of the sentences."""
+    return set(KeywordMatcher.WORD_PATTERN.findall("\n".join(sentences).lower()))
+
+
+def truncate_sentence_around_keywords(sentence, positions, max_length=200):
+    """Cut the sentence to max_length characters around the (start, end) positions of the keywords."""
+    if not positions:
+        return sentence
+
+    positions = sorted(positions)
+    start_pos = positions[0][0]
+    end_pos = positions[-1][1]
+    context_length = (max_length - (end_pos - start_pos)) // 2
+
+    start = max(0, start_pos - context_length)
+    end = min(len(sentence), end_pos + context_length)
+
+    if start > 0:
+        start = sentence.rfind(' ', 0, start) + 1
+    if end < len(sentence):
+        end = sentence.rfind(' ', end) + 1
+
+    truncated = sentence[start:end].strip()
+    if start > 0:
+        truncated = '...' + truncated
+    if end < len(sentence):
+        truncated = truncated + '...'
+
+    return truncated
+
+
+def is_ignored(sentence_trimmed, sentence, has_ignored_keyword, ignored_matcher):
+    """
+    Check if the truncated sentence contains an ignored keyword.
+    has_ignored_keyword is the result of ignored_matcher on the whole sentence, the truncated
+    sentence only needs to be checked again when part of the sentence was cut off.
+    """
+    if not has_ignored_keyword:
+        return False
+    if sentence_trimmed == sentence:
+        return True
+    return ignored_matcher.search(sentence_trimmed)
+
+
+def extract_file_sentences(file_path, profile_matchers, max_length=200, metadata_settings=True, metadata_prefix=";;",
+                           cache_entry_path=None, cached=False, ignored_matcher=None, normalizer=None,
+                           pdf_settings=None, page_progress=None):
+    """
+    Extract the sentences of a single file matching the keywords of each profile.
+
+    profile_matchers is a list of (keyword_forms_map, matcher) in profile order.
+    Sentences containing any of the keywords of ignored_matcher are left out.
+    The text of the sentences is normalized with normalizer, the default replacements if None.
+    If cache_entry_path is given, the sentences are read from it when cached is True, otherwise
+    they are written to it.
+    The file or its cache entry is read batch by batch, page by page or chapter by chapter, the
+    sentences being matched and written to the cache entry one batch after the other.
+    pdf_settings and page_progress are passed to iter_pdf_texts, the PDF being read with the backend of pdf_settings.
+
+    Returns (matches, cache_size, stats), matches being a list of (profile index, keyword, sentence_data)
+    in sentence order, cache_size the size of the written cache entry, or None, and stats the ExtractionStats
+    of the file. Reading and writing the text cache are part of the load stage.
+    """
+    filename = os.path.basename(file_path)
+    matches = []
+    cache_size = None
+    stats = ExtractionStats()
+    start = time.perf_counter()
+    normalizer = normalizer or _default_normalizer
+
+    header = None
+    if cached:
+        try:
+            header = TextCache.read_entry_header(cache_entry_path)
+        except Exception as e:
+            print(f"Error reading text cache entry for {file_path}: {str(e)}")
+
+    # The text of a PDF depends on the backend that read it, the entries of another backend are parsed again
+    if header is not None and file_path.endswith('.pdf'):
+        try:
+            pdf_backend = get_pdf_backend((pdf_settings or {}).get("backend") or DEFAULT_PDF_SETTINGS["backend"]).name
+        except RuntimeError:
+            pdf_backend = None
+        if header.get('pdf_backend') != pdf_backend:
+            print(f"Text cache entry of {filename} was read with {header.get('pdf_backend')}, "
+                  f"extracting it again with {pdf_backend}")
+            header = None
+
+    # The file is opened once for its metadata and its text, the errors are reported below
+    document = None
+    if header is None:
+        try:
+            document = open_document(file_path, pdf_settings)
+        except Exception:
+            pass
+
+    # Extract metadata once per file if needed
+    metadata = None
+    if metadata_settings:
+        if header and metadata_prefix in header['metadata']:
+            metadata = header['metadata'][metadata_prefix]
+        else:
+            try:
+                metadata = get_book_metadata(file_path, metadata_prefix, document)
+            except Exception as e:
+                print(f"Error extracting metadata from {filename}: {str(e)}")
+                metadata = filename
+    stats.add_time("load", start)
+
+    # Read file content
+    cache_writer = None
+    try:
+        # The vocabulary of the document is stored with its sentences, it depends on the normalization settings
+        if (header is not None and header['vocabulary']['normalization'] == normalizer.signature()
+                and (not metadata_settings or metadata_prefix in header['metadata'])):
+            stats.sentences_scanned += header['sentences']
+
+            # Pre-filter keywords with the vocabulary of the document
+            start = time.perf_counter()
+            active_profiles = active_profile_matchers(profile_matchers, set(header['vocabulary']['words']))
+            stats.add_time("match", start)
+            if not active_profiles:
+                return matches, cache_size, stats  # Skip processing if no keywords found in file
+
+            for sentences in iter_cached_sentence_batches(cache_entry_path, normalizer, stats):
+                match_sentences(sentences, active_profiles, file_path, metadata if metadata_settings else None,
+                                max_length, ignored_matcher, matches, stats)
+            return matches, cache_size, stats
+
+        # The cache entry is written, or written again with the new vocabulary or metadata, batch after batch
+        if cache_entry_path:
+            try:
+                cache_writer = TextCacheWriter(cache_entry_path)
+            except Exception as e:
+                print(f"Error writing text cache entry for {file_path}: {str(e)}")
+
+        if header is None:
+            # Parse the file piece by piece (pages, chapters)
+            batches = iter_sentence_batches(file_path, normalizer, pdf_settings=pdf_settings, page_progress=page_progress,
+                                            document=document, stats=stats, cache_writer=cache_writer)
+        else:
+            batches = iter_cached_sentence_batches(cache_entry_path, normalizer, stats, cache_writer)
+
+        words = set()
+        for sentences in batches:
+            stats.sentences_scanned += len(sentences)
+            start = time.perf_counter()
+            batch_words = sentence_words(sentences)
+            words |= batch_words
+            active_profiles = active_profile_matchers(profile_matchers, batch_words)
+            stats.add_time("match", start)
+            match_sentences(sentences, active_profiles, file_path, metadata if metadata_settings else None,
+                            max_length, ignored_matcher, matches, stats)
+
+        if cache_writer is not None:
+            start = time.perf_counter()
+            entry_metadata = header['metadata'] if header else {}
+            if metadata_settings:
+                entry_metadata[metadata_prefix] = metadata
+            vocabulary = {'normalization': normalizer.signature(), 'words': sorted(words)}
+            pdf_backend = document.pdf.name if isinstance(document, PdfDocument) else header and header.get('pdf_backend')
+            try:
+                cache_size = cache_writer.close(entry_metadata, vocabulary, pdf_backend)
+            except Exception as e:
+                print(f"Error writing text cache entry for {file_path}: {str(e)}")
+            cache_writer = None
+            stats.add_time("load", start)
+
+    except ExtractionCancelled:
+        raise
+    except Exception as e:
+        print(f"Error processing file {file_path}: {str(e)}")
+    finally:
+        if cache_writer is not None:
+            cache_writer.discard()
+        if document is not None:
+            document.close()
+
+    return matches, cache_size, stats
+
+
+def active_profile_matchers(profile_matchers, vocabulary):
+    """Return (profile index, active keywords, matcher) of the profiles with keywords that may be found in the vocabulary."""
+    active_profiles = []
+    for profile_index, (keyword_forms_map, matcher) in enumerate(profile_matchers):
+        active_keywords = matcher.active_keywords(vocabulary)
+        if active_keywords:
+            active_profiles.append((profile_index, active_keywords, matcher))
+    return active_profiles
+
+
+def match_sentences(sentences, active_profiles, file_path, metadata, max_length, ignored_matcher, matches,
+                    stats=None):
+    """
+    Append the (profile index, keyword, sentence_data) of the sentences matching the active profiles to matches,
+    metadata is added to the sentence data unless None.
+    The time spent looking for the ignored keywords and matching is added to the ExtractionStats stats.
+    """
+    if not active_profiles:
+        return
+    stats = stats or ExtractionStats()
+    matches_before = len(matches)
+    start = time.perf_counter()
+    filter_seconds = 0.0  # Time spent looking for the ignored keywords, its own stage
+
+    # Process sentences only if we have matching keywords
+    for sentence_cleaned in sentences:
+        # Looked up on the first keyword found in the sentence, then kept for the other keywords and profiles
+        has_ignored_keyword = None if ignored_matcher is not None else False
+
+        # Match the profiles in order, each one in a single scan of the sentence
+        for profile_index, active_keywords, matcher in active_profiles:
+            for keyword, positions in matcher.match(sentence_cleaned):
+                if keyword not in active_keywords:
+                    continue
+                matched_sentence_trimmed = truncate_sentence_around_keywords(sentence_cleaned, positions, max_length)
+                filter_start = time.perf_counter()
+                if has_ignored_keyword is None:
+                    has_ignored_keyword = ignored_matcher.search(sentence_cleaned)
+                ignored = is_ignored(matched_sentence_trimmed, sentence_cleaned, has_ignored_keyword, ignored_matcher)
+                filter_seconds += time.perf_counter() - filter_start
+                if ignored:
+                    continue
+                if metadata is not None:
+                    sentence_data = (matched_sentence_trimmed, file_path, metadata)
+                else:
+                    sentence_data = (matched_sentence_trimmed, file_path)
+                matches.append((profile_index, keyword, sentence_data))
+    stats.add_time("match", start + filter_seconds)  # The match stage leaves out the filter time
+    stats.seconds["filter"] += filter_seconds
+    stats.sentences_matched += len(matches) - matches_before
+
+
+# Settings shared by the tasks of a worker process, sent once when the process starts
+_worker_settings = {}
+
+
+def _init_worker(profile_matchers, max_length, metadata_settings, metadata_prefix, ignored_matcher, normalizer,
+                 pdf_settings):
+    _worker_settings.update(
+        profile_matchers=profile_matchers,
+        max_length=max_length,
+        metadata_settings=metadata_settings,
+        metadata_prefix=metadata_prefix,
+        ignored_matcher=ignored_matcher,
+        normalizer=normalizer,
+        pdf_settings=pdf_settings
+    )
+
+
+def _extract_file_task(file_path, cache_entry_path, cached):
+    return extract_file_sentences(file_path, cache_entry_path=cache_entry_path, cached=cached, **_worker_settings)
+
+
+def extract_files(file_paths, profile_matchers, max_length=200, metadata_settings=True, metadata_prefix=";;",
+                  text_cache=None, jobs=1, ignored_matcher=None, normalizer=None, pdf_settings=None, page_progress=None):
+    """
+    Run extract_file_sentences over every file and yield (file_path, matches, stats) in the order of file_paths.
+    With jobs > 1 the files are spread over a pool of worker processes, largest files first among the
+    jobs * 2 files following the last yielded one, so only the matches of these files are held at once.
+    A single file uses the jobs for the pages of a PDF instead, page_progress(file_path, pages_done, pages_total)
+    is then called after each batch of pages.
+    pdf_settings are the "backend", "pages_per_batch" and "page_timeout" of iter_pdf_texts.
+    """
+    pdf_settings = dict(DEFAULT_PDF_SETTINGS, **(pdf_settings or {}))
+    tasks = []
+    for file_path in file_paths:
+        if not file_path.endswith(SUPPORTED_EXTENSIONS):
+            print(f"Unsupported file type: {file_path}")
+            continue
+
+        # Reuse the cached text if the file did not change since the last extraction
+        fingerprint = None
+        cache_entry_path = None
+        cached = False
+        if text_cache:
+            try:
+                fingerprint = text_cache.fingerprint(file_path)
+                cache_entry_path = text_cache.lookup(file_path, fingerprint)
+                cached = cache_entry_path is not None
+                if not cached:
+                    cache_entry_path = text_cache.entry_path(file_path)
+            except OSError as e:
+                print(f"Error reading text cache for {os.path.basename(file_path)}: {str(e)}")
+                cache_entry_path = None
+        tasks.append((file_path, fingerprint, cache_entry_path, cached))
+
+    def finish(task, result):
+        file_path, fingerprint, _, _ = task
+        matches, cache_size, stats = result
+        if cache_size is not None:
+            text_cache.add_record(file_path, fingerprint, cache_size)
+        return file_path, matches, stats
+
+    if jobs <= 1 or len(tasks) <= 1:
+        file_pdf_settings = dict(pdf_settings, jobs=jobs)
+        for task in tasks:
+            file_path, _, cache_entry_path, cached = task
+            file_page_progress = None
+            if page_progress:
+                file_page_progress = lambda pages_done, pages_total, file_path=file_path: page_progress(
+                    file_path, pages_done, pages_total)
+            result = extract_file_sentences(file_path, profile_matchers, max_length, metadata_settings, metadata_prefix,
+                                            cache_entry_path, cached, ignored_matcher, normalizer,
+                                            file_pdf_settings, file_page_progress)
+            yield finish(task, result)
+        return
+
+    # Schedule the largest files first so a big book doesn't start last, the files are submitted
+    # jobs * 2 ahead of the next one to yield so the results waiting for an earlier file stay bounded
+    def file_size(task):
+        try:
+            return os.path.getsize(task[0])
+        except OSError:
+            return 0
+    window = jobs * 2
+
+    results = {}
+    next_index = 0
+    submitted = 0
+    with ProcessPoolExecutor(max_workers=min(jobs, len(tasks)), initializer=_init_worker,
+                             initargs=(profile_matchers, max_length, metadata_settings, metadata_prefix,
+                                       ignored_matcher, normalizer, pdf_settings)) as executor:
+        futures = {}
+        try:
+            while futures or submitted < len(tasks):
+                schedule = range(submitted, min(next_index + window, len(tasks)))
+                for i in sorted(schedule, key=lambda i: file_size(tasks[i]), reverse=True):
+                    futures[executor.submit(_extract_file_task, tasks[i][0], tasks[i][2], tasks[i][3])] = i
+                submitted = max(submitted, schedule.stop)
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = futures.pop(future)
+                    try:
+                        results[index] = future.result()
+                    except Exception as e:
+                        # A crashed worker only loses its own file
+                        print(f"Error processing file {tasks[index][0]}: {str(e)}")
+                        results[index] = ([], None, ExtractionStats())
+
+                # Merge the results in the original file order
+                while next_index in results:
+                    yield finish(tasks[next_index], results.pop(next_index))
+                    next_index += 1
+        finally:
+            # Drop the files not started yet when the caller stops early (cancelled extraction)
+            for future in futures:
+                future.cancel()
+
+
+class SentenceIndex:
+    """
+    Persistent inverted index of the sentences of the source files, stored in a SQLite database.
+    Every lowercased word points to the sentences containing it (file, sentence id and offset of its
+    first occurrence), so keywords are resolved with posting list lookups instead of scanning the files.
+    Files are indexed again when their size or modification time changes, and the whole index
+    when the normalization settings change. The title, author and date of every book are stored
+    with it, its metadata string is formatted from them for any metadata prefix.
+    """
+    INDEX_VERSION = 3
+    WORD_PATTERN = re.compile(r'\w+')
+
+    def __init__(self, index_path, normalizer=None):
+        self.index_path = index_path
+        self.normalizer = normalizer or _default_normalizer
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        self.connection = sqlite3.connect(index_path)
+        self.create_tables()
+        self.check_normalization()
+
+    def create_tables(self):
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.INDEX_VERSION:
+            self.connection.executescript("""
+                DROP TABLE IF EXISTS files;
+                DROP TABLE IF EXISTS sentences;
+                DROP TABLE IF EXISTS postings;
+                DROP TABLE IF EXISTS settings;
+            """)
+        self.connection.executescript(f"""
+            CREATE TABLE IF NOT EXISTS files (
+                file_id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE,
+                size INTEGER,
+                mtime INTEGER,
+                metadata TEXT
+            );
+            CREATE TABLE IF NOT EXISTS sentences (
+                file_id INTEGER,
+                sentence_id INTEGER,
+                text TEXT,
+                PRIMARY KEY (file_id, sentence_id)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS postings (
+                token TEXT,
+                file_id INTEGER,
+                sentence_id INTEGER,
+                offset INTEGER,
+                PRIMARY KEY (token, file_id, sentence_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_file ON postings (file_id);
+            CREATE TABLE IF NOT EXISTS settings (
+                name TEXT PRIMARY KEY,
+                value TEXT
+            );
+            PRAGMA user_version = {self.INDEX_VERSION};
+        """)
+
+    def check_normalization(self):
+        """Clear the index if its sentences were normalized with other settings."""
+        signature = self.normalizer.signature()
+        row = self.connection.execute("SELECT value FROM settings WHERE name = 'normalization'").fetchone()
+        if row and row[0] == signature:
+            return
+        if row:
+            print("Normalization settings changed, the sentence index will be rebuilt.")
+            self.clear()
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO settings (name, value) VALUES ('normalization', ?)",
+                                    (signature,))
+
+    def close(self):
+        self.connection.close()
+
+    def file_record(self, file_path):
+        """Return (file_id, size, mtime, metadata) of an indexed file, or None."""
+        return self.connection.execute(
+            "SELECT file_id, size, mtime, metadata FROM files WHERE path = ?", (os.path.abspath(file_path),)
+        ).fetchone()
+
+    def indexed_files(self):
+        return [row[0] for row in self.connection.execute("SELECT path FROM files ORDER BY path")]
+
+    def update(self, file_paths, pdf_settings=None):
+        """
+        Index the new and modified files, returns the number of files indexed.
+        pdf_settings are the "backend", "pages_per_batch" and "page_timeout" the PDFs are read with.
+        """
+        indexed = 0
+        for file_path in file_paths:
+            if not file_path.endswith(SUPPORTED_EXTENSIONS):
+                continue
+            try:
+                stat = os.stat(file_path)
+                record = self.file_record(file_path)
+                if record and record[1] == stat.st_size and record[2] == stat.st_mtime_ns:
+                    continue
+                self.index_file(file_path, stat, pdf_settings)
+                indexed += 1
+            except Exception as e:
+                print(f"Error indexing file {file_path}: {str(e)}")
+        return indexed
+
+    def index_file(self, file_path, stat, pdf_settings=None):
+        """Store the sentences of the file and the postings of their words, replacing any previous version."""
+        sentences = []
+        postings = []
+        with open_document(file_path, pdf_settings) as document:
+            try:
+                metadata = document.book_metadata()
+            except Exception as e:
+                print(f"Error extracting metadata from {os.path.basename(file_path)}: {str(e)}")
+                metadata = {}
+            normalized_sentences = (
+                sentence for batch in iter_sentence_batches(file_path, self.normalizer, document=document)
+                for sentence in batch
+            )
+            for sentence_id, sentence in enumerate(normalized_sentences):
+                sentences.append((sentence_id, sentence))
+                first_offsets = {}
+                for word in self.WORD_PATTERN.finditer(sentence):
+                    first_offsets.setdefault(word.group(0).lower(), word.start())
+                postings.extend((token, sentence_id, offset) for token, offset in first_offsets.items())
+
+        with self.connection:
+            self.remove_file(file_path)
+            file_id = self.connection.execute(
+                "INSERT INTO files (path, size, mtime, metadata) VALUES (?, ?, ?, ?)",
+                (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, json.dumps(metadata))
+            ).lastrowid
+            self.connection.executemany(
+                "INSERT INTO sentences (file_id, sentence_id, text) VALUES (?, ?, ?)",
+                ((file_id, sentence_id, sentence) for sentence_id, sentence in sentences)
+            )
+            self.connection.executemany(
+                "INSERT INTO postings (token, file_id, sentence_id, offset) VALUES (?, ?, ?, ?)",
+                ((token, file_id, sentence_id, offset) for token, sentence_id, offset in postings)
+            )
+
+    def remove_file(self, file_path):
+        record = self.file_record(file_path)
+        if record is None:
+            return
+        file_id = record[0]
+        self.connection.execute("DELETE FROM postings WHERE file_id = ?", (file_id,))
+        self.connection.execute("DELETE FROM sentences WHERE file_id = ?", (file_id,))
+        self.connection.execute("DELETE FROM files WHERE file_id = ?", (file_id,))
+
+    def prune(self):
+        """Remove the files that no longer exist from the index, returns their number."""
+        missing = [path for path in self.indexed_files() if not os.path.exists(path)]
+        with self.connection:
+            for path in missing:
+                self.remove_file(path)
+        return len(missing)
+
+    def clear(self):
+        with self.connection:
+            self.connection.executescript("DELETE FROM postings; DELETE FROM sentences; DELETE FROM files;")
+        self.connection.execute("VACUUM")
+
+    def info(self):
+        """Return a short description of the index content."""
+        files = self.connection.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        sentences = self.connection.execute("SELECT COUNT(*) FROM sentences").fetchone()[0]
+        size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+        return (f"Sentence index: {files} files, {sentences} sentences, {size / (1024 * 1024):.1f} MB "
+                f"({self.index_path})")
+
+    def keyword_candidates(self, file_id, forms_list, token_postings):
+        """
+        Return the ids of the sentences of the file that may contain the keyword:
+        the intersection over its parts of the sentences containing every word of one of the forms.
+        token_postings memoizes the posting list of each word in the file.
+        """
+        def postings(token):
+            if token not in token_postings:
+                token_postings[token] = {row[0] for row in self.connection.execute(
+                    "SELECT sentence_id FROM postings WHERE token = ? AND file_id = ?", (token, file_id)
+                )}
+            return token_postings[token]
+
+        candidates = None
+        for forms in forms_list:
+            part_candidates = set()
+            for form in forms:
+                tokens = self.WORD_PATTERN.findall(form.lower())
+                if tokens:
+                    part_candidates |= set.intersection(*(postings(token) for token in tokens))
+            candidates = part_candidates if candidates is None else candidates & part_candidates
+            if not candidates:
+                return set()
+        return candidates or set()
+
+    def file_candidates(self, file_id, profile_matchers):
+        """Return the sorted ids of the sentences of the file that may contain a keyword of any profile."""
+        token_postings = {}
+        candidates = set()
+        for keyword_forms_map, matcher in profile_matchers:
+            for keyword, (forms_list, exact_matches, all_forms) in keyword_forms_map.items():
+                candidates |= self.keyword_candidates(file_id, forms_list, token_postings)
+        return sorted(candidates)
+
+    def extract_files(self, file_paths, profile_matchers, max_length=200, metadata_settings=True, metadata_prefix=";;",
+                      ignored_matcher=None, pdf_settings=None):
+        """
+        Index-backed counterpart of extract_files, yields (file_path, matches, stats) in the order of file_paths.
+        The new and modified files are indexed first, the PDFs being read with pdf_settings, then the candidate
+        sentences of every keyword are looked up in the index file by file and checked with the profile matchers.
+        The indexing is part of the load stage of the first file.
+        """
+        start = time.perf_counter()
+        self.update(file_paths, pdf_settings)
+
+        active_profiles = [
+            (profile_index, keyword_forms_map, matcher)
+            for profile_index, (keyword_forms_map, matcher) in enumerate(profile_matchers)
+        ]
+        for file_path in file_paths:
+            stats = ExtractionStats()
+            record = self.file_record(file_path)
+            if record is None:
+                continue
+            file_id, _, _, metadata_json = record
+            sentence_ids = self.file_candidates(file_id, profile_matchers)
+            if not sentence_ids:
+                stats.add_time("load", start)
+                yield file_path, [], stats
+                start = time.perf_counter()
+                continue
+
+            metadata = None
+            if metadata_settings:
+                metadata = format_book_metadata(file_path, json.loads(metadata_json), metadata_prefix)
+
+            sentences = list(self.read_sentences(file_id, sentence_ids))
+            stats.add_time("load", start)
+            stats.sentences_scanned = len(sentences)
+
+            matches = []
+            match_sentences(sentences, active_profiles, file_path, metadata, max_length, ignored_matcher, matches, stats)
+            yield file_path, matches, stats
+            start = time.perf_counter()
+
+    def read_sentences(self, file_id, sentence_ids, chunk_size=500):
+        """Yield the text of the given sentences of a file, in sentence order."""
+        for i in range(0, len(sentence_ids), chunk_size):
+            chunk = sentence_ids[i:i + chunk_size]
+            rows = self.connection.execute(
+                f"SELECT text FROM sentences WHERE file_id = ? AND sentence_id IN ({','.join('?' * len(chunk))}) "
+                f"ORDER BY sentence_id",
+                (file_id, *chunk)
+            )
+            for row in rows:
+                yield row[0]
+
+
+class DigestSet:
+    """
+    Set of strings stored as 16-byte digests, to deduplicate sentences without keeping them in memory.
+    With a SQLite connection, the digests are moved to a table once max_items of them are held in memory.
+    """
+
+    def __init__(self, connection=None, table="digests", max_items=None):
+        self.connection = connection
+        self.table = table
+        self.max_items = max_items if connection is not None else None
+        self.items = set()
+        self.spilled = False
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, text):
+        """Add the string, returns False if it was already in the set."""
+        digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        if digest in self.items:
+            return False
+        if self.spilled and self.connection.execute(
+                f"SELECT 1 FROM {self.table} WHERE digest = ?", (digest,)).fetchone():
+            return False
+
+        self.items.add(digest)
+        self.count += 1
+        if self.max_items is not None and len(self.items) >= self.max_items:
+            self.spill()
+        return True
+
+    def spill(self):
+        with self.connection:
+            self.connection.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (digest BLOB PRIMARY KEY) WITHOUT ROWID")
+            self.connection.executemany(f"INSERT INTO {self.table} (digest) VALUES (?)",
+                                        ((digest,) for digest in self.items))
+        self.items.clear()
+        self.spilled = True
+
+
+class SentenceStore:
+    """
+    The sentences extracted for each keyword, unique per profile, in extraction order.
+    Sentences are highlighted as they are added. This store keeps everything in memory.
+    """
+
+    def __init__(self, keywords, profile_count, highlighter=None):
+        self.keywords = list(keywords)
+        self.highlighter = highlighter
+        self.highlight_seconds = 0.0
+        self.profile_counts = [0] * profile_count
+        self.count = 0
+        self.keyword_sentences = {keyword: [] for keyword in self.keywords}
+        self.profile_sentences = [set() for _ in range(profile_count)]
+
+    def is_new(self, profile_index, sentence_data):
+        if sentence_data in self.profile_sentences[profile_index]:
+            return False
+        self.profile_sentences[profile_index].add(sentence_data)
+        return True
+
+    def add(self, profile_index, keyword, sentence_data):
+        """Add a sentence of a keyword unless the profile already has it, returns True if it was added."""
+        if not self.is_new(profile_index, sentence_data):
+            return False
+        self.profile_counts[profile_index] += 1
+        self.count += 1
+
+        if self.highlighter is not None:
+            start = time.perf_counter()
+            highlighted_sentence = self.highlighter.highlight(sentence_data[0])
+            if highlighted_sentence is not sentence_data[0]:
+                sentence_data = (highlighted_sentence,) + tuple(sentence_data[1:])
+            self.highlight_seconds += time.perf_counter() - start
+        self.store(keyword, sentence_data)
+        return True
+
+    def store(self, keyword, sentence_data):
+        if keyword not in self.keyword_sentences:
+            self.keyword_sentences[keyword] = []
+            self.keywords.append(keyword)
+        self.keyword_sentences[keyword].append(sentence_data)
+
+    def iter_sentences(self):
+        """Yield (keyword, sentence_data), keyword by keyword in the order of the profiles."""
+        for keyword, sentences in self.keyword_sentences.items():
+            for sentence_data in sentences:
+                yield keyword, sentence_data
+
+    def new_digest_set(self):
+        return DigestSet()
+
+    def close(self):
+        pass
+
+
+class StreamingSentenceStore(SentenceStore):
+    """
+    SentenceStore writing the sentences to a temporary SQLite database as they are extracted,
+    the per-profile deduplication uses digests that spill to the database past the memory budget.
+    The memory used stays bounded whatever the number of sentences.
+    """
+    BATCH_SIZE = 10000
+    DIGEST_SIZE = 100  # Approximate memory used by a digest in a set, in bytes
+
+    def __init__(self, keywords, profile_count, highlighter=None, memory_budget_mb=256, temp_dir=None):
+        super().__init__(keywords, profile_count, highlighter)
+        self.keyword_sentences = None
+        self.profile_sentences = None
+        self.keyword_ids = {keyword: keyword_id for keyword_id, keyword in enumerate(self.keywords)}
+
+        # Half of the budget for the digests of the extraction, half for the ones of the output
+        self.max_digests = max(int(memory_budget_mb * 1024 * 1024 / 2 / self.DIGEST_SIZE), 1000)
+        self.temp_dir = tempfile.mkdtemp(prefix='inktyping_', dir=temp_dir)
+        self.connection = sqlite3.connect(os.path.join(self.temp_dir, 'sentences.db'))
+        self.connection.executescript(f"""
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            PRAGMA cache_size = -{max(int(memory_budget_mb * 1024 / 4), 2048)};
+            CREATE TABLE sentences (
+                keyword_id INTEGER,
+                sequence INTEGER,
+                sentence TEXT,
+                file_path TEXT,
+                metadata TEXT,
+                PRIMARY KEY (keyword_id, sequence)
+            ) WITHOUT ROWID;
+        """)
+        self.profile_digests = DigestSet(self.connection, "profile_digests", self.max_digests)
+        self.pending = []
+
+    def is_new(self, profile_index, sentence_data):
+        return self.profile_digests.add("\0".join(map(str, (profile_index,) + tuple(sentence_data))))
+
+    def store(self, keyword, sentence_data):
+        if keyword not in self.keyword_ids:
+            self.keyword_ids[keyword] = len(self.keywords)
+            self.keywords.append(keyword)
+        metadata = sentence_data[2] if len(sentence_data) == 3 else None
+        self.pending.append((self.keyword_ids[keyword], self.count, sentence_data[0], sentence_data[1], metadata))
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT INTO sentences (keyword_id, sequence, sentence, file_path, metadata) VALUES (?, ?, ?, ?, ?)",
+                    self.pending
+                )
+            self.pending = []
+
+    def iter_sentences(self):
+        self.flush()
+        rows = self.connection.execute(
+            "SELECT keyword_id, sentence, file_path, metadata FROM sentences ORDER BY keyword_id, sequence"
+        )
+        for keyword_id, sentence, file_path, metadata in rows:
+            if metadata is None:
+                yield self.keywords[keyword_id], (sentence, file_path)
+            else:
+                yield self.keywords[keyword_id], (sentence, file_path, metadata)
+
+    def new_digest_set(self):
+        return DigestSet(self.connection, "output_digests", self.max_digests)
+
+    def close(self):
+        self.connection.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+
+class ExtractionCancelled(Exception):
+    """Raised by the extraction when its cancel check returns True, the partial results are discarded."""
+
+
+def estimate_remaining_time(start_time, done_size, total_size):
+    """Return the estimated seconds left from the size of the files processed so far, or None."""
+    if done_size <= 0:
+        return None
+    return (time.time() - start_time) * max(total_size - done_size, 0) / done_size
+
+
+EXTRACTION_STAGES = ["load", "normalize", "segment", "match", "filter", "highlight", "write"]
+
+
+class ExtractionStats:
+    """
+    Seconds spent in each stage of an extraction with the numbers of scanned and matched sentences,
+    for a whole preset and for each of its files. The worker processes send back the stats of their files.
+    """
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(EXTRACTION_STAGES, 0.0)
+        self.sentences_scanned = 0
+        self.sentences_matched = 0
+        self.files = {}  # File path: ExtractionStats of the file
+
+    def add_time(self, stage, start):
+        """Add the time elapsed since start, a time.perf_counter() value, to the stage and return the current one."""
+        now = time.perf_counter()
+        self.seconds[stage] += now - start
+        return now
+
+    def add_file(self, file_path, file_stats):
+        """Add the stats of a file to the totals."""
+        self.files[file_path] = file_stats
+        for stage, seconds in file_stats.seconds.items():
+            self.seconds[stage] += seconds
+        self.sentences_scanned += file_stats.sentences_scanned
+        self.sentences_matched += file_stats.sentences_matched
+
+    def total_seconds(self):
+        return sum(self.seconds.values())
+
+    def to_dict(self):
+        stats = {
+            'seconds': {stage: round(seconds, 4) for stage, seconds in self.seconds.items()},
+            'sentences_scanned': self.sentences_scanned,
+            'sentences_matched': self.sentences_matched
+        }
+        if self.files:
+            stats['files'] = {file_path: file_stats.to_dict() for file_path, file_stats in self.files.items()}
+        return stats
+
+    def summary(self):
+        """Return the seconds of each stage on one line."""
+        return ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in self.seconds.items())
+
+    def table(self, max_files=10):
+        """Return the stages, the counters and the slowest files as a text table."""
+        total = self.total_seconds()
+        lines = [f"{'Stage':<12}{'Seconds':>10}{'Share':>8}"]
+        for stage, seconds in self.seconds.items():
+            lines.append(f"{stage:<12}{seconds:>10.2f}{seconds / total if total else 0:>8.1%}")
+        lines.append(f"{'total':<12}{total:>10.2f}")
+        lines.append(f"Sentences scanned: {self.sentences_scanned}, matched: {self.sentences_matched}")
+
+        if self.files:
+            file_stages = EXTRACTION_STAGES[:5]  # Highlight and write are done for the whole preset
+            slowest = sorted(self.files.items(), key=lambda item: item[1].total_seconds(), reverse=True)[:max_files]
+            lines.append(f"{'Slowest files':<30}" + "".join(f"{stage:>10}" for stage in file_stages) + f"{'Sentences':>11}")
+            for file_path, file_stats in slowest:
+                name = os.path.basename(file_path)
+                name = name if len(name) <= 28 else name[:25] + "..."
+                lines.append(f"{name:<30}" + "".join(f"{file_stats.seconds[stage]:>10.2f}" for stage in file_stages)
+                             + f"{file_stats.sentences_scanned:>11}")
+        return "\n".join(lines)
+
+
+# Presets are written in JSON Lines, one {"sentence": ..., "metadata": ...} record per line.
+# The legacy presets hold ["""sentence""","""metadata"""] or plain sentence blocks separated by an empty line.
+PRESET_RECORD_START = b'{"'
+
+
+def format_preset_record(sentence, metadata=None):
+    """Return the JSON line of a sentence, without metadata when it is None."""
+    record = {"sentence": sentence} if metadata is None else {"sentence": sentence, "metadata": metadata}
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def parse_legacy_record(block):
+    """
+    Return the [sentence, metadata] of a legacy block (a list of two triple-quoted strings), None if it isn't one.
+    The blocks without escapes are sliced directly, the others are read as Python literals, never evaluated.
+    """
+    if block.startswith('["""') and block.endswith('"""]') and block.count('"""') == 4 \
+            and '\\' not in block and '""","""' in block:
+        sentence, metadata = block[4:-4].split('""","""')
+        return [sentence.strip(), metadata.strip()]
+    try:
+        entry = ast.literal_eval(block)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return None
+    if isinstance(entry, list) and len(entry) == 2 and all(isinstance(part, str) for part in entry):
+        return [entry[0].strip(), entry[1].strip()]
+    return None
+
+
+def parse_preset_record(block):
+    """Return the [sentence, metadata] of a preset record in any format, plain sentences have no metadata."""
+    block = block.strip()
+    if block.startswith('{"'):
+        try:
+            record = json.loads(block)
+            return [record.get("sentence", "").strip(), record.get("metadata", "").strip()]
+        except (ValueError, AttributeError):
+            pass
+    elif block.startswith('['):
+        entry = parse_legacy_record(block)
+        if entry is not None:
+            return entry
+    return [block, ""]
+
+
+def parse_preset_lines(lines):
+    """
+    Return the [sentence, metadata] of JSON lines, decoded together as a single JSON array.
+    A batch with an invalid line is parsed again line by line.
+    """
+    lines = [line for line in lines if not line.isspace()]
+    try:
+        records = json.loads("[" + ",".join(lines) + "]")
+        return [[record.get("sentence", "").strip(), record.get("metadata", "").strip()] for record in records]
+    except (ValueError, AttributeError):
+        return [parse_preset_record(line) for line in lines]
+
+
+def is_json_lines_preset(preset_path):
+    with open(preset_path, 'rb') as f:
+        return f.read(64).lstrip().startswith(PRESET_RECORD_START)
+
+
+def iter_preset_blocks(preset_path):
+    """
+    Yield the text of every record of a preset, numbered as in its PresetIndex: one record per line
+    for JSON Lines, blocks separated by an empty line for the legacy presets. Empty records are left out.
+    The records are split on the bytes of the preset by PresetIndex.iter_block_offsets, so both agree
+    on the numbering whatever the line breaks of the preset.
+    """
+    with open(preset_path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return  # An empty file can't be mapped
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for start, end in PresetIndex.iter_block_offsets(data):
+                yield PresetIndex.decode_block(data[start:end])
+
+
+def iter_preset_records(preset_path, batch_size=1024 * 1024):
+    """
+    Yield the [sentence, metadata] of every record of a preset, reading it in batches of about batch_size bytes
+    for JSON Lines and block by block for the legacy presets.
+    """
+    if not is_json_lines_preset(preset_path):
+        for block in iter_preset_blocks(preset_path):
+            yield parse_preset_record(block)
+        return
+
+    with open(preset_path, 'r', encoding='utf-8', errors='replace') as f:
+        for lines in iter(lambda: f.readlines(batch_size), []):
+            yield from parse_preset_lines(lines)
+
+
+def sample_preset_blocks(preset_path, count=None, randomize=True):
+    """
+    Return the (block number, text) of count records of a preset in a single pass, for presets without index.
+    With randomize, they are a uniform random sample in random order, drawn by reservoir sampling,
+    otherwise the first count records. count None returns every record.
+    """
+    sample = []
+    for number, block in enumerate(iter_preset_blocks(preset_path)):
+        if count is None or len(sample) < count:
+            sample.append((number, block))
+        elif not randomize:
+            break
+        else:
+            # Record n replaces one of the sample with probability count / (n + 1)
+            replaced = random.randint(0, number)
+            if replaced < count:
+                sample[replaced] = (number, block)
+    if randomize:
+        random.shuffle(sample)
+    return sample
+
+
+def migrate_preset_file(preset_path):
+    """
+    Rewrite a legacy preset in JSON Lines, can be called from the worker processes.
+    Returns (preset_path, records, migrated), presets already in JSON Lines are left as they are.
+    """
+    if is_json_lines_preset(preset_path):
+        return preset_path, None, False
+
+    records = 0
+    temp_path = preset_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as output_file:
+        for sentence, metadata in iter_preset_records(preset_path):
+            output_file.write(format_preset_record(sentence, metadata if metadata else None))
+            records += 1
+    os.replace(temp_path, preset_path)
+    return preset_path, records, True
+
+
+class PresetIndex:
+    """
+    Byte offsets of the sentence blocks of a preset file, a block being one line of a JSON Lines preset,
+    or a block separated by an empty line in the presets of older versions.
+    The offsets are saved in a "<preset>.idx" sidecar next to the preset with its size and modification
+    time, the index is built on first use and rebuilt when they change. Block n is then read directly,
+    without reading or parsing the blocks before it.
+    """
+    INDEX_VERSION = 2
+    MAGIC = b'IKPI'
+    HEADER = struct.Struct('<4sIQqQ')  # Magic, version, preset size, preset modification time, number of blocks
+    BLOCK_OFFSETS = struct.Struct('<QQ')  # Start and end offset of a block in the sidecar
+    # Two line breaks, each one being \r\n, \n or a bare \r as in the universal newlines of text files
+    BLOCK_SEPARATOR = re.compile(rb'(?:\r\n|\r(?!\n)|\n){2}')
+    LINE_SEPARATOR = re.compile(rb'\r\n?|\n')  # JSON Lines presets hold one record per line
+
+    def __init__(self, preset_path):
+        self.preset_path = preset_path
+        self.index_path = self.sidecar_path(preset_path)
+        self.offsets = None  # Start and end of every block, read from the sidecar when first needed
+        self.count = self.read_count(preset_path)
+        if self.count is None:
+            self.build()
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def sidecar_path(preset_path):
+        return preset_path + '.idx'
+
+    @classmethod
+    def remove_sidecar(cls, preset_path):
+        try:
+            os.remove(cls.sidecar_path(preset_path))
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def rename_sidecar(cls, old_path, new_path):
+        """Move the sidecar along with its renamed preset, the modification time of the preset is kept."""
+        if os.path.exists(cls.sidecar_path(old_path)):
+            os.replace(cls.sidecar_path(old_path), cls.sidecar_path(new_path))
+
+    @classmethod
+    def read_count(cls, preset_path):
+        """Return the number of blocks of the preset from its sidecar, None when it is missing or out of date."""
+        stat = os.stat(preset_path)
+        try:
+            with open(cls.sidecar_path(preset_path), 'rb') as f:
+                magic, version, size, mtime, count = cls.HEADER.unpack(f.read(cls.HEADER.size))
+        except (OSError, struct.error):
+            return None
+        if magic != cls.MAGIC or version != cls.INDEX_VERSION or size != stat.st_size or mtime != stat.st_mtime_ns:
+            return None
+        return count
+
+    def load_offsets(self):
+        if self.offsets is None:
+            offsets = array('Q')
+            with open(self.index_path, 'rb') as f:
+                f.seek(self.HEADER.size)
+                offsets.frombytes(f.read())
+            if len(offsets) != 2 * self.count:
+                self.build()  # Truncated sidecar
+            else:
+                self.offsets = offsets
+        return self.offsets
+
+    @staticmethod
+    def decode_block(data):
+        """Return the stripped text of the bytes of a block, its line breaks read as in text mode."""
+        return data.decode('utf-8', errors='replace').replace('\r\n', '\n').replace('\r', '\n').strip()
+
+    @classmethod
+    def iter_block_offsets(cls, data):
+        """Yield the (start, end) of the blocks of the bytes of a preset, empty blocks are left out."""
+        position = 0
+        json_lines = bytes(data[:64]).lstrip().startswith(PRESET_RECORD_START)
+        block_separator = cls.LINE_SEPARATOR if json_lines else cls.BLOCK_SEPARATOR
+        for separator in block_separator.finditer(data):
+            if data[position:separator.start()].strip():
+                yield position, separator.start()
+            position = separator.end()
+        if data[position:].strip():
+            yield position, len(data)
+
+    def build(self):
+        """Scan the preset for its blocks, empty blocks are left out, and save the sidecar."""
+        offsets = array('Q')
+        with open(self.preset_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+            try:
+                for start, end in self.iter_block_offsets(data):
+                    offsets.extend((start, end))
+            finally:
+                if size:
+                    data.close()
+        self.offsets = offsets
+        self.count = len(offsets) // 2
+        self.save()
+
+    def save(self):
+        stat = os.stat(self.preset_path)
+        temp_path = self.index_path + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.INDEX_VERSION, stat.st_size, stat.st_mtime_ns, self.count))
+                self.offsets.tofile(f)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            # The index still works from memory
+            print(f"Error saving the index of {os.path.basename(self.preset_path)}: {str(e)}")
+
+    def block_offsets(self, numbers):
+        """
+        Return the (start, end) of the blocks at the given numbers. Until the offsets are loaded, only those
+        of the requested blocks are read from the sidecar, so a few blocks are reached whatever the preset size.
+        """
+        if self.offsets is not None:
+            return [(self.offsets[2 * number], self.offsets[2 * number + 1]) for number in numbers]
+        block_offsets = []
+        with open(self.index_path, 'rb') as f:
+            for number in numbers:
+                if not 0 <= number < self.count:
+                    raise IndexError(f"Block {number} out of range")
+                f.seek(self.HEADER.size + number * self.BLOCK_OFFSETS.size)
+                data = f.read(self.BLOCK_OFFSETS.size)
+                if len(data) < self.BLOCK_OFFSETS.size:
+                    self.build()  # Truncated sidecar
+                    return self.block_offsets(numbers)
+                block_offsets.append(self.BLOCK_OFFSETS.unpack(data))
+        return block_offsets
+
+    def blocks(self, numbers):
+        """Return the text of the blocks at the given numbers, in the same order."""
+        texts = []
+        with open(self.preset_path, 'rb') as f:
+            for start, end in self.block_offsets(numbers):
+                f.seek(start)
+                texts.append(self.decode_block(f.read(end - start)))
+        return texts
+
+    def block(self, number):
+        return self.blocks([number])[0]
+
+    def find(self, predicate):
+        """Return the number of the first block whose text satisfies predicate, None if there is none."""
+        with open(self.preset_path, 'rb') as f:
+            offsets = self.load_offsets()
+            for number in range(self.count):
+                start, end = offsets[2 * number], offsets[2 * number + 1]
+                f.seek(start)
+                if predicate(self.decode_block(f.read(end - start))):
+                    return number
+        return None
+
+    def remove(self, number):
+        """
+        Remove block n and the line breaks following it from the preset, the following blocks move down by one.
+        Returns the text of the removed block.
+        """
+        offsets = self.load_offsets()
+        text = self.block(number)
+        start = offsets[2 * number]
+        end = offsets[2 * number + 2] if number + 1 < self.count else os.path.getsize(self.preset_path)
+
+        temp_path = self.preset_path + '.tmp'
+        with open(self.preset_path, 'rb') as source, open(temp_path, 'wb') as target:
+            target.write(source.read(start))
+            source.seek(end)
+            shutil.copyfileobj(source, target)
+        os.replace(temp_path, self.preset_path)
+
+        removed = end - start
+        following = array('Q', (offset - removed for offset in offsets[2 * number + 2:]))
+        del offsets[2 * number:]
+        offsets.extend(following)
+        self.count -= 1
+        self.save()
+        return text
+
+
+class SessionPlaylist:
+    """
+    Lazy sequence of the [sentence, metadata] entries of a session, holding only the block numbers of its
+    sentences in the preset. The entries are read through the PresetIndex of the preset and parsed when
+    accessed, the last cache_size of them are kept in an LRU cache. blocks holds the text of the blocks
+    instead when they were already read, by sample_preset_blocks for a preset without index.
+    """
+
+    def __init__(self, preset_path, block_numbers, blocks=None, preset_index=None, cache_size=16):
+        self.preset_path = preset_path
+        self.block_numbers = array('q', block_numbers)
+        self.blocks = list(blocks) if blocks is not None else None
+        self.preset_index = preset_index
+        self.cache_size = cache_size
+        self.entries = OrderedDict()  # Block number -> parsed entry, least recently used first
+
+    def __len__(self):
+        return len(self.block_numbers)
+
+    def __getitem__(self, position):
+        number = self.block_numbers[position]
+        entry = self.entries.get(number)
+        if entry is not None:
+            self.entries.move_to_end(number)
+            return entry
+
+        block = self.blocks[position] if self.blocks is not None else self.get_preset_index().block(number)
+        entry = parse_preset_record(block)
+        self.entries[number] = entry
+        if len(self.entries) > self.cache_size:
+            self.entries.popitem(last=False)
+        return entry
+
+    def get_preset_index(self):
+        if self.preset_index is None:
+            self.preset_index = PresetIndex(self.preset_path)
+        return self.preset_index
+
+    def block_number(self, position):
+        return self.block_numbers[position]
+
+    def remove(self, position, removed_block):
+        """
+        Remove the entry at position after the block removed_block was removed from the preset,
+        the following blocks of the preset moved down by one.
+        """
+        del self.block_numbers[position]
+        if self.blocks is not None:
+            del self.blocks[position]
+        self.block_numbers = array('q', (number - 1 if number > removed_block else number for number in self.block_numbers))
+        self.entries.clear()  # Keyed by the former block numbers
+
+
+# The inflect engine takes seconds to import, it is only loaded for the first keyword that needs it
+_inflect_engine = None
+
+
+def get_inflect_engine():
+    global _inflect_engine
+    if _inflect_engine is None:
+        import inflect
+        _inflect_engine = inflect.engine()
+    return _inflect_engine
+
+
+class KeywordRegistry:
+    """
+    Memo of the singular and plural forms of the keywords. The forms of each keyword list are also
+    saved in cache_dir under the hash of the list, a dictionary that was already used is loaded
+    from there without importing inflect. The least recently used files are removed past max_files.
+    """
+    CACHE_VERSION = 1
+
+    def __init__(self, cache_dir=None, max_files=50):
+        self.cache_dir = cache_dir
+        self.max_files = max_files
+        self.inflections = {}  # word -> (singular, plural)
+
+    def inflect(self, word):
+        """Return the (singular, plural) forms of the word, inflect is only called for unknown words."""
+        forms = self.inflections.get(word)
+        if forms is None:
+            engine = get_inflect_engine()
+            # singular_noun returns False for words already in singular form
+            singular = engine.singular_noun(word)
+            forms = (word if singular == False else singular, engine.plural(word))
+            self.inflections[word] = forms
+        return forms
+
+    def singular(self, word):
+        return self.inflect(word)[0]
+
+    def plural(self, word):
+        return self.inflect(word)[1]
+
+    @staticmethod
+    def inflected_words(keywords):
+        """Return the words of the keywords that get_keyword_forms inflects, the exact (&) ones are left out."""
+        words = []
+        for keyword in keywords:
+            parts = [k.strip() for k in keyword.split('+')] if '+' in keyword else [keyword]
+            words.extend(part for part in parts if not part.startswith('&'))
+        return list(dict.fromkeys(words))
+
+    def list_hash(self, words):
+        return hashlib.sha1("\n".join([str(self.CACHE_VERSION)] + words).encode('utf-8')).hexdigest()
+
+    def prepare(self, keywords):
+        """
+        Load the forms of a keyword list from its cache file, they are computed and saved
+        when the list wasn't seen yet. Returns the number of words that had to be inflected.
+        """
+        words = self.inflected_words(keywords)
+        if all(word in self.inflections for word in words):
+            return 0
+        if self.cache_dir is None:
+            missing = [word for word in words if word not in self.inflections]
+            for word in missing:
+                self.inflect(word)
+            return len(missing)
+
+        cache_path = os.path.join(self.cache_dir, self.list_hash(words) + '.json')
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'r', encoding='utf-8') as f:
+                    cached = json.load(f)
+                self.inflections.update((word, tuple(forms)) for word, forms in cached.items())
+                os.utime(cache_path)  # The modification time is the last use
+            except Exception as e:
+                print(f"Error loading keyword forms: {str(e)}. Computing them again.")
+
+        missing = [word for word in words if word not in self.inflections]
+        for word in missing:
+            self.inflect(word)
+        if missing:
+            self.save(cache_path, {word: self.inflections[word] for word in words})
+        return len(missing)
+
+    def save(self, cache_path, forms):
+        temp_path = cache_path + '.tmp'
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(forms, f, ensure_ascii=False)
+            os.replace(temp_path, cache_path)
+        except Exception as e:
+            print(f"Error saving keyword forms: {str(e)}")
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used cache files past max_files."""
+        try:
+            names = [name for name in os.listdir(self.cache_dir) if name.endswith('.json')]
+            if len(names) <= self.max_files:
+                return
+            paths = sorted((os.path.join(self.cache_dir, name) for name in names), key=os.path.getmtime)
+            for path in paths[:len(paths) - self.max_files]:
+                os.remove(path)
+        except OSError as e:
+            print(f"Error cleaning the keyword forms cache: {str(e)}")
+
+
+class ExtractionEngine:
+    """
+    Creates the text presets: keyword forms, extraction of the sentences, ignored keywords,
+    highlighting and writing of the preset files. It doesn't need any widget, MainApp and the
+    command line both use it.
+    """
+
+    def __init__(self, presets_dir, text_cache_settings=None, extraction_jobs=1, use_sentence_index=False,
+                 streaming_settings=None, pdf_settings=None, save_timings=False):
+        self.presets_dir = presets_dir
+        self.text_presets_dir = os.path.join(presets_dir, 'text_presets')
+        self.text_cache_dir = os.path.join(presets_dir, 'text_cache')  # Extracted text cache directory
+        self.sentence_index_path = os.path.join(presets_dir, 'sentence_index.db')  # Inverted index of the source files
+        self.normalization_settings_path = os.path.join(presets_dir, 'normalization_settings.txt')  # Broken characters replacements
+        self.keyword_forms_dir = os.path.join(presets_dir, 'keyword_forms')  # Singular and plural forms of the dictionaries
+        self.keyword_registry = KeywordRegistry(self.keyword_forms_dir)
+
+        self.text_cache_settings = dict(DEFAULT_TEXT_CACHE_SETTINGS, **(text_cache_settings or {}))
+        self.extraction_jobs = extraction_jobs
+        self.use_sentence_index = use_sentence_index
+        self.streaming_settings = dict(DEFAULT_STREAMING_SETTINGS, **(streaming_settings or {}))
+        self.pdf_settings = dict(DEFAULT_PDF_SETTINGS, **(pdf_settings or {}))
+        self.save_timings = save_timings  # Write the stage timings of each preset next to it
+        self.last_stats = None  # ExtractionStats of the last created preset
+
+    @classmethod
+    def from_session_settings(cls, presets_dir):
+        """Create the engine with the extraction settings of session_settings.txt, ignoring the other settings."""
+        settings = {}
+        session_settings_path = os.path.join(presets_dir, 'session_settings.txt')
+        if os.path.exists(session_settings_path):
+            try:
+                with open(session_settings_path, 'r', encoding='utf-8') as f:
+                    settings = json.load(f)
+            except Exception as e:
+                print(f"Error loading session settings: {str(e)}. Using default settings.")
+
+        return cls(
+            presets_dir,
+            text_cache_settings=settings.get("text_cache_settings"),
+            extraction_jobs=settings.get("extraction_jobs", 1),
+            use_sentence_index=settings.get("use_sentence_index", False),
+            streaming_settings=settings.get("streaming_settings"),
+            pdf_settings=settings.get("pdf_settings"),
+            save_timings=settings.get("save_extraction_timings", False)
+        )
+
+    @property
+    def plural(self):
+        return get_inflect_engine()
+
+    def create_preset(self, selected_files, keyword_profiles, preset_name="preset_output", highlight_keywords=True,
+                      output_option="Single output", max_length=200, metadata_settings=True, output_folder=None,
+                      metadata_prefix=";;", use_text_cache=None, jobs=None, use_sentence_index=None, streaming=None,
+                      save_timings=None, progress_callback=None, cancel_check=None):
+        """
+        Extract the sentences of the selected files matching the keyword profiles and write the preset files.
+        The text cache, the number of jobs, the sentence index, the streaming and the timings default to the engine settings.
+        With streaming, the sentences are kept in a temporary database instead of memory until they are written.
+        The time spent in each stage is printed as a table, and written to {preset_name}_timings.json
+        next to the preset with save_timings. The stats are kept in last_stats.
+        progress_callback(files_done, files_total, sentences, remaining_seconds, file_path, pages) is called after each file,
+        and after each batch of pages of a PDF extracted on its own with pages = (pages_done, pages_total), None otherwise,
+        cancel_check() is polled between files and raises ExtractionCancelled before anything is written.
+        Returns the summary message.
+        """
+        total_sentences = 0  # Counter for total unique sentences
+
+        start_time = time.time()
+
+        if use_text_cache is None:
+            use_text_cache = self.text_cache_settings["enabled"]
+        text_cache = self.get_text_cache() if use_text_cache else None
+        if jobs is None:
+            jobs = self.extraction_jobs
+        if use_sentence_index is None:
+            use_sentence_index = self.use_sentence_index
+        if streaming is None:
+            streaming = self.streaming_settings["enabled"]
+        if save_timings is None:
+            save_timings = self.save_timings
+        stats = ExtractionStats()
+        normalizer = self.get_text_normalizer()
+        sentence_index = SentenceIndex(self.sentence_index_path, normalizer) if use_sentence_index else None
+
+
+        try:
+            sentence_store = self.process_text_files(
+                    file_paths=selected_files,
+                    keyword_profiles=keyword_profiles,
+                    highlight_keywords=highlight_keywords,
+                    output_option=output_option,
+                    preset_name=preset_name,
+                    max_length=max_length,
+                    metadata_settings=metadata_settings,
+                    text_cache=text_cache,
+                    jobs=jobs,
+                    sentence_index=sentence_index,
+                    normalizer=normalizer,
+                    streaming=streaming,
+                    progress_callback=progress_callback,
+                    cancel_check=cancel_check,
+                    stats=stats
+                )
+        finally:
+            # The files processed before a cancellation stay cached and indexed
+            if text_cache:
+                text_cache.save_index()
+                print(text_cache.info())
+            if sentence_index:
+                print(sentence_index.info())
+                sentence_index.close()
+
+
+
+        try:
+            if cancel_check and cancel_check():
+                raise ExtractionCancelled()
+            write_start = time.perf_counter()
+            total_sentences = self.write_preset_files(sentence_store, preset_name, output_option, metadata_settings,
+                                                      output_folder)
+            stats.add_time("write", write_start)
+        finally:
+            sentence_store.close()
+
+        # End timer and calculate elapsed time
+        elapsed_time = time.time() - start_time
+        self.last_stats = stats
+        print(stats.table())
+        if save_timings:
+            self.write_timings(stats, preset_name, output_folder, elapsed_time)
+
+        summary_message = (f"Successfully extracted {total_sentences} unique sentences to: {preset_name}.txt in {elapsed_time:.2f} seconds!\n"
+                           f"Stages: {stats.summary()}")
+        print(summary_message)
+        return summary_message
+
+    def write_timings(self, stats, preset_name, output_folder=None, elapsed_time=None):
+        """Write the stats of the extraction of a preset to {preset_name}_timings.json next to the preset file."""
+        timings_path = os.path.join(output_folder if output_folder else self.text_presets_dir, f"{preset_name}_timings.json")
+        timings = dict(stats.to_dict(), preset=preset_name, elapsed_seconds=round(elapsed_time or 0, 4),
+                       created=time.strftime("%Y-%m-%d %H:%M:%S"))
+        try:
+            with open(timings_path, 'w', encoding='utf-8') as f:
+                json.dump(timings, f, indent=4)
+        except OSError as e:
+            print(f"Error writing the timings of {preset_name}: {str(e)}")
+
+    def write_preset_files(self, sentence_store, preset_name, output_option="Single output", metadata_settings=True,
+                           output_folder=None):
+        """
+        Write the combined preset file, and the keyword files with "All output", in a single pass over the sentences.
+        The presets are written in JSON Lines, one record per sentence.
+        Returns the number of unique sentences of the combined file.
+        """
+        total_sentences = 0
+
+        # Determine the output folder
+        target_folder = output_folder if output_folder else self.text_presets_dir
+        os.makedirs(target_folder, exist_ok=True)
+
+        # Create the combined output file and count unique sentences
+        combined_output_path = os.path.join(target_folder, f"{preset_name}.txt")
+        seen_sentences = sentence_store.new_digest_set()
+
+        keyword_file = None
+        current_keyword = None
+        try:
+            with open(combined_output_path, 'w', encoding='utf-8') as output_file:
+                for keyword, sentence_data in sentence_store.iter_sentences():
+                    if metadata_settings:
+                        sentence, filepath, metadata = sentence_data  # Now includes metadata
+                        line = format_preset_record(sentence, metadata)
+                    else:
+                        line = format_preset_record(sentence_data[0])
+
+                    # sentence and filepath
+                    if seen_sentences.add(f"{sentence_data[0]}\0{sentence_data[1]}"):
+                        total_sentences += 1
+                        output_file.write(line)
+
+                    # If "All output" is selected, create individual keyword files, one at a time
+                    if output_option == "All output":
+                        if keyword != current_keyword:
+                            if keyword_file:
+                                keyword_file.close()
+                            current_keyword = keyword
+                            keyword_output_path = os.path.join(target_folder, f"{preset_name}_{keyword}.txt")
+                            keyword_file = open(keyword_output_path, 'w', encoding='utf-8')
+                        keyword_file.write(line)
+        finally:
+            if keyword_file:
+                keyword_file.close()
+
+        return total_sentences
+
+    def benchmark_pdf_backends(self, sample_files, save=True, min_fidelity=0.9):
+        """
+        Extract the sample PDFs with every available backend, measuring the pages per second and the
+        fidelity of the text compared to the first available backend (PyPDF2 by default).
+        The fastest backend extracting every file with at least min_fidelity becomes the backend of
+        the engine, and of the pdf_settings of session_settings.txt when save is True.
+        Returns a list of (backend, pages, seconds, fidelity, error) in registration order.
+        """
+        results = []
+        reference_words = None
+        for name, backend in PDF_BACKENDS.items():
+            if not backend.is_available():
+                continue
+            try:
+                pages, seconds, words = measure_pdf_backend(sample_files, name)
+            except Exception as e:
+                results.append((name, 0, 0.0, 0.0, str(e)))
+                continue
+            if reference_words is None:
+                reference_words = words
+            results.append((name, pages, seconds, text_fidelity(words, reference_words), None))
+
+        print(f"{'Backend':<15}{'Pages':>8}{'Seconds':>10}{'Pages/s':>10}{'Fidelity':>10}")
+        for name, pages, seconds, fidelity, error in results:
+            if error:
+                print(f"{name:<15}failed: {error}")
+            else:
+                print(f"{name:<15}{pages:>8}{seconds:>10.2f}{pages / max(seconds, 1e-9):>10.1f}{fidelity:>10.1%}")
+
+        working = [result for result in results if not result[4] and result[3] >= min_fidelity]
+        if working:
+            fastest = min(working, key=lambda result: result[2])[0]
+            print(f"Fastest PDF backend: {fastest}")
+            self.set_pdf_backend(fastest, save)
+        else:
+            print("No PDF backend extracted the sample files.")
+        return results
+
+    def set_pdf_backend(self, backend, save=True):
+        """Use the PDF backend called backend, storing it in the pdf_settings of session_settings.txt when save is True."""
+        if backend not in PDF_BACKENDS:
+            raise ValueError(f"Unknown PDF backend: {backend}, expected one of {', '.join(PDF_BACKENDS)}")
+        self.pdf_settings["backend"] = backend
+        if not save:
+            return
+
+        settings = {}
+        session_settings_path = os.path.join(self.presets_dir, 'session_settings.txt')
+        if os.path.exists(session_settings_path):
+            with open(session_settings_path, 'r', encoding='utf-8') as f:
+                settings = json.load(f)
+        settings["pdf_settings"] = dict(DEFAULT_PDF_SETTINGS, **settings.get("pdf_settings", {}))
+        settings["pdf_settings"]["backend"] = backend
+        os.makedirs(self.presets_dir, exist_ok=True)
+        with open(session_settings_path, 'w', encoding='utf-8') as f:
+            json.dump(settings, f, indent=4)
+
+    def get_text_cache(self):
+        """Return the extracted text cache configured by the text cache settings."""
+        return TextCache(
+            self.text_cache_dir,
+            max_size_mb=self.text_cache_settings.get("max_size_mb", 1024),
+            use_content_hash=self.text_cache_settings.get("use_content_hash", False)
+        )
+
+    def get_text_normalizer(self):
+        """Return the text normalizer configured by the normalization settings file, the defaults if it can't be read."""
+        try:
+            return TextNormalizer.from_settings_file(self.normalization_settings_path)
+        except Exception as e:
+            print(f"Error loading normalization settings: {str(e)}. Using default replacements.")
+            return TextNormalizer()
+
+    def manage_text_cache(self, clear=False):
+        """Print the content of the extracted text cache, clearing it first if requested."""
+        text_cache = self.get_text_cache()
+        if clear:
+            text_cache.clear()
+            print("Text cache cleared.")
+        print(text_cache.info())
+        return text_cache.info()
+
+    def migrate_presets(self, folder=None, jobs=None):
+        """
+        Rewrite the legacy presets of the folder (the text presets by default) in JSON Lines,
+        with jobs presets converted in parallel. Presets already in JSON Lines are skipped.
+        Returns the number of migrated presets.
+        """
+        folder = folder if folder else self.text_presets_dir
+        if jobs is None:
+            jobs = self.extraction_jobs
+        try:
+            preset_paths = [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.endswith('.txt')]
+        except FileNotFoundError:
+            print(f"Folder not found: {folder}")
+            return 0
+
+        start_time = time.time()
+        migrated = 0
+
+        def report(preset_path, records, converted):
+            if converted:
+                print(f"Migrated {os.path.basename(preset_path)}: {records} sentences.")
+            return int(converted)
+
+        if jobs <= 1 or len(preset_paths) <= 1:
+            for preset_path in preset_paths:
+                try:
+                    migrated += report(*migrate_preset_file(preset_path))
+                except Exception as e:
+                    print(f"Error migrating {preset_path}: {str(e)}")
+        else:
+            with ProcessPoolExecutor(max_workers=min(jobs, len(preset_paths))) as executor:
+                futures = {executor.submit(migrate_preset_file, preset_path): preset_path for preset_path in preset_paths}
+                for future in as_completed(futures):
+                    try:
+                        migrated += report(*future.result())
+                    except Exception as e:
+                        print(f"Error migrating {futures[future]}: {str(e)}")
+
+        print(f"Migrated {migrated} of {len(preset_paths)} presets to JSON Lines in {time.time() - start_time:.2f} seconds.")
+        return migrated
+
+    def manage_pdf_backends(self, benchmark=None, set_backend=None):
+        """
+        Print the PDF backends and their availability, after benchmarking them on the benchmark files
+        or setting the backend called set_backend as the default one.
+        """
+        if set_backend:
+            try:
+                self.set_pdf_backend(set_backend)
+                print(f"PDF backend set to {set_backend}.")
+            except Exception as e:
+                print(f"Error setting the PDF backend: {str(e)}")
+        if benchmark:
+            self.benchmark_pdf_backends(benchmark)
+        for name, backend in PDF_BACKENDS.items():
+            status = "available" if backend.is_available() else "not installed"
+            default = " (default)" if name == self.pdf_settings["backend"] else ""
+            print(f"{name}: {status}{default}")
+
+    def manage_sentence_index(self, add_files=None, query=None, clear=False, max_results=20):
+        """
+        Update the sentence index with the given files, clear it or prune the deleted files,
+        and print the sentences matching the query keywords.
+        """
+        sentence_index = SentenceIndex(self.sentence_index_path, self.get_text_normalizer())
+        try:
+            if clear:
+                sentence_index.clear()
+                print("Sentence index cleared.")
+            else:
+                pruned = sentence_index.prune()
+                if pruned:
+                    print(f"Removed {pruned} deleted files from the sentence index.")
+
+            if add_files:
+                start_time = time.time()
+                indexed = sentence_index.update(add_files, self.pdf_settings)
+                print(f"Indexed {indexed} new or modified files in {time.time() - start_time:.2f} seconds.")
+
+            if query:
+                start_time = time.time()
+                keyword_forms_map = {}
+                for keyword in query:
+                    forms_list, exact_matches = self.get_keyword_forms(keyword)
+                    keyword_forms_map[keyword] = (forms_list, exact_matches, [])
+                matcher = KeywordMatcher([
+                    (keyword, forms_list, exact_matches)
+                    for keyword, (forms_list, exact_matches, _) in keyword_forms_map.items()
+                ])
+
+                results = []
+                for file_path, matches, _ in sentence_index.extract_files(
+                        sentence_index.indexed_files(), [(keyword_forms_map, matcher)], metadata_settings=False):
+                    results.extend(matches)
+
+                print(f"Found {len(results)} sentences in {(time.time() - start_time) * 1000:.0f} ms.")
+                for _, keyword, (sentence, file_path) in results[:max_results]:
+                    print(f"[{keyword}] {sentence} ({os.path.basename(file_path)})")
+
+            print(sentence_index.info())
+        finally:
+            sentence_index.close()
+
+    def process_text_files(self, file_paths, keyword_profiles, highlight_keywords=True, output_option="Single output", preset_name="preset_output", max_length=200, metadata_settings=True, metadata_prefix=";;", text_cache=None, jobs=1, sentence_index=None, normalizer=None, streaming=False, progress_callback=None, cancel_check=None, stats=None):
+        """
+        Process a list of EPUB, PDF, or text files and return the extracted sentences.
+        Returns a SentenceStore holding the keyword-sentence pairs with their complete file paths,
+        a StreamingSentenceStore with streaming. The caller must close it.
+        The timings of the stages are added to the ExtractionStats stats.
+        """
+        
+        # Process ignored keywords
+        ignored_keywords = keyword_profiles.get("Ignored keywords", [])
+        # Remove "Ignored keywords" from profiles for processing
+        if "Ignored keywords" in keyword_profiles:
+            del keyword_profiles["Ignored keywords"]
+
+        # Remove duplicates across all profiles
+        seen_keywords = set()
+        for profile, keywords in keyword_profiles.items():
+            unique_keywords = []
+            for keyword in keywords:
+                if keyword not in seen_keywords:
+                    unique_keywords.append(keyword)
+                    seen_keywords.add(keyword)
+            keyword_profiles[profile] = unique_keywords
+
+        # Remove duplicates from ignored keywords
+        ignored_keywords = list(set(ignored_keywords))
+
+        # Load the forms of every dictionary at once, from the keyword forms cache when it was already used
+        for keywords in [[keyword.lstrip('!') for keyword in ignored_keywords]] + list(keyword_profiles.values()):
+            self.keyword_registry.prepare(keywords)
+
+        # Compile the ignored keywords once, sentences containing them are skipped during extraction
+        ignored_matcher = self.compile_ignored_keywords(ignored_keywords)
+
+        # Gather all files in the specified folder
+
+
+        # Highlight keywords if requested, the sentences are highlighted as they are stored
+        highlighter = self.build_highlighter(keyword_profiles) if highlight_keywords else None
+
+        # Initialize storage for combined sentences and processed keywords
+        keywords = [keyword for keywords in keyword_profiles.values() for keyword in keywords]
+        profile_count = len([keywords for keywords in keyword_profiles.values() if keywords])
+        if streaming:
+            sentence_store = StreamingSentenceStore(keywords, profile_count, highlighter,
+                                                    self.streaming_settings.get("memory_budget_mb", 256))
+        else:
+            sentence_store = SentenceStore(keywords, profile_count, highlighter)
+        processed_keywords = []
+
+        # Extract sentences for all profiles, each file gets parsed only once
+        try:
+            self.extract_sentences_with_keywords(
+                file_paths, keyword_profiles, sentence_store,
+                processed_keywords, max_length, metadata_settings, metadata_prefix, text_cache, jobs, sentence_index,
+                ignored_matcher, normalizer, progress_callback, cancel_check, stats
+            )
+        except BaseException:
+            sentence_store.close()
+            raise
+
+        if stats is not None:
+            stats.seconds["highlight"] += sentence_store.highlight_seconds
+
+        return sentence_store
+
+    def get_keyword_forms(self, keyword):
+        """
+        Get the forms of a keyword, handling the '&' prefix and combined keywords.
+        Returns a list of forms and a boolean indicating if it's an exact match.
+        """
+        if '+' in keyword:
+            # Split combined keywords and process each part
+            parts = [k.strip() for k in keyword.split('+')]
+            all_forms = []
+            exact_matches = []
+            
+            for part in parts:
+                if part.startswith('&'):
+                    all_forms.append([part[1:]])  # Exact form only
+                    exact_matches.append(True)
+                else:
+                    all_forms.append([self.get_singular_form(part), self.get_plural_form(part)])
+                    exact_matches.append(False)
+            
+            return all_forms, exact_matches
+        else:
+            if keyword.startswith('&'):
+                return [[keyword[1:]]], [True]  # Single keyword, exact match
+            else:
+                return [[self.get_singular_form(keyword), self.get_plural_form(keyword)]], [False]  # Single keyword, both forms
+
+
+
+    def compile_ignored_keywords(self, ignored_keywords):
+        """
+        Compile the ignored keywords into a single matcher, a sentence is ignored when any form of any keyword is found.
+        Handles both regular ignored keywords and exact matches (with & prefix).
+        Returns None if there are no ignored keywords.
+        """
+        keyword_forms = []
+        for ignored_keyword in ignored_keywords:
+            # Remove the ! prefix first
+            keyword = ignored_keyword.lstrip('!')
+
+            # Get the forms to check (handles both exact and regular matches)
+            forms_to_check, exact_matches = self.get_keyword_forms(keyword)
+            keyword_forms.append((keyword, forms_to_check, exact_matches))
+
+        if not keyword_forms:
+            return None
+        # Exact matches (with &) must not touch any other word character
+        return KeywordMatcher(keyword_forms, exact_boundaries=True)
+
+
+
+
+    def build_highlighter(self, profiles):
+        """
+        Build the highlighter of the keywords and their forms, with the appropriate number of brackets based on the profile name.
+        All keywords are highlighted in a single scan per sentence, earlier profiles win.
+        Returns None if there is nothing to highlight.
+        """
+        processed_forms = set()
+        keyword_brackets = []
+        for profile_name, keywords in profiles.items():
+            # Extract the numeric part from the profile name (e.g., 'Keywords_1' -> 1)
+            match = re.search(r'(\d+)', profile_name)
+            bracket_count = int(match.group(1)) if match else 1  # Default to 1 if no number is found
+
+            # Process each keyword in the profile
+            for keyword in keywords:
+                # Get all forms of the keyword(s)
+                forms_list, exact_matches = self.get_keyword_forms(keyword)
+
+                # Flatten the forms list for highlighting
+                all_forms = [form for sublist in forms_list for form in sublist]
+                forms_lower = [form.lower() for form in all_forms]
+
+                if not processed_forms.isdisjoint(forms_lower):
+                    continue
+
+                keyword_brackets.append((all_forms, bracket_count))
+
+                # Add all forms to processed_forms
+                processed_forms.update(forms_lower)
+
+        if not keyword_brackets:
+            return None
+        return KeywordHighlighter(keyword_brackets)
+
+
+
+    def get_plural_form(self, keyword):
+        return self.keyword_registry.plural(keyword)
+
+    def get_singular_form(self, keyword):
+        # Words already in singular form are returned as they are
+        return self.keyword_registry.singular(keyword)
+
+                
+    def extract_sentences_with_keywords(self, file_paths, keyword_profiles, sentence_store, processed_keywords, max_length, metadata_settings=True, metadata_prefix=";;", text_cache=None, jobs=1, sentence_index=None, ignored_matcher=None, normalizer=None, progress_callback=None, cancel_check=None, stats=None):
+        """
+        Extract sentences containing the keywords of every profile from the list of files.
+        Each file is loaded, cleaned and split only once, then matched against the profiles in order.
+        Keywords whose forms were all used by a previous profile are skipped.
+        When a TextCache is given, unchanged files are read from it instead of being parsed again.
+        With jobs > 1 the files are processed in parallel by that many worker processes.
+        When a SentenceIndex is given, the sentences are looked up in the index instead.
+        The sentences are added to the SentenceStore, unique per profile.
+        The stats of every file are added to the ExtractionStats stats.
+        progress_callback and cancel_check are described in create_preset.
+        """
+        # Pre-process keywords and their forms, profile by profile so the first profile wins
+        # processed_forms mirrors processed_keywords for the lookups
+        processed_forms = set(processed_keywords)
+        profile_matchers = []
+        profile_names = []
+        for profile_name, keywords in keyword_profiles.items():
+            if not keywords:
+                continue
+
+            keyword_forms_map = {}
+            for keyword in keywords:
+                forms_list, exact_matches = self.get_keyword_forms(keyword)
+                # Skip if all forms have been processed
+                all_forms = [form.lower() for sublist in forms_list for form in sublist]
+                if processed_forms.issuperset(all_forms):
+                    continue
+                keyword_forms_map[keyword] = (forms_list, exact_matches, all_forms)
+
+            # Update processed keywords
+            for _, (_, _, all_forms) in keyword_forms_map.items():
+                processed_keywords.extend(all_forms)
+                processed_forms.update(all_forms)
+
+            # Compile every remaining keyword into a single matcher, each sentence is then scanned once
+            matcher = KeywordMatcher([
+                (keyword, forms_list, exact_matches)
+                for keyword, (forms_list, exact_matches, _) in keyword_forms_map.items()
+            ])
+
+            profile_matchers.append((keyword_forms_map, matcher))
+            profile_names.append(profile_name)
+
+        # The remaining time is estimated from the size of the files
+        file_sizes = {}
+        if progress_callback:
+            for file_path in file_paths:
+                try:
+                    file_sizes[file_path] = os.path.getsize(file_path)
+                except OSError:
+                    file_sizes[file_path] = 0
+        files_total = len([file_path for file_path in file_paths if file_path.endswith(SUPPORTED_EXTENSIONS)])
+        total_size = sum(file_sizes.values())
+        files_done = 0
+        done_size = 0
+        start_time = time.time()
+
+        def report_pages(file_path, pages_done, pages_total):
+            # Called between the batches of pages of a PDF, before the file is done
+            if cancel_check and cancel_check():
+                raise ExtractionCancelled()
+            if progress_callback:
+                pages_size = file_sizes.get(file_path, 0) * pages_done / pages_total
+                remaining_time = estimate_remaining_time(start_time, done_size + pages_size, total_size)
+                progress_callback(files_done, files_total, sentence_store.count, remaining_time, file_path,
+                                  (pages_done, pages_total))
+
+        # Process each file once, the results come back in the order of file_paths
+        if sentence_index:
+            results = sentence_index.extract_files(file_paths, profile_matchers, max_length, metadata_settings, metadata_prefix,
+                                                   ignored_matcher, self.pdf_settings)
+        else:
+            results = extract_files(file_paths, profile_matchers, max_length, metadata_settings, metadata_prefix, text_cache, jobs,
+                                    ignored_matcher, normalizer, self.pdf_settings, report_pages)
+
+        for files_done, (file_path, matches, file_stats) in enumerate(results, 1):
+            if cancel_check and cancel_check():
+                results.close()  # Stops the worker processes
+                raise ExtractionCancelled()
+            if stats is not None:
+                stats.add_file(file_path, file_stats)
+
+            for profile_index, keyword, sentence_data in matches:
+                sentence_store.add(profile_index, keyword, sentence_data)
+
+            if progress_callback:
+                done_size += file_sizes.get(file_path, 0)
+                sentences = sentence_store.count
+                remaining_time = estimate_remaining_time(start_time, done_size, total_size)
+                progress_callback(files_done, files_total, sentences, remaining_time, file_path, None)
+
+        print(f"Processed keywords: {processed_keywords[0:5]} ...")
+        for profile_name, profile_count in zip(profile_names, sentence_store.profile_counts):
+            print(f"{profile_name}: extracted {profile_count} unique sentences.")